@@ -0,0 +1,104 @@
+#! -*- coding: utf-8 -*-
+#
+# author: forcemain@163.com
+
+from __future__ import annotations
+
+import eventlet
+
+# werkzeug的ProxyMiddleware使用标准库http.client,需打补丁才不会阻塞事件循环
+eventlet.monkey_patch()
+
+import time
+import typing as t
+
+from eventlet import wsgi
+from eventlet.green.http import client
+from werkzeug.middleware.http_proxy import ProxyMiddleware
+from service_webserver.core.middlewares.http_proxy import HttpProxyMiddleware
+
+# 对比: werkzeug的ProxyMiddleware(每个请求新建连接) vs 连接池化的HttpProxyMiddleware
+#
+# python benchmark/bench_http_proxy.py
+
+CLIENTS = 20
+REQUESTS = 200
+UPLOAD_SIZE = 1 << 20
+
+
+class NullLog(object):
+    """ 丢弃服务器日志 """
+
+    def write(self, *args: t.Any) -> None:
+        pass
+
+
+def upstream_app(environ: t.Dict, start_response: t.Callable) -> t.Iterable[bytes]:
+    """ 模拟上游: /echo回显请求体,其它返回固定内容
+
+    注意: 路径都带查询字符串,werkzeug的ProxyMiddleware要求环境对象中存在QUERY_STRING
+    """
+    if environ['PATH_INFO'].endswith('/echo'):
+        body = environ['wsgi.input'].read()
+        start_response('200 OK', [('Content-Length', str(len(body)))])
+        return [body]
+    start_response('200 OK', [('Content-Type', 'application/json'), ('Content-Length', '11')])
+    return [b'{"ok":true}']
+
+
+def fallback_app(environ: t.Dict, start_response: t.Callable) -> t.Iterable[bytes]:
+    start_response('404 Not Found', [('Content-Length', '0')])
+    return []
+
+
+def serve(app: t.Callable) -> int:
+    """ 在随机端口启动服务器并返回端口 """
+    sock = eventlet.listen(('127.0.0.1', 0), backlog=1024)
+    eventlet.spawn(wsgi.server, sock, app, log=NullLog(), log_output=False)
+    return sock.getsockname()[1]
+
+
+def run_clients(port: int, method: t.Text, path: t.Text, body: t.Optional[bytes], number: int) -> float:
+    """ 多个保活客户端并发请求,返回每秒请求数 """
+
+    def client_loop() -> None:
+        conn = client.HTTPConnection('127.0.0.1', port, timeout=30)
+        for _ in range(number):
+            conn.request(method, path, body=body)
+            response = conn.getresponse()
+            data = response.read()
+            assert response.status == 200, (response.status, data)
+            assert body is None or len(data) == len(body)
+        conn.close()
+
+    start = time.perf_counter()
+    pool = eventlet.GreenPool(CLIENTS)
+    for _ in range(CLIENTS):
+        pool.spawn(client_loop)
+    pool.waitall()
+    return CLIENTS * number / (time.perf_counter() - start)
+
+
+def main() -> None:
+    upstream_port = serve(upstream_app)
+    targets = {'/api': {'target': f'http://127.0.0.1:{upstream_port}/'}}
+    werkzeug_port = serve(ProxyMiddleware(fallback_app, targets))
+    pooled = HttpProxyMiddleware(
+        wsgi_app=fallback_app, producer=None, targets=targets, max_idle=CLIENTS, max_per_host=CLIENTS
+    )
+    pooled_port = serve(pooled)
+    upload = b'x' * UPLOAD_SIZE
+    cases = [
+        ('GET small', 'GET', '/api/items?page=1', None, REQUESTS),
+        ('POST 1MB echo', 'POST', '/api/echo?page=1', upload, REQUESTS // 10),
+    ]
+    print(f'{"case":<16}{"werkzeug(req/s)":>18}{"pooled(req/s)":>16}{"speedup":>10}')
+    for name, method, path, body, number in cases:
+        werkzeug_rps = run_clients(werkzeug_port, method, path, body, number)
+        pooled_rps = run_clients(pooled_port, method, path, body, number)
+        print(f'{name:<16}{werkzeug_rps:>18.0f}{pooled_rps:>16.0f}{pooled_rps / werkzeug_rps:>9.2f}x')
+    print(f'upstream connections: {pooled.pools["/api/"].stats}')
+
+
+if __name__ == '__main__':
+    main()
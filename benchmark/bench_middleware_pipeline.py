@@ -0,0 +1,120 @@
+#! -*- coding: utf-8 -*-
+#
+# author: forcemain@163.com
+
+from __future__ import annotations
+
+import timeit
+import typing as t
+
+from werkzeug.routing import Map
+from werkzeug.routing import Rule
+from werkzeug.test import EnvironBuilder
+from werkzeug.wrappers import Response
+from service_webserver.core.timing import TimingRegistry
+from service_webserver.core.metrics import MetricsRegistry
+from service_webserver.core.inflight import InflightRegistry
+from service_webserver.core.middlewares.proxy_fix import ProxyFixMiddleware
+from service_webserver.core.middlewares.profiler import ProfilerMiddleware
+from service_webserver.core.middlewares.openapi3 import OpenApi3Middleware
+from service_webserver.core.entrypoints.webserver.wsgi_app import WsgiApp
+from service_webserver.core.middlewares.corsheader import CorsHeaderMiddleware
+from service_webserver.core.entrypoints.webserver.pipeline import PipelineStep
+
+# 对比: 全部中间件包装整个应用 vs 按路由编译的中间件管道
+#
+# python benchmark/bench_middleware_pipeline.py
+
+ROUTES = 50
+NUMBER = 20000
+
+
+class FakeConsumer(object):
+    """ 模拟路由对象 """
+
+    def __init__(self, raw_url: t.Text, tags: t.List[t.Text], middlewares: t.List[t.Text]) -> None:
+        self.raw_url = raw_url
+        self.tags = tags
+        self.middlewares = middlewares
+
+    @property
+    def rule(self) -> Rule:
+        return Rule(self.raw_url, endpoint=self, methods=['GET'])
+
+    def handle_request(self, request: t.Any) -> Response:
+        return Response('ok')
+
+
+class FakeProducer(object):
+    """ 模拟请求生产者 """
+
+    def __init__(self) -> None:
+        self.all_extensions = [FakeConsumer(f'/api/v{i}/items', ['api'], []) for i in range(ROUTES)]
+        # 只有少数路由需要跨域和性能分析
+        self.all_extensions.append(FakeConsumer('/public/items', ['public'], []))
+        self.all_extensions.append(FakeConsumer('/debug/items', ['debug'], ['ProfilerMiddleware']))
+        self.inflight = InflightRegistry()
+        self.metrics = MetricsRegistry()
+        self.timing = TimingRegistry(self.metrics)
+        self.max_body_size = None
+        self.max_part_size = None
+        self.hub_lag = None
+
+    def create_urls_map(self) -> Map:
+        return Map([e.rule for e in self.all_extensions])
+
+
+# 中间件类及其配置(由内到外)
+MIDDLEWARES = [
+    (CorsHeaderMiddleware, {}, {'route_prefixes': ['/public']}),
+    (OpenApi3Middleware, {}, {}),
+    (ProfilerMiddleware, {'stream': None}, {'route_opt_in': True}),
+    (ProxyFixMiddleware, {'x_for': 1}, {}),
+]
+
+
+def make_wrap_all(producer: FakeProducer) -> t.Callable:
+    """ 旧实现: 每个中间件包装整个应用 """
+    wsgi_app = WsgiApp(producer).wsgi_app
+    for middleware, config, _ in MIDDLEWARES:
+        wsgi_app = middleware(wsgi_app=wsgi_app, producer=producer, **config)
+    return wsgi_app
+
+
+def make_compiled(producer: FakeProducer) -> t.Callable:
+    """ 新实现: 先匹配路由再进入编译后的管道 """
+    wsgi_app, loaded = WsgiApp(producer), []
+    for middleware, config, route_options in MIDDLEWARES:
+        step = PipelineStep()
+        instance = middleware(wsgi_app=step, producer=producer, **config)
+        instance.set_route_options(**route_options)
+        loaded.append((instance, step))
+    wsgi_app.compile(loaded)
+    return wsgi_app.entry
+
+
+def bench(app: t.Callable, path: t.Text) -> float:
+    """ 返回每个请求的平均微秒数 """
+    environ = EnvironBuilder(path=path).get_environ()
+
+    def start_response(status, headers, exc_info=None):
+        return lambda data: None
+
+    def run() -> None:
+        for _ in app(dict(environ), start_response):
+            pass
+
+    return min(timeit.repeat(run, number=NUMBER, repeat=3)) / NUMBER * 1e6
+
+
+def main() -> None:
+    producer = FakeProducer()
+    wrap_all, compiled = make_wrap_all(producer), make_compiled(producer)
+    print(f'{"path":<20}{"wrap-all(us)":>14}{"compiled(us)":>14}{"speedup":>10}')
+    for path in ('/api/v7/items', '/public/items', '/not/found'):
+        old, new = bench(wrap_all, path), bench(compiled, path)
+        print(f'{path:<20}{old:>14.2f}{new:>14.2f}{old / new:>9.2f}x')
+
+
+if __name__ == '__main__':
+    main()
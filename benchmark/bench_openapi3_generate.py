@@ -0,0 +1,96 @@
+#! -*- coding: utf-8 -*-
+#
+# author: forcemain@163.com
+
+from __future__ import annotations
+
+import time
+import typing as t
+
+from pydantic import Required
+from pydantic import BaseModel
+from pydantic import create_model
+from service_webserver.core.request import Request
+from service_webserver.core.openapi3.generate.depent import params
+from service_webserver.core.entrypoints.webserver.consumer import ApiReqConsumer
+from service_webserver.core.middlewares.openapi3.generate import OpenApiGenerator
+
+# 对比: 1000个路由的冷启动全量生成 vs 增量生成(无变化/新增一个路由)
+#
+# python benchmark/bench_openapi3_generate.py
+
+ROUTES = 1000
+MODELS = 200
+
+
+class BenchConsumer(ApiReqConsumer):
+    """ 无需服务容器的路由对象 """
+
+    endpoint = None
+
+    def __init__(self, raw_url: t.Text, endpoint: t.Callable[..., t.Any], **kwargs: t.Any) -> None:
+        super(BenchConsumer, self).__init__(raw_url, **kwargs)
+        self.endpoint = endpoint
+
+
+def make_models() -> t.List[t.Type[BaseModel]]:
+    """ 生成带嵌套的模型 """
+    models = []
+    for i in range(MODELS):
+        fields = {'name': (str, ...), 'size': (int, 0), 'tags': (t.List[str], [])}
+        # 每5个模型组成一条嵌套链
+        i % 5 and fields.update({'parent': (t.Optional[models[-1]], None)})
+        models.append(create_model(f'Model{i}', **fields))
+    return models
+
+
+def make_endpoint(body_model: t.Type[BaseModel]) -> t.Callable[..., t.Any]:
+    """ 生成带路径/查询/头部/请求体参数的视图函数 """
+
+    def endpoint(
+            self: t.Any, request: Request,
+            item_id: int = params.Path(Required, description='item id'),
+            page: int = params.Query(1, description='page'),
+            apikey: t.Text = params.Header(Required, description='apikey'),
+            body: t.Any = params.Body(Required, description='body')
+    ) -> None:
+        """ synthetic endpoint """
+
+    # 延迟注解在此无法解析局部变量,直接写入真实类型
+    endpoint.__annotations__['body'] = body_model
+    return endpoint
+
+
+def make_router(index: int, models: t.List[t.Type[BaseModel]]) -> BenchConsumer:
+    """ 生成单个路由 """
+    body_model = models[index % len(models)]
+    response_model = models[(index * 7) % len(models)]
+    return BenchConsumer(
+        f'/api/v1/group{index % 20}/item{index}/<int:item_id>',
+        make_endpoint(body_model), methods=('GET', 'POST', 'PUT'),
+        tags=[f'group{index % 20}'], summary=f'item{index}', response_model=response_model
+    )
+
+
+def timed(func: t.Callable[[], t.Any]) -> float:
+    """ 返回耗时毫秒数 """
+    start = time.perf_counter()
+    func()
+    return (time.perf_counter() - start) * 1000
+
+
+def main() -> None:
+    models = make_models()
+    routers = [make_router(i, models) for i in range(ROUTES)]
+    generator = OpenApiGenerator()
+    cold = timed(lambda: generator.generate(title='bench', routers=routers))
+    warm = timed(lambda: generator.generate(title='bench', routers=routers))
+    routers.append(make_router(ROUTES, models))
+    added = timed(lambda: generator.generate(title='bench', routers=routers))
+    removed = timed(lambda: generator.generate(title='bench', routers=routers[:-1]))
+    print(f'{"routes":<10}{"cold(ms)":>12}{"unchanged(ms)":>16}{"add one(ms)":>14}{"remove one(ms)":>16}')
+    print(f'{ROUTES:<10}{cold:>12.1f}{warm:>16.1f}{added:>14.1f}{removed:>16.1f}')
+
+
+if __name__ == '__main__':
+    main()
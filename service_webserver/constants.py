@@ -12,6 +12,10 @@ DEFAULT_WEBSERVER_HEADERS_MAPPING = {
 }
 
 # DOC服务配置
+# 文档缓存文件路径,优先于中间件的cache_path选项
+OPENAPI3_CACHE_PATH_ENV_KEY = 'SERVICE_WEBSERVER_OPENAPI3_CACHE_PATH'
+# 文档缓存格式版本,生成逻辑变化时需递增以使旧缓存失效
+OPENAPI3_CACHE_FORMAT_VERSION = 1
 DEFAULT_DEFINITIONS_REF_PREFIX = '#/components/schemas/'
 DEFAULT_CODE_THAT_WITH_NO_BODY = {100, 102, 102, 103, 204, 304}
 DEFAULT_METHODS_THAT_WITH_BODY = {'GET', 'HEAD', 'POST', 'PUT', 'DELETE', 'PATCH'}
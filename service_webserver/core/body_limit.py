@@ -0,0 +1,161 @@
+#! -*- coding: utf-8 -*-
+#
+# author: forcemain@163.com
+
+from __future__ import annotations
+
+import typing as t
+
+from werkzeug.exceptions import RequestEntityTooLarge
+
+if t.TYPE_CHECKING:
+    # 由于其定义在存根文件所以需要在TYPE_CHECKING下
+    from werkzeug.wsgi import WSGIEnvironment
+
+# 请求体的最大字节数,Request解析表单时同样以此为上限
+MAX_BODY_SIZE_ENVIRON_KEY = 'service_webserver.max_body_size'
+# multipart请求中单个部分的最大字节数
+MAX_PART_SIZE_ENVIRON_KEY = 'service_webserver.max_part_size'
+# 由协议类提供的回调,拒绝请求体后调用以关闭连接,避免服务器为了保活而读完剩余的请求体
+CLOSE_CONNECTION_ENVIRON_KEY = 'service_webserver.close_connection'
+
+
+def reject_request_body(environ: WSGIEnvironment) -> RequestEntityTooLarge:
+    """ 拒绝请求体并在响应后关闭连接
+
+    @param environ: 环境对象
+    @return: RequestEntityTooLarge
+    """
+    close_connection = environ.get(CLOSE_CONNECTION_ENVIRON_KEY)
+    close_connection is None or close_connection()
+    return RequestEntityTooLarge()
+
+
+class LimitedInput(object):
+    """ 限制读取总字节数的输入流
+
+    用于没有Content-Length的分块请求体,边读边计数,超出时抛出RequestEntityTooLarge
+    """
+
+    def __init__(self, environ: WSGIEnvironment, stream: t.BinaryIO, limit: int) -> None:
+        """ 初始化实例
+
+        @param environ: 环境对象
+        @param stream: 原始输入流
+        @param limit: 最大字节数
+        """
+        self.environ = environ
+        self.stream = stream
+        self.limit = limit
+        self.position = 0
+
+    def get_size(self, size: t.Optional[int]) -> int:
+        """ 计算本次最多读取的字节数
+
+        @param size: 调用者期望的字节数
+        @return: int
+        """
+        # 多读一个字节才能判断是否超出
+        remaining = self.limit - self.position + 1
+        return remaining if size is None or size < 0 else min(size, remaining)
+
+    def count(self, data: bytes) -> bytes:
+        """ 累计已读取的字节数
+
+        @param data: 本次读取的数据
+        @return: bytes
+        """
+        self.position += len(data)
+        if self.position > self.limit:
+            raise reject_request_body(self.environ)
+        return data
+
+    def read(self, size: t.Optional[int] = -1) -> bytes:
+        """ 读取数据
+
+        @param size: 最大字节数
+        @return: bytes
+        """
+        return self.count(self.stream.read(self.get_size(size)))
+
+    def readline(self, size: t.Optional[int] = None) -> bytes:
+        """ 读取一行
+
+        @param size: 最大字节数
+        @return: bytes
+        """
+        return self.count(self.stream.readline(self.get_size(size)))
+
+    def readlines(self, hint: t.Optional[int] = None) -> t.List[bytes]:
+        """ 读取所有行
+
+        @param hint: 忽略
+        @return: t.List[bytes]
+        """
+        return list(self)
+
+    def __iter__(self) -> t.Iterator[bytes]:
+        return iter(self.readline, b'')
+
+
+class LimitedPartFile(object):
+    """ 限制写入总字节数的multipart文件部分 """
+
+    def __init__(self, environ: WSGIEnvironment, stream: t.BinaryIO, limit: int) -> None:
+        """ 初始化实例
+
+        @param environ: 环境对象
+        @param stream: 原始文件对象
+        @param limit: 最大字节数
+        """
+        self.environ = environ
+        self.stream = stream
+        self.limit = limit
+        self.size = 0
+
+    def write(self, data: bytes) -> int:
+        """ 写入数据
+
+        @param data: 数据
+        @return: int
+        """
+        self.size += len(data)
+        if self.size > self.limit:
+            self.stream.close()
+            raise reject_request_body(self.environ)
+        return self.stream.write(data)
+
+    def __getattr__(self, name: t.Text) -> t.Any:
+        return getattr(self.stream, name)
+
+    def __iter__(self) -> t.Iterator[bytes]:
+        return iter(self.stream)
+
+
+def limit_request_body(
+        environ: WSGIEnvironment,
+        max_body_size: t.Optional[int],
+        max_part_size: t.Optional[int]
+) -> bool:
+    """ 在读取之前限制请求体大小
+
+    有Content-Length时直接比较,分块请求体则包装输入流在读取时计数
+
+    @param environ: 环境对象
+    @param max_body_size: 请求体的最大字节数,None表示不限制
+    @param max_part_size: multipart请求中单个部分的最大字节数,None表示不限制
+    @return: bool 是否在限制之内
+    """
+    environ[MAX_BODY_SIZE_ENVIRON_KEY] = max_body_size
+    environ[MAX_PART_SIZE_ENVIRON_KEY] = max_part_size
+    if max_body_size is None:
+        return True
+    content_length = environ.get('CONTENT_LENGTH')
+    if content_length:
+        # 非法的Content-Length由werkzeug按0处理,服务器也不会读取请求体
+        return not content_length.isdigit() or int(content_length) <= max_body_size
+    if 'chunked' in environ.get('HTTP_TRANSFER_ENCODING', '').lower():
+        environ['wsgi.input'] = LimitedInput(environ, environ['wsgi.input'], max_body_size)
+        # 告知werkzeug输入流会自行结束,否则没有Content-Length时会返回空流
+        environ['wsgi.input_terminated'] = True
+    return True
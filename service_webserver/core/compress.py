@@ -0,0 +1,144 @@
+#! -*- coding: utf-8 -*-
+#
+# author: forcemain@163.com
+
+from __future__ import annotations
+
+import zlib
+import typing as t
+
+try:
+    # 可选依赖 - pip install brotli
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    # 可选依赖 - pip install zstandard
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# 服务端优先选择的压缩算法顺序
+DEFAULT_ENCODINGS_PRIORITY = ('br', 'zstd', 'gzip', 'deflate')
+# 动态压缩时各算法的默认压缩级别
+DEFAULT_COMPRESS_LEVELS = {'br': 4, 'zstd': 3, 'gzip': 6, 'deflate': 6}
+# 预压缩时各算法的默认压缩级别
+DEFAULT_PRECOMPRESS_LEVELS = {'br': 11, 'zstd': 19, 'gzip': 9, 'deflate': 9}
+
+
+def get_available_encodings() -> t.Tuple[t.Text, ...]:
+    """ 获取当前环境可用的压缩算法
+
+    @return: t.Tuple[t.Text, ...]
+    """
+    unavailable = set()
+    brotli is None and unavailable.add('br')
+    zstandard is None and unavailable.add('zstd')
+    return tuple(e for e in DEFAULT_ENCODINGS_PRIORITY if e not in unavailable)
+
+
+def parse_accept_encoding(accept_encoding: t.Text) -> t.Dict[t.Text, float]:
+    """ 解析Accept-Encoding头部
+
+    @param accept_encoding: 头部的值
+    @return: t.Dict[t.Text, float]
+    """
+    qualities = {}
+    for item in accept_encoding.split(','):
+        name, _, params = item.partition(';')
+        name = name.strip().lower()
+        if not name:
+            continue
+        quality = 1.0
+        for param in params.split(';'):
+            key, _, value = param.partition('=')
+            if key.strip().lower() != 'q':
+                continue
+            try:
+                quality = float(value.strip())
+            except ValueError:
+                quality = 0.0
+        qualities[name] = quality
+    return qualities
+
+
+def negotiate_encoding(accept_encoding: t.Optional[t.Text], encodings: t.Sequence[t.Text]) -> t.Optional[t.Text]:
+    """ 根据Accept-Encoding协商压缩算法
+
+    质量值相同时以服务端给出的顺序优先
+
+    @param accept_encoding: 头部的值
+    @param encodings: 服务端可用的压缩算法
+    @return: t.Optional[t.Text]
+    """
+    if not accept_encoding:
+        return None
+    qualities = parse_accept_encoding(accept_encoding)
+    default = qualities.get('*', 0.0)
+    best, best_quality = None, 0.0
+    for encoding in encodings:
+        quality = qualities.get(encoding, default)
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+class Compressor(object):
+    """ 统一接口的流式压缩器 """
+
+    def __init__(self, encoding: t.Text, level: t.Optional[int] = None) -> None:
+        """ 初始化实例
+
+        @param encoding: 压缩算法
+        @param level: 压缩级别
+        """
+        self.encoding = encoding
+        level = DEFAULT_COMPRESS_LEVELS[encoding] if level is None else level
+        if encoding == 'gzip':
+            self.obj = zlib.compressobj(level, zlib.DEFLATED, 31)
+        elif encoding == 'deflate':
+            self.obj = zlib.compressobj(level, zlib.DEFLATED, 15)
+        elif encoding == 'br' and brotli is not None:
+            self.obj = brotli.Compressor(quality=level)
+        elif encoding == 'zstd' and zstandard is not None:
+            self.obj = zstandard.ZstdCompressor(level=level).compressobj()
+        else:
+            raise ValueError(f'unsupported content encoding {encoding}')
+
+    def compress(self, data: bytes) -> bytes:
+        """ 压缩数据块
+
+        @param data: 原始数据
+        @return: bytes
+        """
+        return self.obj.process(data) if self.encoding == 'br' else self.obj.compress(data)
+
+    def flush(self) -> bytes:
+        """ 同步刷出已压缩数据,保证流式场景下客户端能及时解码
+
+        @return: bytes
+        """
+        if self.encoding == 'br':
+            return self.obj.flush()
+        if self.encoding == 'zstd':
+            return self.obj.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+        return self.obj.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        """ 结束压缩并刷出剩余数据
+
+        @return: bytes
+        """
+        return self.obj.finish() if self.encoding == 'br' else self.obj.flush()
+
+
+def compress_bytes(data: bytes, encoding: t.Text, level: t.Optional[int] = None) -> bytes:
+    """ 一次性压缩数据
+
+    @param data: 原始数据
+    @param encoding: 压缩算法
+    @param level: 压缩级别
+    @return: bytes
+    """
+    compressor = Compressor(encoding, level=level)
+    return compressor.compress(data) + compressor.finish()
@@ -7,8 +7,10 @@ from __future__ import annotations
 import re
 import sys
 import enum
+import time
 import eventlet
 import typing as t
+import collections.abc
 
 from http import HTTPStatus
 from logging import getLogger
@@ -22,9 +24,17 @@ from service_core.core.context import WorkerContext
 from service_core.core.decorator import AsLazyProperty
 from service_webserver.core.response import JsonResponse
 from service_webserver.core.response import HtmlResponse
+from service_webserver.core.response import StaticResponse
+from service_webserver.core.response import StreamingJsonResponse
 from service_core.core.service.entrypoint import Entrypoint
 from service_webserver.constants import WEBSERVER_CONFIG_KEY
 from service_core.exchelper import gen_exception_description
+from service_webserver.core.timing import PHASE_WAIT
+from service_webserver.core.timing import PHASE_SPAWN
+from service_webserver.core.timing import PHASE_CONTEXT
+from service_webserver.core.timing import PHASE_SERIALIZE
+from service_webserver.core.timing import TIMING_ENVIRON_KEY
+from service_webserver.core.inflight import INFLIGHT_ENVIRON_KEY
 from service_webserver.core.default import DefaultResponseModel
 from service_webserver.core.convert import from_headers_to_context
 from service_webserver.core.openapi3.generate.depent.models import Dependent
@@ -37,6 +47,8 @@ from .producer import ReqProducer
 logger = getLogger(__name__)
 # 响应状态
 HttpStatus = t.Optional[t.Union[int, str, HTTPStatus]]
+# 允许冻结及回放响应的请求方法,其它方法仍由工作协程处理
+FROZEN_METHODS = ('GET', 'HEAD')
 
 
 class ReqConsumer(Entrypoint):
@@ -62,6 +74,11 @@ class ReqConsumer(Entrypoint):
             include_in_doc: t.Optional[bool] = True,
             other_response: t.Optional[t.Dict[t.Union[int, t.Text], t.Dict[t.Text, t.Any]]] = None,
             rule_options: t.Optional[t.Dict[t.Text, t.Any]] = None,
+            frozen: t.Optional[bool] = False,
+            middlewares: t.Optional[t.List[t.Text]] = None,
+            rate_limit: t.Optional[t.Text] = None,
+            max_body_size: t.Optional[int] = None,
+            max_part_size: t.Optional[int] = None,
             **kwargs
     ) -> None:
         """ 初始化实例
@@ -77,6 +94,11 @@ class ReqConsumer(Entrypoint):
         @param response_model: 响应的验证模型
         @param include_in_doc: 是否暴露在文档
         @param rule_options: 路由其它配置选项
+        @param frozen: 是否冻结首个成功的GET/HEAD响应并在之后直接回放,不区分查询字符串,不能用于带参数的路由
+        @param middlewares: 显式启用的中间件(类名或加载路径)
+        @param rate_limit: 路由独立的限流预算,如100/m,配合RateLimitMiddleware使用
+        @param max_body_size: 路由独立的请求体最大字节数,未设置时使用全局配置
+        @param max_part_size: 路由独立的multipart单个部分最大字节数,未设置时使用全局配置
         @param kwargs: 其它的相关配置选项
         """
         # 用于兼容不同的追踪协议头部
@@ -99,6 +121,18 @@ class ReqConsumer(Entrypoint):
         self._setup_other_response_fields()
         self.include_in_doc = include_in_doc
         self.response_description = response_description
+        # 冻结的响应 - 适用于健康检查/版本号等返回固定内容的接口
+        if frozen and re.search(r'<[^>]+>', raw_url):
+            raise ValueError(f'frozen route {raw_url} must not have arguments')
+        self.frozen = frozen
+        self.frozen_response = None
+        # 显式启用的中间件 - 配合中间件的route_opt_in选项使用
+        self.middlewares = middlewares or []
+        # 路由独立的限流预算 - 配合RateLimitMiddleware使用
+        self.rate_limit = rate_limit
+        # 路由独立的请求体限制 - 在读取请求体之前检查
+        self.max_body_size = max_body_size
+        self.max_part_size = max_part_size
         kwargs.setdefault('exec_timing', 15)
         super(ReqConsumer, self).__init__(**kwargs)
 
@@ -255,6 +289,35 @@ class ReqConsumer(Entrypoint):
             context = eventlet.getcurrent().context
         event.send((context, results, excinfo))
 
+    def get_frozen_response(self, request: t.Any) -> t.Optional[StaticResponse]:
+        """ 获取可回放的冻结响应
+
+        @param request: 请求对象
+        @return: t.Optional[StaticResponse]
+        """
+        return self.frozen_response if request.method in FROZEN_METHODS else None
+
+    def freeze_response(self, request: t.Any, response: Response) -> Response:
+        """ 冻结成功的响应
+
+        注意: 冻结后不再调度工作协程,响应中的call_id等字段也将固定为首次请求的值
+
+        @param request: 请求对象
+        @param response: 响应对象
+        @return: Response
+        """
+        if not self.frozen or response.is_streamed or request.method not in FROZEN_METHODS:
+            return response
+        if not HTTPStatus.OK <= response.status_code < HTTPStatus.MULTIPLE_CHOICES:
+            return response
+        # 携带Cookie的响应属于首个请求方,回放给其它客户端会泄露会话
+        if 'Set-Cookie' in response.headers:
+            logger.warning(f'frozen route {self.raw_url} responded with Set-Cookie, freezing disabled')
+            self.frozen = False
+            return response
+        self.frozen_response = StaticResponse.from_response(response)
+        return self.frozen_response
+
     def handle_request(self, request) -> t.Tuple:
         """ 处理工作请求
 
@@ -262,14 +325,27 @@ class ReqConsumer(Entrypoint):
         @return: t.Tuple
         """
         event = Event()
+        start_time = time.perf_counter()
         tid = f'{self}.self_handle_request'
+        timing = request.environ.get(TIMING_ENVIRON_KEY)
         request_header = dict(request.headers)
         worker_context = from_headers_to_context(request_header, self.map_headers)
+        timing is None or timing.mark(PHASE_CONTEXT)
         args, kwargs = (request,), request.path_group_dict
         gt = self.container.spawn_worker_thread(self, args, kwargs, worker_context, tid=tid)
+        timing is None or timing.mark(PHASE_SPAWN)
+        # 工作协程同样归属于此请求,便于采样分析器等按路由统计
+        inflight = request.environ.get(INFLIGHT_ENVIRON_KEY)
+        inflight is None or inflight.attach(gt)
+        # 回调在工作协程结束时按注册顺序执行,计时回调需先于结果回调
+        timing is None or gt.link(timing.on_link)
         gt.link(self._link_results, event)
         # 注意: 此协程异常会导致收不到event最终内存溢出!
         context, results, excinfo = event.wait()
+        timing is None or timing.mark(PHASE_WAIT)
+        metrics = self.producer.metrics
+        # 有使用者时才统计视图函数的执行时间
+        metrics.enabled and metrics.observe_handler(self, time.perf_counter() - start_time, excinfo is not None)
         return context, results, excinfo
 
     def handle_result(self, context: WorkerContext, results: t.Any) -> t.Any:
@@ -311,12 +387,18 @@ class WebReqConsumer(ReqConsumer):
         @param request: 请求对象
         @return: t.Tuple
         """
+        frozen_response = self.get_frozen_response(request)
+        if frozen_response is not None:
+            return frozen_response
         context, results, excinfo = super(WebReqConsumer, self).handle_request(request)
-        return (
-            self.handle_result(context, results)
+        response = (
+            self.freeze_response(request, self.handle_result(context, results))
             if excinfo is None else
             self.handle_errors(context, excinfo)
         )
+        timing = request.environ.get(TIMING_ENVIRON_KEY)
+        timing is None or timing.mark(PHASE_SERIALIZE)
+        return response
 
     def handle_result(self, context: WorkerContext, results: t.Any) -> t.Any:
         """ 处理正常结果
@@ -372,12 +454,18 @@ class ApiReqConsumer(ReqConsumer):
         @param request: 请求对象
         @return: t.Tuple
         """
+        frozen_response = self.get_frozen_response(request)
+        if frozen_response is not None:
+            return frozen_response
         context, results, excinfo = super(ApiReqConsumer, self).handle_request(request)
-        return (
-            self.handle_result(context, results)
+        response = (
+            self.freeze_response(request, self.handle_result(context, results))
             if excinfo is None else
             self.handle_errors(context, excinfo)
         )
+        timing = request.environ.get(TIMING_ENVIRON_KEY)
+        timing is None or timing.mark(PHASE_SERIALIZE)
+        return response
 
     def handle_result(self, context: WorkerContext, results: t.Any) -> t.Any:
         """ 处理正常结果
@@ -393,6 +481,10 @@ class ApiReqConsumer(ReqConsumer):
             data, errs = payload, None
         else:
             data, errs = None, payload
+        # 迭代器或生成器类型的结果集以流式编码响应避免整体序列化带来的内存峰值
+        if isinstance(data, collections.abc.Iterator):
+            envelope = {'code': status, 'errs': errs, 'call_id': call_id}
+            return StreamingJsonResponse(data, status=status, headers=headers, envelope=envelope)
         payload = {'code': status, 'errs': errs, 'data': data, 'call_id': call_id}
         response_class = self.response_class or JsonResponse
         return response_class(payload, status=status)
@@ -0,0 +1,89 @@
+#! -*- coding: utf-8 -*-
+#
+# author: forcemain@163.com
+
+from __future__ import annotations
+
+import typing as t
+
+if t.TYPE_CHECKING:
+    # 由于其定义在存根文件所以需要在TYPE_CHECKING下
+    from werkzeug.wsgi import WSGIApplication
+    from werkzeug.wsgi import WSGIEnvironment
+    from werkzeug.wrappers.response import StartResponse
+    from service_webserver.core.middlewares.base import BaseMiddleware
+
+# 当前请求所在管道的下一跳映射表
+PIPELINE_ENVIRON_KEY = 'service_webserver.pipeline'
+# 当前请求匹配到的(entrypoint, path_group_dict)
+ROUTE_ENVIRON_KEY = 'service_webserver.route'
+
+
+class PipelineStep(object):
+    """ 中间件的下一跳
+
+    每个中间件实例只创建一次,其wsgi_app为此对象,真正的下一跳由所在管道的映射表决定
+    """
+
+    __slots__ = ()
+
+    def __call__(self, environ: WSGIEnvironment, start_response: StartResponse) -> t.Iterable[bytes]:
+        """ 请求处理器
+
+        @param environ: 环境对象
+        @param start_response: 响应对象
+        @return: t.Iterable[bytes]
+        """
+        return environ[PIPELINE_ENVIRON_KEY][self](environ, start_response)
+
+
+class Pipeline(object):
+    """ 编译后的中间件管道 """
+
+    __slots__ = ('entry', 'table', 'middlewares')
+
+    def __init__(
+            self,
+            entry: WSGIApplication,
+            table: t.Dict[PipelineStep, WSGIApplication],
+            middlewares: t.List[BaseMiddleware]
+    ) -> None:
+        """ 初始化实例
+
+        @param entry: 管道入口
+        @param table: 下一跳映射表
+        @param middlewares: 管道中的中间件(由内到外)
+        """
+        self.entry = entry
+        self.table = table
+        self.middlewares = middlewares
+
+    def __call__(self, environ: WSGIEnvironment, start_response: StartResponse) -> t.Iterable[bytes]:
+        """ 请求处理器
+
+        @param environ: 环境对象
+        @param start_response: 响应对象
+        @return: t.Iterable[bytes]
+        """
+        environ[PIPELINE_ENVIRON_KEY] = self.table
+        return self.entry(environ, start_response)
+
+
+def compile_pipeline(
+        wsgi_app: WSGIApplication,
+        middlewares: t.Sequence[t.Tuple[BaseMiddleware, PipelineStep]]
+) -> WSGIApplication:
+    """ 编译中间件管道
+
+    @param wsgi_app: 最内层应用程序
+    @param middlewares: 中间件及其下一跳(由内到外)
+    @return: WSGIApplication
+    """
+    # 没有任何中间件时直接调用应用程序
+    if not middlewares:
+        return wsgi_app
+    entry, table = wsgi_app, {}
+    for middleware, step in middlewares:
+        table[step] = entry
+        entry = middleware
+    return Pipeline(entry, table, [middleware for middleware, _ in middlewares])
@@ -21,7 +21,14 @@ from service_webserver.constants import WEBSERVER_CONFIG_KEY
 from service_core.core.service.extension import ShareExtension
 from service_core.core.service.extension import StoreExtension
 from service_core.core.as_finder import load_dot_path_colon_obj
+from service_webserver.core.health import HealthCheck
+from service_webserver.core.health import HealthState
+from service_webserver.core.hub_lag import HubLagMonitor
+from service_webserver.core.timing import TimingRegistry
+from service_webserver.core.metrics import MetricsRegistry
+from service_webserver.core.inflight import InflightRegistry
 from service_webserver.core.middlewares.base import BaseMiddleware
+from service_webserver.core.middlewares.base import MIDDLEWARE_ROUTE_OPTIONS
 from service_webserver.constants import DEFAULT_WEBSERVER_MAX_CONNECTIONS
 from service_webserver.core.middlewares.exception import ExceptionMiddleware
 
@@ -30,6 +37,8 @@ if t.TYPE_CHECKING:
     from werkzeug.wsgi import WSGIApplication
 
 from .wsgi_app import WsgiApp
+from .protocol import HttpProtocol
+from .pipeline import PipelineStep
 
 logger = getLogger(__name__)
 
@@ -60,7 +69,28 @@ class ReqProducer(Entrypoint, ShareExtension, StoreExtension):
         self.map_options = {}
         # 相关配置 - 最大连接
         self.max_connect = None
+        # 相关配置 - 请求体限制
+        self.max_body_size = None
+        self.max_part_size = None
+        # 相关配置 - 探针配置
+        self.health_options = {}
+        # 相关配置 - 停止前保持未就绪的秒数
+        self.drain_grace = None
+        # 相关配置 - 事件循环延迟监控及负载保护
+        self.hub_lag_options = {}
         self.middlewares = {}
+        # 已载入的中间件及其下一跳(由内到外)
+        self.loaded_middlewares = []
+        # 在途请求登记表 - 供采样分析器等中间件使用
+        self.inflight = InflightRegistry()
+        # 指标登记表 - 供指标中间件使用
+        self.metrics = MetricsRegistry()
+        # 分阶段计时登记表 - 供ServerTimingMiddleware使用
+        self.timing = TimingRegistry(self.metrics)
+        # 就绪状态 - 供就绪探针及负载保护使用
+        self.health = HealthState()
+        # 事件循环延迟监控 - 在setup阶段按配置创建
+        self.hub_lag = None
         Entrypoint.__init__(self, *args, **kwargs)
         ShareExtension.__init__(self, *args, **kwargs)
         StoreExtension.__init__(self, *args, **kwargs)
@@ -79,12 +109,25 @@ class ReqProducer(Entrypoint, ShareExtension, StoreExtension):
         max_connect = self.container.config.get(f'{WEBSERVER_CONFIG_KEY}.max_connect', default=None)
         max_connect = max_connect or DEFAULT_WEBSERVER_MAX_CONNECTIONS
         self.max_connect = self.max_connect or max_connect
+        max_body_size = self.container.config.get(f'{WEBSERVER_CONFIG_KEY}.max_body_size', default=None)
+        self.max_body_size = self.max_body_size or max_body_size
+        max_part_size = self.container.config.get(f'{WEBSERVER_CONFIG_KEY}.max_part_size', default=None)
+        self.max_part_size = self.max_part_size or max_part_size
+        health_options = self.container.config.get(f'{WEBSERVER_CONFIG_KEY}.health_options', default={})
+        self.health_options = health_options or {}
+        drain_grace = self.container.config.get(f'{WEBSERVER_CONFIG_KEY}.drain_grace', default=None)
+        self.drain_grace = self.drain_grace or drain_grace
+        hub_lag_options = self.container.config.get(f'{WEBSERVER_CONFIG_KEY}.hub_lag_options', default={})
+        self.hub_lag_options = hub_lag_options or {}
+        self.hub_lag = HubLagMonitor(self.metrics, self.health, **self.hub_lag_options)
         ssl_options = self.container.config.get(f'{WEBSERVER_CONFIG_KEY}.ssl_options', default={})
         self.ssl_options = ssl_options or {}
         srv_options = self.container.config.get(f'{WEBSERVER_CONFIG_KEY}.srv_options', default={})
         self.srv_options = srv_options or {}
         self.srv_options.setdefault('log', logger)
         self.srv_options.setdefault('log_output', True)
+        # 支持wsgi.file_wrapper以便文件响应可以零拷贝发送
+        self.srv_options.setdefault('protocol', HttpProtocol)
 
     def start(self) -> None:
         """ 生命周期 - 启动阶段
@@ -99,12 +142,25 @@ class ReqProducer(Entrypoint, ShareExtension, StoreExtension):
         self.wsgi_socket.settimeout(None)
         self.wsgi_server = self.create_wsgi_server()
         self.gt = self.container.spawn_splits_thread(fun, args=args, kwargs=kwargs, tid=tid)
+        # 中间件的后台任务在开始监听之后再启动
+        for middleware, _ in self.loaded_middlewares:
+            middleware.start()
+        # 配置了监控选项或启用了指标时才采样事件循环延迟
+        (self.hub_lag_options or self.metrics.enabled) and self.hub_lag.start(self.container)
+        # 管道已编译且中间件已启动
+        self.health.release('startup')
 
     def stop(self) -> None:
         """ 生命周期 - 停止阶段
 
         @return: None
         """
+        self.health.draining = True
+        # 继续处理请求一段时间,以便负载均衡根据就绪探针摘除此实例
+        self.drain_grace and eventlet.sleep(self.drain_grace)
+        for middleware, _ in self.loaded_middlewares:
+            middleware.stop()
+        self.hub_lag and self.hub_lag.stop()
         self.kill()
 
     def kill(self) -> None:
@@ -167,15 +223,15 @@ class ReqProducer(Entrypoint, ShareExtension, StoreExtension):
             middlewares = self.get_dict_middleware()
         return middlewares
 
-    def set_all_middlewares(self, wsgi_app: WSGIApplication) -> WSGIApplication:
+    def load_all_middlewares(self) -> t.List[t.Tuple[BaseMiddleware, PipelineStep]]:
         """ 载入配置文件中间件
 
-        @param wsgi_app: 应用程序
-        @return: WSGIApplication
+        @return: t.List[t.Tuple[BaseMiddleware, PipelineStep]]
         """
+        loaded_middlewares = []
         middlewares = self.get_all_middlewares()
         for dotted_path, (error, middleware) in middlewares:
-            config = middlewares[(dotted_path, (error, middleware))]
+            config = dict(middlewares[(dotted_path, (error, middleware))])
             error_prefix_message = f'load {dotted_path} failed,'
             if error is not None or middleware is None:
                 logger.error(error_prefix_message + error)
@@ -189,21 +245,39 @@ class ReqProducer(Entrypoint, ShareExtension, StoreExtension):
                 logger.error(error_prefix_message + error)
                 continue
             logger.debug(f'load middleware {dotted_path} succ')
-            wsgi_app = middleware(
-                wsgi_app=wsgi_app, producer=self, **config
-            )
-        return wsgi_app
+            # 路由选择选项由中间件基类处理,不传递给中间件构造函数
+            route_options = {k: config.pop(k) for k in MIDDLEWARE_ROUTE_OPTIONS if k in config}
+            # 每个中间件只实例化一次,其下一跳由所在管道决定
+            step = PipelineStep()
+            instance = middleware(wsgi_app=step, producer=self, **config)
+            instance.dotted_path = dotted_path
+            instance.set_route_options(**route_options)
+            loaded_middlewares.append((instance, step))
+        return loaded_middlewares
+
+    def set_all_middlewares(self, wsgi_app: WsgiApp) -> WSGIApplication:
+        """ 按路由编译中间件管道
+
+        @param wsgi_app: 应用程序
+        @return: WSGIApplication
+        """
+        self.loaded_middlewares = self.load_all_middlewares()
+        wsgi_app.compile(self.loaded_middlewares)
+        # 请求先匹配路由,然后只经过作用于该路由的中间件
+        return wsgi_app.entry
 
     def create_wsgi_app(self) -> WSGIApplication:
         """ 创建wsgi请求处理器
 
         @return: t.Callable
         """
-        wsgi_app = WsgiApp(self).wsgi_app
-        # 加载配置文件中定义的中间件修饰返回新app
+        wsgi_app = WsgiApp(self)
+        # 加载配置文件中定义的中间件并按路由编译管道
         wsgi_app = self.set_all_middlewares(wsgi_app)
         # 最外层加上异常处理防止其它中间件信息泄漏
-        return ExceptionMiddleware(wsgi_app=wsgi_app, producer=self)
+        wsgi_app = ExceptionMiddleware(wsgi_app=wsgi_app, producer=self)
+        # 探针位于所有中间件之前
+        return HealthCheck(wsgi_app, self.health, **self.health_options)
 
     def create_wsgi_server(self) -> wsgi.Server:
         """ 创建wsgi应用服务器
@@ -0,0 +1,86 @@
+#! -*- coding: utf-8 -*-
+#
+# author: forcemain@163.com
+
+from __future__ import annotations
+
+import time
+import functools
+import typing as t
+
+from eventlet import wsgi
+from service_webserver.core.file_wrapper import SendfileWrapper
+from service_webserver.core.timing import ACCEPT_TIME_ENVIRON_KEY
+from service_webserver.core.body_limit import CLOSE_CONNECTION_ENVIRON_KEY
+
+if t.TYPE_CHECKING:
+    # 由于其定义在存根文件所以需要在TYPE_CHECKING下
+    from werkzeug.wrappers.response import StartResponse
+    from werkzeug.wrappers.request import WSGIEnvironment
+
+
+class HttpProtocol(wsgi.HttpProtocol):
+    """ 支持文件包装器及主动关闭连接的协议类 """
+
+    @property
+    def application(self) -> t.Callable[..., t.Iterable[bytes]]:
+        """ 应用程序 """
+        return self.call_application
+
+    @application.setter
+    def application(self, application: t.Callable[..., t.Iterable[bytes]]) -> None:
+        self.raw_application = application
+
+    def call_application(self, environ: WSGIEnvironment, start_response: StartResponse) -> t.Iterable[bytes]:
+        """ 调用应用程序
+
+        @param environ: 环境对象
+        @param start_response: 响应对象
+        @return: t.Iterable[bytes]
+        """
+        # 响应头部 - 判断直接写套接字时是否有Content-Length
+        headers_set = []
+
+        def capture_start_response(status: t.Text, headers: t.List, exc_info: t.Optional[t.Tuple] = None):
+            """ 记录响应头部
+
+            @param status  : 响应状态
+            @param headers : 头部信息
+            @param exc_info: 异常信息
+            """
+            headers_set[:] = headers
+            return start_response(status, headers, exc_info)
+
+        result = self.raw_application(environ, capture_start_response)
+        # 只有未被中间件包装的文件包装器才能安全的绕开迭代直接写套接字
+        isinstance(result, SendfileWrapper) and result.enable_direct(environ, headers_set)
+        return result
+
+    def setup(self) -> None:
+        """ 连接建立后的初始化
+
+        @return: None
+        """
+        # 连接建立时间,只计入此连接上的首个请求
+        self.accept_time = time.perf_counter()
+        super(HttpProtocol, self).setup()
+
+    def set_close_connection(self) -> None:
+        """ 响应后关闭连接
+
+        注意: 未读完的请求体将被丢弃而不是读完后复用连接
+
+        @return: None
+        """
+        self.close_connection = 1
+
+    def get_environ(self) -> WSGIEnvironment:
+        """ 生成环境对象
+
+        @return: WSGIEnvironment
+        """
+        environ = super(HttpProtocol, self).get_environ()
+        environ['wsgi.file_wrapper'] = functools.partial(SendfileWrapper, connection=self.connection)
+        environ[CLOSE_CONNECTION_ENVIRON_KEY] = self.set_close_connection
+        environ[ACCEPT_TIME_ENVIRON_KEY], self.accept_time = self.accept_time, None
+        return environ
@@ -4,19 +4,30 @@
 
 from __future__ import annotations
 
+import functools
 import typing as t
 import werkzeug.exceptions
 
 from logging import getLogger
 from service_webserver.core.request import Request
+from service_webserver.core.timing import PHASE_ROUTE
+from service_webserver.core.timing import PHASE_MIDDLEWARE
+from service_webserver.core.timing import TIMING_ENVIRON_KEY
+from service_webserver.core.body_limit import limit_request_body
+from service_webserver.core.body_limit import reject_request_body
 
 if t.TYPE_CHECKING:
     # ReqProducer引用了App,需防止循环引用
     from .producer import ReqProducer
+    from .pipeline import PipelineStep
+    from service_webserver.core.middlewares.base import BaseMiddleware
     # 由于其定义在存根文件所以需要在TYPE_CHECKING下
     from werkzeug.wrappers.response import StartResponse
     from werkzeug.wrappers.request import WSGIEnvironment
 
+from .pipeline import ROUTE_ENVIRON_KEY
+from .pipeline import compile_pipeline
+
 logger = getLogger(__name__)
 
 
@@ -30,6 +41,124 @@ class WsgiApp(object):
         """
         self.producer = producer
         self.urls_map = producer.create_urls_map()
+        # 每个路由编译后的中间件管道
+        self.pipelines = {}
+        # 未匹配到路由时的中间件管道
+        self.fallback = self.wsgi_app
+        # 由中间件自身处理的完整路径及路径前缀,在路由匹配之前认领
+        self.claimed_paths = frozenset()
+        self.claimed_prefixes = ()
+        # 请求入口,在路由匹配之前执行的中间件位于所有管道之外
+        self.entry = self.dispatch
+        # 每个路由的请求体限制 - {路由: (最大字节数, multipart单个部分的最大字节数)}
+        self.body_limits = {}
+        self.default_body_limit = (producer.max_body_size, producer.max_part_size)
+
+    def compile(self, middlewares: t.Sequence[t.Tuple[BaseMiddleware, PipelineStep]]) -> None:
+        """ 为每个路由编译中间件管道
+
+        @param middlewares: 中间件及其下一跳(由内到外)
+        @return: None
+        """
+        prelude = tuple(m for m in middlewares if m[0].before_routing)
+        middlewares = tuple(m for m in middlewares if not m[0].before_routing)
+        pipelines = {}
+        for entrypoint in self.producer.all_extensions:
+            selected = tuple(m for m in middlewares if m[0].applies_to(entrypoint))
+            # 中间件组合相同的路由共享同一管道
+            selected in pipelines or pipelines.update({selected: compile_pipeline(self.route_app, selected)})
+            self.pipelines[entrypoint] = pipelines[selected]
+            max_body_size = getattr(entrypoint, 'max_body_size', None) or self.producer.max_body_size
+            max_part_size = getattr(entrypoint, 'max_part_size', None) or self.producer.max_part_size
+            self.body_limits[entrypoint] = (max_body_size, max_part_size)
+        selected = tuple(m for m in middlewares if m[0].apply_to_fallback)
+        self.fallback = compile_pipeline(self.wsgi_app, selected)
+        claimed_paths, claimed_prefixes = set(), []
+        for middleware, _ in selected:
+            if not middleware.claim_paths:
+                continue
+            paths, prefixes = middleware.get_claimed_paths()
+            claimed_paths.update(paths)
+            claimed_prefixes.extend(prefixes)
+        self.claimed_paths, self.claimed_prefixes = frozenset(claimed_paths), tuple(claimed_prefixes)
+        # 改写主机/路径前缀等的中间件需在路由匹配之前执行
+        self.entry = compile_pipeline(self.dispatch, prelude)
+
+    def dispatch(self, environ: WSGIEnvironment, start_response: StartResponse) -> t.Iterable[bytes]:
+        """ 先匹配路由再进入对应的中间件管道,中间件认领的路径直接进入兜底管道
+
+        @param environ: 环境对象
+        @param start_response: 响应对象
+        @return: t.Iterable[bytes]
+        """
+        timing = self.producer.timing
+        # 有使用者时才分阶段计时
+        request_timing = timing.begin(environ) if timing.enabled else None
+        path = environ.get('PATH_INFO') or '/'
+        # 挂载/代理/管理接口等中间件认领的路径优先于同样能匹配到的路由
+        if path in self.claimed_paths or path.startswith(self.claimed_prefixes):
+            entrypoint, pipeline = None, self.fallback
+        else:
+            adapter = self.urls_map.bind_to_environ(environ)
+            try:
+                entrypoint, path_group_dict = adapter.match()
+            except werkzeug.exceptions.HTTPException:
+                # 未匹配到路由时经过完整的兜底管道,由wsgi_app生成404/405等响应
+                entrypoint, pipeline = None, self.fallback
+            else:
+                environ[ROUTE_ENVIRON_KEY] = (entrypoint, path_group_dict)
+                pipeline = self.pipelines[entrypoint]
+        if request_timing is not None:
+            request_timing.route = entrypoint
+            request_timing.mark(PHASE_ROUTE)
+            pipeline = functools.partial(timing.track, pipeline, request_timing)
+        max_body_size, max_part_size = self.body_limits.get(entrypoint, self.default_body_limit)
+        # 在任何中间件读取之前按Content-Length拒绝过大的请求体
+        hub_lag = self.producer.hub_lag
+        if not limit_request_body(environ, max_body_size, max_part_size):
+            # 拒绝时需关闭连接,避免为保持连接而读完过大的请求体,因此优先于负载保护
+            pipeline = self.reject_app
+        # 事件循环延迟过高时按策略拒绝或推迟匹配到路由的新请求,由中间件提供的指标/诊断等端点不受影响
+        elif entrypoint is not None and hub_lag is not None and hub_lag.shedding and not hub_lag.admit():
+            pipeline = hub_lag.shed_app
+        inflight, metrics = self.producer.inflight, self.producer.metrics
+        # 有使用者时才登记在途请求
+        if inflight.enabled:
+            pipeline = functools.partial(inflight.track, pipeline, entrypoint)
+        # 有使用者时才统计指标
+        if metrics.enabled:
+            return metrics.track(pipeline, entrypoint, environ, start_response)
+        return pipeline(environ, start_response)
+
+    @staticmethod
+    def reject_app(environ: WSGIEnvironment, start_response: StartResponse) -> t.Iterable[bytes]:
+        """ 请求体过大时的请求处理器
+
+        @param environ: 环境对象
+        @param start_response: 响应对象
+        @return: t.Iterable[bytes]
+        """
+        return reject_request_body(environ)(environ, start_response)
+
+    def route_app(self, environ: WSGIEnvironment, start_response: StartResponse) -> t.Iterable[bytes]:
+        """ 已匹配路由的请求处理器
+
+        @param environ: 环境对象
+        @param start_response: 响应对象
+        @return: t.Iterable[bytes]
+        """
+        entrypoint, path_group_dict = environ[ROUTE_ENVIRON_KEY]
+        request_timing = environ.get(TIMING_ENVIRON_KEY)
+        request_timing is None or request_timing.mark(PHASE_MIDDLEWARE)
+        request = Request(environ)
+        # 注意: 不能在此读取请求体,否则会在视图函数之前将其整体载入内存
+        logger.debug(f'request {request.method} {request.url} with content_length={request.content_length}')
+        request.path_group_dict = path_group_dict
+        try:
+            response = entrypoint.handle_request(request)
+            return response(environ, start_response)
+        except werkzeug.exceptions.HTTPException as response:
+            return response(environ, start_response)
 
     def wsgi_app(self, environ: WSGIEnvironment, start_response: StartResponse) -> t.Iterable[bytes]:
         """ 请求处理器
@@ -39,8 +168,8 @@ class WsgiApp(object):
         @return: t.Iterable[bytes]
         """
         request = Request(environ)
-        url, data, form = request.url, request.data, request.form.to_dict()
-        logger.debug(f'request {url} with data={data} form={form}')
+        # 注意: 不能在此读取请求体,否则会在视图函数之前将其整体载入内存
+        logger.debug(f'request {request.method} {request.url} with content_length={request.content_length}')
         adapter = self.urls_map.bind_to_environ(environ)
         try:
             # 通过路由匹配到Rule再到对应的entrypoint入口
@@ -0,0 +1,178 @@
+#! -*- coding: utf-8 -*-
+#
+# author: forcemain@163.com
+
+from __future__ import annotations
+
+import os
+import ssl
+import stat
+import eventlet
+import typing as t
+
+from eventlet.green import socket
+from eventlet.green.ssl import GreenSSLSocket
+from eventlet.hubs import trampoline
+
+if t.TYPE_CHECKING:
+    # 由于其定义在存根文件所以需要在TYPE_CHECKING下
+    from werkzeug.wrappers.request import WSGIEnvironment
+
+
+class SendfileWrapper(object):
+    """ 支持零拷贝的文件包装器
+
+    doc: https://peps.python.org/pep-3333/#optional-platform-specific-file-handling
+
+    只有原样抵达服务器时才会绕开迭代直接写套接字,否则与FileWrapper行为一致
+    """
+
+    # 经由eventlet写出的首块大小,用于先把响应头部刷出
+    first_block_size = 16384
+    # 单次sendfile最多发送的字节数,发送完后让出协程
+    sendfile_block_size = 1 << 20
+
+    def __init__(
+            self,
+            file: t.BinaryIO,
+            buffer_size: int = 8192,
+            *,
+            connection: t.Optional[socket.socket] = None,
+            length: t.Optional[int] = None
+    ) -> None:
+        """ 初始化实例
+
+        @param file: 文件对象
+        @param buffer_size: 每次读取的字节数
+        @param connection: 客户端套接字
+        @param length: 从当前位置起最多发送的字节数,None表示到文件末尾
+        """
+        self.file = file
+        self.length = length
+        self.connection = connection
+        self.buffer_size = buffer_size
+        # 由HttpProtocol在确认响应未被中间件包装后开启
+        self.direct = False
+
+    def enable_direct(self, environ: WSGIEnvironment, headers: t.List[t.Tuple[t.Text, t.Text]]) -> None:
+        """ 开启直接写套接字
+
+        注意: 没有Content-Length时eventlet使用分块编码,直接写入的数据会绕开分块格式,只能常规迭代
+
+        @param environ: 环境对象
+        @param headers: 传入start_response的头部列表
+        @return: None
+        """
+        if self.connection is None:
+            return
+        if not any(name.lower() == 'content-length' for name, _ in headers):
+            return
+        self.direct = True
+        # 首块必须立即写出,保证头部先于直接写入的数据到达客户端
+        environ['eventlet.minimum_write_chunk_size'] = 0
+
+    def get_fileno(self) -> t.Optional[int]:
+        """ 获取普通文件的描述符
+
+        @return: t.Optional[int]
+        """
+        try:
+            fileno = self.file.fileno()
+        except (AttributeError, OSError, ValueError):
+            return None
+        return fileno if stat.S_ISREG(os.fstat(fileno).st_mode) else None
+
+    def get_remaining(self, fileno: int) -> t.Tuple[int, int]:
+        """ 获取当前偏移和剩余长度
+
+        @param fileno: 文件描述符
+        @return: t.Tuple[int, int]
+        """
+        offset = self.file.tell()
+        remaining = os.fstat(fileno).st_size - offset
+        return offset, remaining if self.length is None else min(remaining, self.length)
+
+    def __iter__(self) -> t.Iterator[bytes]:
+        fileno = self.get_fileno() if self.direct else None
+        if fileno is None:
+            return self.iter_read()
+        # 由套接字判断是否为TLS,wsgi.url_scheme可能被ProxyFix按客户端头部改写
+        is_secure = isinstance(self.connection, (ssl.SSLSocket, GreenSSLSocket))
+        if is_secure or not hasattr(os, 'sendfile'):
+            return self.iter_readinto(fileno)
+        return self.iter_sendfile(fileno)
+
+    def iter_read(self) -> t.Iterator[bytes]:
+        """ 常规分块读取
+
+        @return: t.Iterator[bytes]
+        """
+        remaining = self.length
+        while remaining is None or remaining > 0:
+            size = self.buffer_size if remaining is None else min(self.buffer_size, remaining)
+            data = self.file.read(size)
+            if not data:
+                break
+            remaining = remaining if remaining is None else remaining - len(data)
+            yield data
+
+    def iter_first_block(self, fileno: int) -> t.Iterator[bytes]:
+        """ 经由eventlet写出头部和首块
+
+        @param fileno: 文件描述符
+        @return: t.Iterator[bytes]
+        """
+        offset, remaining = self.get_remaining(fileno)
+        data = self.file.read(min(remaining, self.first_block_size)) if remaining > 0 else b''
+        self.length = self.length if self.length is None else self.length - len(data)
+        # 空文件时无需直接写入,交由eventlet正常结束响应
+        data and (yield data)
+
+    def iter_sendfile(self, fileno: int) -> t.Iterator[bytes]:
+        """ 非TLS时使用os.sendfile零拷贝发送
+
+        @param fileno: 文件描述符
+        @return: t.Iterator[bytes]
+        """
+        yield from self.iter_first_block(fileno)
+        offset, remaining = self.get_remaining(fileno)
+        sock_fileno = self.connection.fileno()
+        timeout = self.connection.gettimeout()
+        while remaining > 0:
+            try:
+                sent = os.sendfile(sock_fileno, fileno, offset, min(remaining, self.sendfile_block_size))
+            except BlockingIOError:
+                # 套接字缓冲区已满时挂起当前协程直到可写
+                trampoline(sock_fileno, write=True, timeout=timeout, timeout_exc=socket.timeout)
+                continue
+            if not sent:
+                break
+            offset += sent
+            remaining -= sent
+            eventlet.sleep()
+        self.file.seek(offset)
+
+    def iter_readinto(self, fileno: int) -> t.Iterator[bytes]:
+        """ TLS时复用大缓冲区读取后直接发送
+
+        @param fileno: 文件描述符
+        @return: t.Iterator[bytes]
+        """
+        yield from self.iter_first_block(fileno)
+        offset, remaining = self.get_remaining(fileno)
+        buffer = bytearray(self.buffer_size)
+        view = memoryview(buffer)
+        while remaining > 0:
+            size = self.file.readinto(view[:min(remaining, self.buffer_size)])
+            if not size:
+                break
+            remaining -= size
+            self.connection.sendall(view[:size])
+
+    def close(self) -> None:
+        """ 关闭文件
+
+        @return: None
+        """
+        close = getattr(self.file, 'close', None)
+        close and close()
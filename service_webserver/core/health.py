@@ -0,0 +1,125 @@
+#! -*- coding: utf-8 -*-
+#
+# author: forcemain@163.com
+
+from __future__ import annotations
+
+import typing as t
+
+from service_webserver.core.response import StaticResponse
+
+if t.TYPE_CHECKING:
+    # 由于其定义在存根文件所以需要在TYPE_CHECKING下
+    from werkzeug.wsgi import WSGIApplication
+    from werkzeug.wsgi import WSGIEnvironment
+    from werkzeug.wrappers.response import StartResponse
+
+# 默认的存活/就绪探针地址
+DEFAULT_LIVENESS_URL = '/healthz'
+DEFAULT_READINESS_URL = '/readyz'
+# 未就绪的原因,按优先级排列
+NOT_READY_REASONS = ('starting', 'draining', 'shedding')
+
+
+def create_probe_response(status: int, reason: t.Optional[t.Text] = None) -> StaticResponse:
+    """ 生成探针的不可变响应
+
+    @param status: 响应状态
+    @param reason: 未就绪的原因
+    @return: StaticResponse
+    """
+    body = '{"status":"ok"}' if reason is None else f'{{"status":"unavailable","reason":"{reason}"}}'
+    headers = {'Content-Type': 'application/json', 'Cache-Control': 'no-store'}
+    return StaticResponse(body, status=status, headers=headers)
+
+
+class HealthState(object):
+    """ 服务就绪状态
+
+    启动阶段(编译管道/启动中间件)完成前、停止阶段开始后以及负载保护生效时均为未就绪,
+    中间件也可以在自己的预计算完成前保持未就绪
+    """
+
+    def __init__(self) -> None:
+        """ 初始化实例 """
+        # 尚未完成的启动任务
+        self.pending: t.Set[t.Text] = {'startup'}
+        self.draining = False
+        self.shedding = False
+
+    def hold(self, name: t.Text) -> None:
+        """ 登记一个尚未完成的启动任务
+
+        @param name: 任务名称
+        @return: None
+        """
+        self.pending.add(name)
+
+    def release(self, name: t.Text) -> None:
+        """ 完成一个启动任务
+
+        @param name: 任务名称
+        @return: None
+        """
+        self.pending.discard(name)
+
+    @property
+    def reason(self) -> t.Optional[t.Text]:
+        """ 未就绪的原因,就绪时为None """
+        if self.pending:
+            return 'starting'
+        if self.draining:
+            return 'draining'
+        if self.shedding:
+            return 'shedding'
+        return None
+
+    @property
+    def ready(self) -> bool:
+        """ 是否就绪 """
+        return self.reason is None
+
+
+class HealthCheck(object):
+    """ 存活/就绪探针
+
+    位于所有中间件之前,在接收请求的协程中直接回放预计算的响应,不匹配路由/不创建工作协程,
+    也不计入指标和在途请求,因此工作协程繁忙时探针仍能及时响应
+    """
+
+    def __init__(
+            self,
+            wsgi_app: WSGIApplication,
+            state: HealthState,
+            liveness_url: t.Optional[t.Text] = DEFAULT_LIVENESS_URL,
+            readiness_url: t.Optional[t.Text] = DEFAULT_READINESS_URL
+    ) -> None:
+        """ 初始化实例
+
+        @param wsgi_app: 应用程序
+        @param state: 就绪状态
+        @param liveness_url: 存活探针地址,None表示关闭
+        @param readiness_url: 就绪探针地址,None表示关闭
+        """
+        self.wsgi_app = wsgi_app
+        self.state = state
+        self.liveness_url = liveness_url
+        self.readiness_url = readiness_url
+        self.ok_response = create_probe_response(200)
+        self.not_ready_responses = {r: create_probe_response(503, r) for r in NOT_READY_REASONS}
+
+    def __call__(self, environ: WSGIEnvironment, start_response: StartResponse) -> t.Iterable[bytes]:
+        """ 请求处理器
+
+        @param environ: 环境对象
+        @param start_response: 响应对象
+        @return: t.Iterable[bytes]
+        """
+        path = environ.get('PATH_INFO')
+        if path == self.liveness_url:
+            return self.ok_response(environ, start_response)
+        if path == self.readiness_url:
+            reason = self.state.reason
+            response = self.ok_response if reason is None else self.not_ready_responses[reason]
+            return response(environ, start_response)
+        return self.wsgi_app(environ, start_response)
@@ -0,0 +1,189 @@
+#! -*- coding: utf-8 -*-
+#
+# author: forcemain@163.com
+
+from __future__ import annotations
+
+import time
+import eventlet
+import typing as t
+
+from logging import getLogger
+from service_webserver.core.metrics import Histogram
+from service_webserver.core.metrics import format_float
+from service_webserver.core.metrics import MetricsRegistry
+from service_webserver.core.response import StaticResponse
+
+if t.TYPE_CHECKING:
+    # 由于其定义在存根文件所以需要在TYPE_CHECKING下
+    from werkzeug.wsgi import WSGIEnvironment
+    from werkzeug.wrappers.response import StartResponse
+    # 仅用于类型提示
+    from service_webserver.core.health import HealthState
+
+logger = getLogger(__name__)
+
+# 默认的事件循环延迟直方图桶上限(秒)
+DEFAULT_HUB_LAG_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+# 负载保护策略,reject立即返回503,defer等待延迟恢复后再处理,超时仍返回503
+SHED_POLICIES = ('reject', 'defer')
+
+
+class HubLagMonitor(object):
+    """ 事件循环延迟监控
+
+    后台协程按固定间隔休眠,实际唤醒时间比预期晚多少即为事件循环延迟,视图函数中的CPU密集计算
+    或阻塞调用会使所有请求的延迟同时增大
+
+    设置shed_threshold后启用负载保护,延迟达到阈值时按策略拒绝或推迟新请求,直到延迟持续cooldown秒
+    低于shed_threshold * resume_ratio,期间就绪探针返回503,只有匹配到路由的请求会被拒绝或推迟,
+    由中间件提供的/metrics等端点仍可访问以便排查
+    """
+
+    def __init__(
+            self,
+            metrics: MetricsRegistry,
+            health: HealthState,
+            interval: float = 0.1,
+            shed_threshold: t.Optional[float] = None,
+            shed_policy: t.Text = 'reject',
+            resume_ratio: float = 0.5,
+            cooldown: float = 1.0,
+            defer_timeout: float = 1.0,
+            retry_after: int = 1,
+            buckets: t.Optional[t.Sequence[float]] = None
+    ) -> None:
+        """ 初始化实例
+
+        @param metrics: 指标登记表,启用时导出延迟指标
+        @param health: 就绪状态,负载保护生效时标记为未就绪
+        @param interval: 采样间隔秒数
+        @param shed_threshold: 开始负载保护的延迟秒数,None表示不启用
+        @param shed_policy: 负载保护策略,可选reject/defer
+        @param resume_ratio: 延迟降到阈值的多少倍以下时视为恢复
+        @param cooldown: 持续恢复多少秒后结束负载保护,避免间歇的高延迟使其反复开关
+        @param defer_timeout: defer策略下新请求最多等待的秒数
+        @param retry_after: 拒绝请求时Retry-After头部的秒数
+        @param buckets: 延迟直方图的桶上限(秒),默认为DEFAULT_HUB_LAG_BUCKETS
+        """
+        if shed_policy not in SHED_POLICIES:
+            raise ValueError(f'invalid shed policy {shed_policy!r}, choices are {SHED_POLICIES}')
+        self.metrics = metrics
+        self.health = health
+        self.interval = interval
+        self.shed_threshold = shed_threshold
+        self.shed_policy = shed_policy
+        self.resume_ratio = resume_ratio
+        self.cooldown = cooldown
+        self.defer_timeout = defer_timeout
+        self.stopped = True
+        self.shedding = False
+        # 最近一次采样的延迟及启动以来的最大延迟
+        self.lag = 0.0
+        self.max_lag = 0.0
+        # 最近一次未恢复的采样时间
+        self.overload_time = 0.0
+        self.histogram = Histogram(tuple(sorted(float(b) for b in buckets or DEFAULT_HUB_LAG_BUCKETS)))
+        self.shed_count = 0
+        self.deferred_count = 0
+        body = '{"error":"service overloaded"}'
+        headers = {'Content-Type': 'application/json', 'Retry-After': str(retry_after)}
+        self.shed_response = StaticResponse(body, status=503, headers=headers)
+
+    def observe(self, lag: float) -> None:
+        """ 记录一次采样并更新负载保护状态
+
+        @param lag: 延迟秒数
+        @return: None
+        """
+        self.lag = lag
+        self.max_lag = max(self.max_lag, lag)
+        self.histogram.observe(lag)
+        if self.shed_threshold is None:
+            return
+        now = time.monotonic()
+        lag >= self.shed_threshold * self.resume_ratio and setattr(self, 'overload_time', now)
+        if not self.shedding and lag >= self.shed_threshold:
+            logger.warning(f'hub lag {lag:.3f}s exceeds {self.shed_threshold}s, start shedding new requests')
+            self.shedding = self.health.shedding = True
+        elif self.shedding and now - self.overload_time >= self.cooldown:
+            logger.warning(f'hub lag recovered to {lag:.3f}s, stop shedding, {self.shed_count} rejected in total')
+            self.shedding = self.health.shedding = False
+
+    def watch_lag(self) -> None:
+        """ 定时采样事件循环延迟
+
+        @return: None
+        """
+        while not self.stopped:
+            start_time = time.perf_counter()
+            eventlet.sleep(self.interval)
+            self.observe(max(time.perf_counter() - start_time - self.interval, 0.0))
+
+    def start(self, container: t.Any) -> None:
+        """ 启动采样协程
+
+        @param container: 服务容器
+        @return: None
+        """
+        self.stopped = False
+        self.metrics.collectors.append(self.render)
+        tid = f'{self}.self_watch_lag'
+        container.spawn_splits_thread(self.watch_lag, tid=tid)
+
+    def stop(self) -> None:
+        """ 停止采样协程
+
+        @return: None
+        """
+        if self.stopped:
+            return
+        self.stopped = True
+        self.shedding = self.health.shedding = False
+        self.render in self.metrics.collectors and self.metrics.collectors.remove(self.render)
+
+    def admit(self) -> bool:
+        """ 负载保护生效时决定是否处理新请求
+
+        @return: bool
+        """
+        if self.shed_policy == 'defer':
+            self.deferred_count += 1
+            deadline = time.monotonic() + self.defer_timeout
+            # 让出事件循环,优先完成已在处理的请求
+            while self.shedding and time.monotonic() < deadline:
+                eventlet.sleep(self.interval)
+        if self.shedding:
+            self.shed_count += 1
+            return False
+        return True
+
+    def shed_app(self, environ: WSGIEnvironment, start_response: StartResponse) -> t.Iterable[bytes]:
+        """ 被拒绝请求的请求处理器
+
+        @param environ: 环境对象
+        @param start_response: 响应对象
+        @return: t.Iterable[bytes]
+        """
+        return self.shed_response(environ, start_response)
+
+    def render(self, lines: t.List[t.Text]) -> None:
+        """ 按Prometheus文本格式导出
+
+        @param lines: 输出行
+        @return: None
+        """
+        lines.append('# HELP hub_lag_seconds Delay of scheduled wake-ups in the eventlet hub.')
+        lines.append('# TYPE hub_lag_seconds histogram')
+        self.metrics.render_histogram(lines, 'hub_lag_seconds', '', self.histogram)
+        gauges = (
+            ('hub_lag_current_seconds', 'gauge', 'Hub lag of the latest sample.', format_float(self.lag)),
+            ('hub_lag_max_seconds', 'gauge', 'Maximum hub lag since start.', format_float(self.max_lag)),
+            ('hub_lag_shedding', 'gauge', 'Whether new requests are being shed.', int(self.shedding)),
+            ('hub_lag_shed_requests_total', 'counter', 'Requests rejected by load shedding.', self.shed_count),
+            ('hub_lag_deferred_requests_total', 'counter', 'Requests deferred by load shedding.', self.deferred_count),
+        )
+        for name, kind, help_text, value in gauges:
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            lines.append(f'{name} {value}')
@@ -0,0 +1,147 @@
+#! -*- coding: utf-8 -*-
+#
+# author: forcemain@163.com
+
+from __future__ import annotations
+
+import time
+import greenlet
+import typing as t
+
+if t.TYPE_CHECKING:
+    # 由于其定义在存根文件所以需要在TYPE_CHECKING下
+    from werkzeug.wsgi import WSGIApplication
+    from werkzeug.wsgi import WSGIEnvironment
+    from werkzeug.wrappers.response import StartResponse
+
+# 当前请求的在途记录
+INFLIGHT_ENVIRON_KEY = 'service_webserver.inflight'
+
+
+class InflightRequest(object):
+    """ 在途请求 """
+
+    __slots__ = ('registry', 'environ', 'route', 'start_time', 'greenlets')
+
+    def __init__(self, registry: InflightRegistry, environ: WSGIEnvironment, route: t.Any) -> None:
+        """ 初始化实例
+
+        @param registry: 所属的登记表
+        @param environ: 环境对象
+        @param route: 匹配到的路由对象,未匹配到时为None
+        """
+        self.registry = registry
+        self.environ = environ
+        self.route = route
+        self.start_time = time.monotonic()
+        # 处理此请求的协程,包括接收请求的协程和执行视图函数的工作协程
+        self.greenlets = [greenlet.getcurrent()]
+
+    def attach(self, gt: greenlet.greenlet) -> None:
+        """ 关联为此请求工作的协程
+
+        @param gt: 协程对象
+        @return: None
+        """
+        self.greenlets.append(gt)
+        self.registry.requests[gt] = self
+
+
+class InflightRegistry(object):
+    """ 在途请求登记表
+
+    只有存在使用者(如采样分析器)时才登记,平时请求只多一次属性判断
+    """
+
+    def __init__(self) -> None:
+        """ 初始化实例 """
+        self.users = 0
+        # 协程到其所属请求的映射
+        self.requests: t.Dict[greenlet.greenlet, InflightRequest] = {}
+        self.switch_users = 0
+        # 当前系统线程中正在运行的协程,只在跟踪协程切换时更新
+        self.current: t.Optional[greenlet.greenlet] = None
+        # 协程切换次数,只在跟踪协程切换时更新,不变说明事件循环被阻塞
+        self.switch_count = 0
+        self.prev_trace = None
+
+    @property
+    def enabled(self) -> bool:
+        """ 是否需要登记 """
+        return self.users > 0
+
+    def enable(self) -> None:
+        """ 增加一个使用者
+
+        @return: None
+        """
+        self.users += 1
+
+    def disable(self) -> None:
+        """ 减少一个使用者
+
+        @return: None
+        """
+        self.users = max(self.users - 1, 0)
+        self.users or self.requests.clear()
+
+    def track(
+            self,
+            wsgi_app: WSGIApplication,
+            route: t.Any,
+            environ: WSGIEnvironment,
+            start_response: StartResponse
+    ) -> t.Iterable[bytes]:
+        """ 登记请求并调用应用程序
+
+        注意: 只覆盖应用程序的调用过程,不包括之后对响应体的迭代
+
+        @param wsgi_app: 应用程序
+        @param route: 匹配到的路由对象
+        @param environ: 环境对象
+        @param start_response: 响应对象
+        @return: t.Iterable[bytes]
+        """
+        request = environ[INFLIGHT_ENVIRON_KEY] = InflightRequest(self, environ, route)
+        self.requests[request.greenlets[0]] = request
+        try:
+            return wsgi_app(environ, start_response)
+        finally:
+            for gt in request.greenlets:
+                self.requests.pop(gt, None)
+
+    def trace_switch(self, event: t.Text, args: t.Tuple[greenlet.greenlet, greenlet.greenlet]) -> None:
+        """ 协程切换的回调
+
+        @param event: 事件名称
+        @param args: (源协程, 目标协程)
+        @return: None
+        """
+        if event in ('switch', 'throw'):
+            self.current = args[1]
+            self.switch_count += 1
+        self.prev_trace is None or self.prev_trace(event, args)
+
+    def watch_switches(self) -> None:
+        """ 开始跟踪当前系统线程的协程切换
+
+        @return: None
+        """
+        self.switch_users += 1
+        if self.switch_users > 1:
+            return
+        self.current = greenlet.getcurrent()
+        self.prev_trace = greenlet.settrace(self.trace_switch)
+
+    def unwatch_switches(self) -> None:
+        """ 停止跟踪协程切换
+
+        @return: None
+        """
+        if self.switch_users == 0:
+            return
+        self.switch_users -= 1
+        if self.switch_users > 0:
+            return
+        greenlet.settrace(self.prev_trace)
+        self.current, self.prev_trace = None, None
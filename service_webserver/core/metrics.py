@@ -0,0 +1,325 @@
+#! -*- coding: utf-8 -*-
+#
+# author: forcemain@163.com
+
+from __future__ import annotations
+
+import time
+import typing as t
+
+from array import array
+from bisect import bisect_left
+from service_webserver.core.timing import TIMING_PHASES
+
+if t.TYPE_CHECKING:
+    # 由于其定义在存根文件所以需要在TYPE_CHECKING下
+    from werkzeug.wsgi import WSGIApplication
+    from werkzeug.wsgi import WSGIEnvironment
+    from werkzeug.wrappers.response import StartResponse
+
+# 默认的延迟直方图桶上限(秒)
+DEFAULT_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# 未匹配到路由的请求使用的路由标签
+UNMATCHED_ROUTE_LABEL = '[unmatched]'
+# 状态码类别,下标为状态码的百位
+STATUS_CLASSES = ('0xx', '1xx', '2xx', '3xx', '4xx', '5xx')
+
+
+class Histogram(object):
+    """ 固定桶直方图
+
+    各桶计数保存在紧凑数组中,观测时只做一次二分查找和一次自增,累计值在导出时计算
+    """
+
+    __slots__ = ('buckets', 'counts', 'sum')
+
+    def __init__(self, buckets: t.Tuple[float, ...]) -> None:
+        """ 初始化实例
+
+        @param buckets: 有序的桶上限
+        """
+        self.buckets = buckets
+        # 最后一个位置对应+Inf
+        self.counts = array('Q', bytes(8 * (len(buckets) + 1)))
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        """ 观测一个值
+
+        @param value: 值
+        @return: None
+        """
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class RouteMetrics(object):
+    """ 单个路由的指标 """
+
+    __slots__ = ('label', 'status_counts', 'request_latency', 'handler_latency', 'handler_errors',
+                 'inflight', 'bytes_in', 'bytes_out', 'phase_sums')
+
+    def __init__(self, label: t.Text, buckets: t.Tuple[float, ...]) -> None:
+        """ 初始化实例
+
+        @param label: 路由标签,即路由模板
+        @param buckets: 延迟直方图的桶上限
+        """
+        self.label = label
+        self.status_counts = array('Q', bytes(8 * len(STATUS_CLASSES)))
+        # 整个请求的延迟,包括中间件和响应体的发送
+        self.request_latency = Histogram(buckets)
+        # 视图函数在工作协程中的执行时间
+        self.handler_latency = Histogram(buckets)
+        self.handler_errors = 0
+        self.inflight = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        # 各阶段的累计耗时,由分阶段计时汇总
+        self.phase_sums = array('d', bytes(8 * len(TIMING_PHASES)))
+
+
+def escape_label_value(value: t.Text) -> t.Text:
+    """ 转义标签值
+
+    @param value: 标签值
+    @return: t.Text
+    """
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_float(value: float) -> t.Text:
+    """ 按Prometheus文本格式输出浮点数
+
+    @param value: 值
+    @return: t.Text
+    """
+    return repr(float(value))
+
+
+class MetricsRegistry(object):
+    """ 指标登记表
+
+    指标按路由模板(ReqConsumer.raw_url)聚合以限制标签基数,只有存在使用者(如MetricsMiddleware)时才统计,
+    所有更新都发生在事件循环线程中,无需加锁
+    """
+
+    def __init__(self) -> None:
+        """ 初始化实例 """
+        self.users = 0
+        self.buckets = DEFAULT_LATENCY_BUCKETS
+        # 路由对象到其指标的映射,未匹配到路由时键为None
+        self.routes: t.Dict[t.Any, RouteMetrics] = {}
+        # 路由标签到其指标的映射,路由模板相同而请求方法不同的路由共享同一指标
+        self.labels: t.Dict[t.Text, RouteMetrics] = {}
+        # 各阶段的延迟直方图,不区分路由,首次汇总分阶段计时时创建
+        self.phase_latency: t.Tuple[Histogram, ...] = ()
+        # 其它组件(如事件循环延迟监控)的导出函数,导出时追加到输出行
+        self.collectors: t.List[t.Callable[[t.List[t.Text]], None]] = []
+
+    @property
+    def enabled(self) -> bool:
+        """ 是否需要统计 """
+        return self.users > 0
+
+    def enable(self, buckets: t.Optional[t.Sequence[float]] = None) -> None:
+        """ 增加一个使用者
+
+        @param buckets: 延迟直方图的桶上限,只在尚未产生指标时生效
+        @return: None
+        """
+        self.users += 1
+        if buckets and not self.routes:
+            self.buckets = tuple(sorted(float(b) for b in buckets))
+
+    def disable(self) -> None:
+        """ 减少一个使用者
+
+        @return: None
+        """
+        self.users = max(self.users - 1, 0)
+
+    def get_route_metrics(self, route: t.Any) -> RouteMetrics:
+        """ 获取路由的指标
+
+        @param route: 路由对象,None表示未匹配到路由
+        @return: RouteMetrics
+        """
+        metrics = self.routes.get(route)
+        if metrics is None:
+            label = UNMATCHED_ROUTE_LABEL if route is None else route.raw_url
+            metrics = self.labels.get(label) or self.labels.setdefault(label, RouteMetrics(label, self.buckets))
+            self.routes[route] = metrics
+        return metrics
+
+    def track(
+            self,
+            wsgi_app: WSGIApplication,
+            route: t.Any,
+            environ: WSGIEnvironment,
+            start_response: StartResponse
+    ) -> t.Iterable[bytes]:
+        """ 统计请求并调用应用程序
+
+        在eventlet写完响应后结束统计,因此延迟包括响应体的发送,且无需包装响应体
+
+        @param wsgi_app: 应用程序
+        @param route: 匹配到的路由对象
+        @param environ: 环境对象
+        @param start_response: 响应对象
+        @return: t.Iterable[bytes]
+        """
+        metrics = self.get_route_metrics(route)
+        metrics.inflight += 1
+        content_length = environ.get('CONTENT_LENGTH')
+        if content_length and content_length.isdigit():
+            metrics.bytes_in += int(content_length)
+        # [状态码, 开始时间]
+        state = [0, time.perf_counter()]
+
+        def metrics_start_response(status: t.Text, headers: t.List, exc_info: t.Optional[t.Tuple] = None):
+            """ 记录状态码和响应字节数
+
+            @param status  : 响应状态
+            @param headers : 头部信息
+            @param exc_info: 异常信息
+            """
+            state[0] = int(status[:3])
+            for name, value in headers:
+                if name.lower() == 'content-length':
+                    if value.isdigit():
+                        metrics.bytes_out += int(value)
+                    break
+            return start_response(status, headers, exc_info)
+
+        posthooks = environ.get('eventlet.posthooks')
+        posthooks is None or posthooks.append((self.finish, (metrics, state), {}))
+        try:
+            return wsgi_app(environ, metrics_start_response)  # type: ignore
+        finally:
+            posthooks is None and self.finish(environ, metrics, state)
+
+    @staticmethod
+    def finish(environ: WSGIEnvironment, metrics: RouteMetrics, state: t.List) -> None:
+        """ 结束统计
+
+        @param environ: 环境对象
+        @param metrics: 路由指标
+        @param state: [状态码, 开始时间]
+        @return: None
+        """
+        metrics.inflight -= 1
+        metrics.request_latency.observe(time.perf_counter() - state[1])
+        # 异常未被内层处理时没有调用start_response,最终由ExceptionMiddleware返回500
+        status_class = state[0] // 100 if state[0] else 5
+        metrics.status_counts[status_class if status_class < len(STATUS_CLASSES) else 0] += 1
+
+    def observe_handler(self, route: t.Any, duration: float, failed: bool) -> None:
+        """ 记录视图函数的执行时间
+
+        @param route: 路由对象
+        @param duration: 执行秒数
+        @param failed: 是否抛出异常
+        @return: None
+        """
+        metrics = self.get_route_metrics(route)
+        metrics.handler_latency.observe(duration)
+        if failed:
+            metrics.handler_errors += 1
+
+    def observe_timing(self, route: t.Any, durations: t.Sequence[float]) -> None:
+        """ 汇总一个请求的分阶段计时
+
+        @param route: 路由对象
+        @param durations: 各阶段耗时
+        @return: None
+        """
+        phase_sums = self.get_route_metrics(route).phase_sums
+        self.phase_latency or setattr(self, 'phase_latency', tuple(Histogram(self.buckets) for _ in TIMING_PHASES))
+        for index, (duration, histogram) in enumerate(zip(durations, self.phase_latency)):
+            if duration:
+                phase_sums[index] += duration
+                histogram.observe(duration)
+
+    @staticmethod
+    def render_histogram(lines: t.List[t.Text], name: t.Text, labels: t.Text, histogram: Histogram) -> None:
+        """ 导出直方图
+
+        @param lines: 输出行
+        @param name: 指标名称
+        @param labels: 已转义的标签,如route="/items",空字符串表示无标签
+        @param histogram: 直方图
+        @return: None
+        """
+        total, counts = 0, histogram.counts.tolist()
+        prefix, suffix = (f'{labels},', f'{{{labels}}}') if labels else ('', '')
+        for le, count in zip(histogram.buckets, counts):
+            total += count
+            lines.append(f'{name}_bucket{{{prefix}le="{format_float(le)}"}} {total}')
+        total += counts[-1]
+        lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {total}')
+        lines.append(f'{name}_sum{suffix} {format_float(histogram.sum)}')
+        lines.append(f'{name}_count{suffix} {total}')
+
+    def render(self) -> t.Text:
+        """ 按Prometheus文本格式导出
+
+        @return: t.Text
+        """
+        routes = [self.labels[label] for label in sorted(self.labels)]
+        labels = [escape_label_value(m.label) for m in routes]
+        lines = [
+            '# HELP http_requests_total Total HTTP requests by route and status class.',
+            '# TYPE http_requests_total counter',
+        ]
+        for label, metrics in zip(labels, routes):
+            for status_class, count in zip(STATUS_CLASSES, metrics.status_counts.tolist()):
+                count and lines.append(f'http_requests_total{{route="{label}",status="{status_class}"}} {count}')
+        lines.append('# HELP http_request_duration_seconds HTTP request latency including the response body.')
+        lines.append('# TYPE http_request_duration_seconds histogram')
+        for label, metrics in zip(labels, routes):
+            self.render_histogram(lines, 'http_request_duration_seconds', f'route="{label}"', metrics.request_latency)
+        lines.append('# HELP http_handler_duration_seconds View function execution time in the worker greenthread.')
+        lines.append('# TYPE http_handler_duration_seconds histogram')
+        for label, metrics in zip(labels, routes):
+            # 未匹配到路由的请求不会执行视图函数
+            if metrics.label == UNMATCHED_ROUTE_LABEL:
+                continue
+            self.render_histogram(lines, 'http_handler_duration_seconds', f'route="{label}"', metrics.handler_latency)
+        gauges = (
+            ('http_handler_errors_total', 'counter', 'View functions that raised an exception.', 'handler_errors'),
+            ('http_requests_in_flight', 'gauge', 'HTTP requests currently being served.', 'inflight'),
+            ('http_request_bytes_total', 'counter', 'Request body bytes declared by Content-Length.', 'bytes_in'),
+            ('http_response_bytes_total', 'counter', 'Response body bytes declared by Content-Length.', 'bytes_out'),
+        )
+        for name, kind, help_text, attr in gauges:
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for label, metrics in zip(labels, routes):
+                if attr == 'handler_errors' and metrics.label == UNMATCHED_ROUTE_LABEL:
+                    continue
+                lines.append(f'{name}{{route="{label}"}} {getattr(metrics, attr)}')
+        self.phase_latency and self.render_timing(lines, labels, routes)
+        for collector in self.collectors:
+            collector(lines)
+        return '\n'.join(lines) + '\n'
+
+    def render_timing(self, lines: t.List[t.Text], labels: t.List[t.Text], routes: t.List[RouteMetrics]) -> None:
+        """ 导出分阶段计时
+
+        @param lines: 输出行
+        @param labels: 已转义的路由标签
+        @param routes: 路由指标
+        @return: None
+        """
+        lines.append('# HELP http_request_phase_seconds_total Time spent in each request phase by route.')
+        lines.append('# TYPE http_request_phase_seconds_total counter')
+        for label, metrics in zip(labels, routes):
+            for phase, duration in zip(TIMING_PHASES, metrics.phase_sums.tolist()):
+                duration and lines.append(
+                    f'http_request_phase_seconds_total{{route="{label}",phase="{phase}"}} {format_float(duration)}'
+                )
+        lines.append('# HELP http_request_phase_duration_seconds Per-request time spent in each request phase.')
+        lines.append('# TYPE http_request_phase_duration_seconds histogram')
+        for phase, histogram in zip(TIMING_PHASES, self.phase_latency):
+            self.render_histogram(lines, 'http_request_phase_duration_seconds', f'phase="{phase}"', histogram)
@@ -0,0 +1,316 @@
+#! -*- coding: utf-8 -*-
+#
+# author: forcemain@163.com
+
+from __future__ import annotations
+
+import sys
+import json
+import time
+import eventlet
+import typing as t
+
+from eventlet import tpool
+from eventlet.semaphore import Semaphore
+from datetime import datetime
+from datetime import timezone
+from logging import getLogger
+from collections import deque
+from service_core.core.service.entrypoint import Entrypoint
+from service_webserver.core.entrypoints.webserver.pipeline import ROUTE_ENVIRON_KEY
+
+if t.TYPE_CHECKING:
+    # 由于其定义在存根文件所以需要在TYPE_CHECKING下
+    from werkzeug.wsgi import WSGIApplication
+    from werkzeug.wsgi import WSGIEnvironment
+    from werkzeug.wrappers.response import StartResponse
+
+from .base import BaseMiddleware
+
+logger = getLogger(__name__)
+
+# 访问日志的字段,记录按此顺序保存为元组
+ACCESS_LOG_FIELDS = (
+    'time', 'remote_addr', 'method', 'path', 'query', 'status', 'bytes', 'duration_ms', 'user_agent', 'route'
+)
+# 支持的输出格式
+ACCESS_LOG_FORMATS = ('json', 'logfmt')
+
+
+def format_logfmt_value(value: t.Any) -> t.Text:
+    """ 格式化logfmt的值
+
+    @param value: 值
+    @return: t.Text
+    """
+    if value is None:
+        return '-'
+    value = str(value)
+    if value and not any(c in value for c in ' "=\\'):
+        return value
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+class CountingResponse(object):
+    """ 统计实际写出的响应体字节数
+
+    只用于没有Content-Length的响应,如分块/流式/SSE/NDJSON或压缩后的响应,有长度的响应不包装以免影响零拷贝发送
+    """
+
+    __slots__ = ('app_iter', 'state')
+
+    def __init__(self, app_iter: t.Iterable[bytes], state: t.List) -> None:
+        """ 初始化实例
+
+        @param app_iter: 响应体
+        @param state: [状态码, Content-Length, 已写出的字节数]
+        """
+        self.app_iter = app_iter
+        self.state = state
+        state[2] = 0
+
+    def __iter__(self) -> t.Iterator[bytes]:
+        """ 逐块转发响应体并累加字节数
+
+        @return: t.Iterator[bytes]
+        """
+        state = self.state
+        for data in self.app_iter:
+            state[2] += len(data)
+            yield data
+
+    def close(self) -> None:
+        """ 关闭响应体
+
+        @return: None
+        """
+        close = getattr(self.app_iter, 'close', None)
+        close is None or close()
+
+
+class AccessLogMiddleware(BaseMiddleware):
+    """ 结构化访问日志中间件类
+
+    请求结束时只把记录放入有界缓冲区,由后台协程按批交给系统线程格式化并写出,
+    缓冲区满时丢弃新记录并计数而不阻塞请求,同时可关闭eventlet逐请求同步写出的访问日志
+    """
+
+    def __init__(
+            self, *,
+            wsgi_app: WSGIApplication,
+            producer: Entrypoint,
+            output: t.Text = '-',
+            log_format: t.Text = 'json',
+            buffer_size: int = 65536,
+            batch_size: int = 1024,
+            flush_interval: float = 1.0,
+            sample_rate: int = 1,
+            error_status: int = 500,
+            slow_threshold: t.Optional[float] = 1.0,
+            disable_server_log: bool = True
+    ) -> None:
+        """ 初始化实例
+
+        @param wsgi_app: 应用程序
+        @param producer: 服务提供者
+        @param output: 输出文件路径,-表示标准输出
+        @param log_format: 输出格式,可选json/logfmt
+        @param buffer_size: 缓冲区最多保存的记录数
+        @param batch_size: 每批最多写出的记录数
+        @param flush_interval: 写出间隔秒数
+        @param sample_rate: 每N个普通请求记录1个,错误和慢请求总是记录
+        @param error_status: 不小于此状态码的响应视为错误
+        @param slow_threshold: 不小于此秒数的请求视为慢请求,None表示不区分
+        @param disable_server_log: 是否关闭eventlet自带的访问日志
+        """
+        super(AccessLogMiddleware, self).__init__(wsgi_app=wsgi_app, producer=producer)
+        if log_format not in ACCESS_LOG_FORMATS:
+            raise ValueError(f'invalid access log format {log_format!r}, choices are {ACCESS_LOG_FORMATS}')
+        self.output = output
+        self.log_format = log_format
+        self.buffer_size = buffer_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.sample_rate = max(sample_rate, 1)
+        self.error_status = error_status
+        self.slow_threshold = slow_threshold
+        self.disable_server_log = disable_server_log
+        self.stream = None
+        self.stopped = False
+        # 写出一批记录期间持有,停止阶段需等待正在写出的批次完成后才能关闭输出
+        self.write_lock = Semaphore()
+        # 待写出的记录 - [(字段值, ...)]
+        self.records: t.Deque[t.Tuple] = deque()
+        self.request_count = 0
+        self.written_count = 0
+        self.dropped_count = 0
+        self.route_names: t.Dict[t.Any, t.Text] = {}
+
+    def get_route_name(self, environ: WSGIEnvironment) -> t.Optional[t.Text]:
+        """ 获取匹配到的路由规则
+
+        @param environ: 环境对象
+        @return: t.Optional[t.Text]
+        """
+        route = environ.get(ROUTE_ENVIRON_KEY, (None,))[0]
+        if route is None:
+            return None
+        name = self.route_names.get(route)
+        if name is None:
+            name = self.route_names[route] = route.raw_url
+        return name
+
+    def add_record(self, environ: WSGIEnvironment, state: t.List, start_time: float) -> None:
+        """ 请求结束时生成记录
+
+        @param environ: 环境对象
+        @param state: [状态码, Content-Length, 已写出的字节数]
+        @param start_time: 开始时间
+        @return: None
+        """
+        duration = time.perf_counter() - start_time
+        # 异常未被内层处理时没有调用start_response,最终由ExceptionMiddleware返回500
+        status = state[0] or 500
+        self.request_count += 1
+        sampled = self.request_count % self.sample_rate == 0
+        slow = self.slow_threshold is not None and duration >= self.slow_threshold
+        if not sampled and not slow and status < self.error_status:
+            return
+        if len(self.records) >= self.buffer_size:
+            self.dropped_count += 1
+            return
+        self.records.append((
+            time.time(),
+            environ.get('REMOTE_ADDR'),
+            environ.get('REQUEST_METHOD'),
+            environ.get('PATH_INFO'),
+            environ.get('QUERY_STRING') or None,
+            status,
+            state[2] if state[1] is None else state[1],
+            round(duration * 1000, 3),
+            environ.get('HTTP_USER_AGENT'),
+            self.get_route_name(environ),
+        ))
+
+    def format_record(self, record: t.Tuple) -> t.Text:
+        """ 格式化一条记录
+
+        @param record: 记录
+        @return: t.Text
+        """
+        values = dict(zip(ACCESS_LOG_FIELDS, record))
+        values['time'] = datetime.fromtimestamp(record[0], timezone.utc).isoformat(timespec='milliseconds')
+        if self.log_format == 'json':
+            return json.dumps(values, ensure_ascii=False, separators=(',', ':'))
+        return ' '.join(f'{k}={format_logfmt_value(v)}' for k, v in values.items())
+
+    def write_records(self, records: t.List[t.Tuple]) -> None:
+        """ 格式化并写出一批记录
+
+        注意: 在系统线程中执行,不能使用协程相关的对象,也不记录日志
+
+        @param records: 记录列表
+        @return: None
+        """
+        self.stream.write(''.join(f'{self.format_record(r)}\n' for r in records))
+        self.stream.flush()
+
+    def flush(self) -> None:
+        """ 分批写出缓冲区中的记录
+
+        @return: None
+        """
+        while self.records:
+            with self.write_lock:
+                # 停止阶段已写出剩余记录并关闭输出
+                if self.stream is None:
+                    return
+                count = min(len(self.records), self.batch_size)
+                records = [self.records.popleft() for _ in range(count)]
+                try:
+                    tpool.execute(self.write_records, records)
+                except Exception as e:
+                    self.dropped_count += count
+                    logger.error(f'write {count} access log records to {self.output} failed, {e}')
+                    return
+                self.written_count += count
+
+    def flush_records(self) -> None:
+        """ 定时写出记录
+
+        @return: None
+        """
+        while not self.stopped:
+            eventlet.sleep(self.flush_interval)
+            self.flush()
+
+    def start(self) -> None:
+        """ 生命周期 - 启动阶段
+
+        @return: None
+        """
+        self.stream = sys.stdout if self.output == '-' else open(self.output, 'a', encoding='utf-8')
+        wsgi_server = self.producer.wsgi_server
+        # eventlet在请求协程中同步格式化并写出访问日志,由此中间件接管后关闭
+        self.disable_server_log and wsgi_server is not None and setattr(wsgi_server, 'log_output', False)
+        tid = f'{self}.self_flush_records'
+        self.producer.container.spawn_splits_thread(self.flush_records, tid=tid)
+
+    def stop(self) -> None:
+        """ 生命周期 - 停止阶段
+
+        @return: None
+        """
+        self.stopped = True
+        if self.stream is None:
+            return
+        # 等待后台协程正在写出的批次完成,避免交错写出或写入已关闭的文件
+        with self.write_lock:
+            records, count = list(self.records), len(self.records)
+            self.records.clear()
+            try:
+                records and self.write_records(records)
+                self.written_count += count
+            except Exception as e:
+                self.dropped_count += count
+                logger.error(f'write {count} access log records to {self.output} failed, {e}')
+            self.stream is sys.stdout or self.stream.close()
+            self.stream = None
+        self.dropped_count and logger.warning(f'{self.dropped_count} access log records dropped')
+
+    def __call__(self, environ: WSGIEnvironment, start_response: StartResponse) -> t.Iterable[bytes]:
+        """ 请求处理器
+
+        @param environ: 环境对象
+        @param start_response: 响应对象
+        @return: t.Iterable[bytes]
+        """
+        start_time = time.perf_counter()
+        # [状态码, Content-Length, 没有Content-Length时实际写出的字节数]
+        state = [0, None, None]
+
+        def record_start_response(status: t.Text, headers: t.List, exc_info: t.Optional[t.Tuple] = None):
+            """ 记录状态码和Content-Length
+
+            @param status  : 响应状态
+            @param headers : 头部信息
+            @param exc_info: 异常信息
+            """
+            state[0] = int(status[:3])
+            for name, value in headers:
+                if name.lower() == 'content-length':
+                    state[1] = int(value) if value.isdigit() else None
+                    break
+            return start_response(status, headers, exc_info)
+
+        posthooks = environ.get('eventlet.posthooks')
+        # eventlet在响应完全写出后调用,无需包装响应体,不影响零拷贝发送
+        posthooks is None or posthooks.append((self.add_record, (state, start_time), {}))
+        try:
+            app_iter = self.wsgi_app(environ, record_start_response)  # type: ignore
+        finally:
+            posthooks is None and self.add_record(environ, state, start_time)
+        # 没有Content-Length或者尚未调用start_response(生成器)时统计实际写出的字节数
+        if posthooks is None or state[1] is not None:
+            return app_iter
+        return CountingResponse(app_iter, state)
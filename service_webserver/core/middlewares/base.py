@@ -4,6 +4,7 @@
 
 from __future__ import annotations
 
+import hmac
 import typing as t
 
 from service_core.core.service.entrypoint import Entrypoint
@@ -14,10 +15,48 @@ if t.TYPE_CHECKING:
     from werkzeug.wsgi import WSGIEnvironment
     from werkzeug.wrappers.response import StartResponse
 
+# 由ReqProducer从中间件配置中取出的路由选择选项
+MIDDLEWARE_ROUTE_OPTIONS = (
+    'route_prefixes', 'route_tags', 'route_opt_in', 'apply_to_routes', 'apply_to_fallback',
+    'claim_paths', 'before_routing'
+)
+
+
+def is_admin_authorized(environ: WSGIEnvironment, admin_token: t.Optional[t.Text]) -> bool:
+    """ 是否允许访问中间件的管理接口
+
+    注意: 未设置令牌时一律拒绝,请求经反向代理转发时来源地址不可信,令牌按常量时间比较
+
+    @param environ: 环境对象
+    @param admin_token: 管理接口令牌,通过Authorization: Bearer传入
+    @return: bool
+    """
+    if admin_token is None:
+        return False
+    authorization = environ.get('HTTP_AUTHORIZATION', '').encode('latin-1', 'replace')
+    return hmac.compare_digest(authorization, f'Bearer {admin_token}'.encode('utf-8'))
+
 
 class BaseMiddleware(object):
     """ 中间件基类 """
 
+    # 仅作用于这些路径前缀的路由
+    route_prefixes: t.Optional[t.Tuple[t.Text, ...]] = None
+    # 仅作用于带有这些标签的路由
+    route_tags: t.Optional[t.FrozenSet[t.Text]] = None
+    # 仅作用于在webserver.api(middlewares=[...])中显式声明的路由
+    route_opt_in = False
+    # 是否作用于匹配到的路由,只提供自身接口的中间件可以关闭以减少路由请求的开销
+    apply_to_routes = True
+    # 是否作用于未匹配到路由的请求
+    apply_to_fallback = True
+    # 是否在路由匹配之前认领自身处理的路径,认领的请求不再匹配路由而是直接进入兜底管道
+    claim_paths = True
+    # 是否在路由匹配之前执行,用于改写主机/路径等影响路由匹配的环境对象,此时作用于所有请求且位于其它中间件之外
+    before_routing = False
+    # 配置文件中声明的加载路径
+    dotted_path: t.Optional[t.Text] = None
+
     def __init__(self, *, wsgi_app: WSGIApplication, producer: Entrypoint, **kwargs: t.Any) -> None:
         """ 初始化实例
 
@@ -36,3 +75,80 @@ class BaseMiddleware(object):
         @return: t.Iterable[bytes]
         """
         return self.wsgi_app(environ, start_response)
+
+    def start(self) -> None:
+        """ 生命周期 - 启动阶段
+
+        由ReqProducer在服务开始监听后调用,适合启动后台任务
+
+        @return: None
+        """
+
+    def stop(self) -> None:
+        """ 生命周期 - 停止阶段
+
+        @return: None
+        """
+
+    def set_route_options(
+            self,
+            route_prefixes: t.Optional[t.List[t.Text]] = None,
+            route_tags: t.Optional[t.List[t.Text]] = None,
+            route_opt_in: t.Optional[bool] = None,
+            apply_to_routes: t.Optional[bool] = None,
+            apply_to_fallback: t.Optional[bool] = None,
+            claim_paths: t.Optional[bool] = None,
+            before_routing: t.Optional[bool] = None
+    ) -> None:
+        """ 设置路由选择选项
+
+        @param route_prefixes: 路径前缀列表
+        @param route_tags: 路由标签列表
+        @param route_opt_in: 是否需要路由显式声明
+        @param apply_to_routes: 是否作用于匹配到的路由
+        @param apply_to_fallback: 是否作用于未匹配到路由的请求
+        @param claim_paths: 是否在路由匹配之前认领自身处理的路径
+        @param before_routing: 是否在路由匹配之前执行
+        @return: None
+        """
+        route_prefixes is None or setattr(self, 'route_prefixes', tuple(route_prefixes))
+        route_tags is None or setattr(self, 'route_tags', frozenset(route_tags))
+        route_opt_in is None or setattr(self, 'route_opt_in', route_opt_in)
+        apply_to_routes is None or setattr(self, 'apply_to_routes', apply_to_routes)
+        apply_to_fallback is None or setattr(self, 'apply_to_fallback', apply_to_fallback)
+        claim_paths is None or setattr(self, 'claim_paths', claim_paths)
+        before_routing is None or setattr(self, 'before_routing', before_routing)
+
+    def get_claimed_paths(self) -> t.Tuple[t.Iterable[t.Text], t.Iterable[t.Text]]:
+        """ 获取由中间件自身处理的路径
+
+        挂载/代理/管理接口等中间件只作用于兜底管道,认领其路径后即使业务路由(如/<path:p>)同样匹配也由中间件处理
+
+        @return: t.Tuple[t.Iterable[t.Text], t.Iterable[t.Text]] - (完整路径, 路径前缀)
+        """
+        return (), ()
+
+    def is_declared_by(self, consumer: t.Any) -> bool:
+        """ 路由是否显式声明了此中间件
+
+        @param consumer: 路由对象
+        @return: bool
+        """
+        names = getattr(consumer, 'middlewares', None) or ()
+        return self.__class__.__name__ in names or (self.dotted_path is not None and self.dotted_path in names)
+
+    def applies_to(self, consumer: t.Any) -> bool:
+        """ 是否作用于此路由
+
+        @param consumer: 路由对象
+        @return: bool
+        """
+        if self.is_declared_by(consumer):
+            return True
+        if self.route_opt_in or not self.apply_to_routes:
+            return False
+        if self.route_prefixes is not None and not consumer.raw_url.startswith(self.route_prefixes):
+            return False
+        if self.route_tags is not None and not self.route_tags.intersection(consumer.tags):
+            return False
+        return True
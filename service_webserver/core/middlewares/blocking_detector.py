@@ -0,0 +1,239 @@
+#! -*- coding: utf-8 -*-
+#
+# author: forcemain@163.com
+
+from __future__ import annotations
+
+import sys
+import eventlet
+import traceback
+import typing as t
+
+from eventlet import patcher
+from logging import getLogger
+from collections import deque
+from eventlet.hubs import get_hub
+from service_webserver.core.metrics import format_float
+from service_webserver.core.metrics import escape_label_value
+from service_core.core.service.entrypoint import Entrypoint
+
+if t.TYPE_CHECKING:
+    # 由于其定义在存根文件所以需要在TYPE_CHECKING下
+    from werkzeug.wsgi import WSGIApplication
+
+from .base import BaseMiddleware
+from .sampling_profiler import SamplingProfilerMiddleware
+
+# 检测线程必须是真正的系统线程,不能被eventlet打补丁
+threading = patcher.original('threading')
+original_time = patcher.original('time')
+
+logger = getLogger(__name__)
+
+
+class BlockingEvent(object):
+    """ 一次事件循环阻塞 """
+
+    __slots__ = ('route', 'path', 'start_time', 'duration', 'stack')
+
+    def __init__(self, route: t.Any, path: t.Optional[t.Text], start_time: float, stack: t.Text) -> None:
+        """ 初始化实例
+
+        @param route: 阻塞时正在执行的路由对象,不属于任何请求时为None
+        @param path: 请求路径
+        @param start_time: 最后一次协程切换的时间
+        @param stack: 阻塞时的调用栈
+        """
+        self.route = route
+        self.path = path
+        self.start_time = start_time
+        self.duration = 0.0
+        self.stack = stack
+
+
+class BlockingDetectorMiddleware(BaseMiddleware):
+    """ 阻塞调用检测中间件类
+
+    在系统线程中定时检查协程切换次数,超过threshold秒没有切换且事件循环不是空闲等待时,
+    采集事件循环线程的调用栈并归属到当前正在执行的路由,如未打补丁的time.sleep/原生数据库驱动/大型正则等
+
+    检测线程不使用协程相关的对象也不记录日志,阻塞结束后由后台协程写出告警日志并累加计数,
+    启用MetricsMiddleware时导出为hub_blocking_*指标
+
+    注意: 跟踪协程切换有少量开销,建议在测试环境开启
+    """
+
+    # 检测由系统线程完成,业务路由无需经过
+    apply_to_routes = False
+    apply_to_fallback = False
+
+    def __init__(
+            self, *,
+            wsgi_app: WSGIApplication,
+            producer: Entrypoint,
+            threshold: float = 0.1,
+            check_interval: t.Optional[float] = None,
+            flush_interval: float = 1.0,
+            max_events: int = 1000,
+            max_depth: int = 64
+    ) -> None:
+        """ 初始化实例
+
+        @param wsgi_app: 应用程序
+        @param producer: 服务提供者
+        @param threshold: 超过多少秒没有协程切换视为阻塞
+        @param check_interval: 检查间隔秒数,默认为threshold的四分之一
+        @param flush_interval: 写出告警日志的间隔秒数
+        @param max_events: 尚未写出的阻塞事件最多保留的数量
+        @param max_depth: 每个调用栈最多保留的帧数(靠近栈顶的部分)
+        """
+        super(BlockingDetectorMiddleware, self).__init__(wsgi_app=wsgi_app, producer=producer)
+        self.threshold = threshold
+        self.check_interval = check_interval or threshold / 4
+        self.flush_interval = flush_interval
+        self.max_depth = max_depth
+        self.running = False
+        self.thread = None
+        # 事件循环所在的系统线程及其主协程,在启动时获取
+        self.hub_ident = None
+        self.hub_greenlet = None
+        # 已结束待写出的阻塞事件,由检测线程写入
+        self.events: t.Deque[BlockingEvent] = deque(maxlen=max_events)
+        self.event_count = 0
+        self.check_errors = 0
+        # 按路由标签统计 - {路由标签: [次数, 总秒数]}
+        self.route_counts: t.Dict[t.Text, t.List] = {}
+
+    def capture(self, start_time: float) -> t.Optional[BlockingEvent]:
+        """ 采集事件循环线程的调用栈
+
+        注意: 在系统线程中执行,不能使用协程相关的对象,也不记录日志
+
+        @param start_time: 最后一次协程切换的时间
+        @return: t.Optional[BlockingEvent]
+        """
+        frame = sys._current_frames().get(self.hub_ident)
+        if frame is None:
+            return None
+        current = self.producer.inflight.current
+        # 事件循环空闲等待时同样没有协程切换
+        if current is self.hub_greenlet and SamplingProfilerMiddleware.is_idle_frame(frame):
+            return None
+        request = self.producer.inflight.requests.get(current)
+        route, path = (None, None) if request is None else (request.route, request.environ.get('PATH_INFO'))
+        stack = ''.join(traceback.format_stack(frame)[-self.max_depth:])
+        return BlockingEvent(route, path, start_time, stack)
+
+    def run_detector(self) -> None:
+        """ 检测线程的主循环
+
+        注意: 在系统线程中执行,不能使用协程相关的对象,也不记录日志
+
+        @return: None
+        """
+        inflight = self.producer.inflight
+        last_count, last_time, event = inflight.switch_count, original_time.monotonic(), None
+        while self.running:
+            original_time.sleep(self.check_interval)
+            now, count = original_time.monotonic(), inflight.switch_count
+            if count != last_count:
+                # 阻塞已结束,记录其持续时间后交给后台协程写出
+                if event is not None:
+                    event.duration = now - event.start_time
+                    self.events.append(event)
+                last_count, last_time, event = count, now, None
+                continue
+            if event is not None or now - last_time < self.threshold:
+                continue
+            try:
+                event = self.capture(last_time)
+            except Exception:
+                # 采集时事件循环线程可能正在修改栈,下次检查时重试
+                self.check_errors += 1
+
+    @staticmethod
+    def get_route_name(route: t.Any) -> t.Text:
+        """ 获取路由名称
+
+        @param route: 路由对象,None表示不属于任何请求
+        @return: t.Text
+        """
+        return '[hub]' if route is None else f'{",".join(sorted(route.methods))} {route.raw_url}'
+
+    def report(self, event: BlockingEvent) -> None:
+        """ 记录一次阻塞
+
+        @param event: 阻塞事件
+        @return: None
+        """
+        self.event_count += 1
+        label = '[hub]' if event.route is None else event.route.raw_url
+        counts = self.route_counts.setdefault(label, [0, 0.0])
+        counts[0] += 1
+        counts[1] += event.duration
+        logger.warning(
+            f'hub blocked for {event.duration:.3f}s by {self.get_route_name(event.route)} '
+            f'path={event.path}, blocking stack:\n{event.stack}'
+        )
+
+    def flush_events(self) -> None:
+        """ 定时写出阻塞事件
+
+        @return: None
+        """
+        while self.running:
+            eventlet.sleep(self.flush_interval)
+            while self.events:
+                self.report(self.events.popleft())
+
+    def start(self) -> None:
+        """ 生命周期 - 启动阶段
+
+        注意: 需在事件循环所在的线程中调用
+
+        @return: None
+        """
+        self.hub_ident = threading.get_ident()
+        self.hub_greenlet = get_hub().greenlet
+        self.producer.inflight.enable()
+        self.producer.inflight.watch_switches()
+        self.producer.metrics.collectors.append(self.render)
+        self.running = True
+        self.thread = threading.Thread(target=self.run_detector, name=f'{self}.self_run_detector', daemon=True)
+        self.thread.start()
+        tid = f'{self}.self_flush_events'
+        self.producer.container.spawn_splits_thread(self.flush_events, tid=tid)
+        logger.debug(f'blocking detector started with threshold={self.threshold}s')
+
+    def stop(self) -> None:
+        """ 生命周期 - 停止阶段
+
+        @return: None
+        """
+        if not self.running:
+            return
+        self.running = False
+        while self.events:
+            self.report(self.events.popleft())
+        collectors = self.producer.metrics.collectors
+        self.render in collectors and collectors.remove(self.render)
+        self.producer.inflight.unwatch_switches()
+        self.producer.inflight.disable()
+        self.thread = None
+        self.event_count and logger.warning(f'hub was blocked {self.event_count} times while running')
+
+    def render(self, lines: t.List[t.Text]) -> None:
+        """ 按Prometheus文本格式导出
+
+        @param lines: 输出行
+        @return: None
+        """
+        route_counts = sorted(self.route_counts.items())
+        lines.append('# HELP hub_blocking_total Times the eventlet hub was blocked longer than the threshold.')
+        lines.append('# TYPE hub_blocking_total counter')
+        for label, (count, _) in route_counts:
+            lines.append(f'hub_blocking_total{{route="{escape_label_value(label)}"}} {count}')
+        lines.append('# HELP hub_blocking_seconds_total Time the eventlet hub spent blocked.')
+        lines.append('# TYPE hub_blocking_seconds_total counter')
+        for label, (_, seconds) in route_counts:
+            lines.append(f'hub_blocking_seconds_total{{route="{escape_label_value(label)}"}} {format_float(seconds)}')
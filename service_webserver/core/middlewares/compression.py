@@ -0,0 +1,306 @@
+#! -*- coding: utf-8 -*-
+#
+# author: forcemain@163.com
+
+from __future__ import annotations
+
+import typing as t
+
+from collections import OrderedDict
+from service_webserver.core.compress import Compressor
+from service_webserver.core.compress import compress_bytes
+from service_webserver.core.compress import negotiate_encoding
+from service_core.core.service.entrypoint import Entrypoint
+from service_webserver.core.compress import get_available_encodings
+
+if t.TYPE_CHECKING:
+    # 由于其定义在存根文件所以需要在TYPE_CHECKING下
+    from werkzeug.wsgi import WSGIApplication
+    from werkzeug.wsgi import WSGIEnvironment
+    from werkzeug.wrappers.response import StartResponse
+
+from .base import BaseMiddleware
+
+# 默认跳过的已压缩类型
+DEFAULT_EXCLUDE_MIMETYPES = (
+    'image/', 'video/', 'audio/', 'font/woff',
+    'application/zip', 'application/gzip', 'application/x-gzip',
+    'application/x-bzip2', 'application/x-xz', 'application/x-7z-compressed',
+    'application/x-rar-compressed', 'application/octet-stream', 'application/pdf',
+)
+# 图片中仍然值得压缩的文本类型
+DEFAULT_INCLUDE_MIMETYPES = ('image/svg+xml',)
+
+
+class CompressedCache(object):
+    """ 按资源及其强ETag缓存压缩结果的LRU """
+
+    def __init__(self, max_items: int = 256, max_bytes: int = 64 << 20) -> None:
+        """ 初始化实例
+
+        @param max_items: 最大条目数
+        @param max_bytes: 最大总字节数
+        """
+        self.size = 0
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.items: OrderedDict[t.Tuple[t.Text, ...], bytes] = OrderedDict()
+
+    def get(self, key: t.Tuple[t.Text, ...]) -> t.Optional[bytes]:
+        """ 获取并标记为最近使用
+
+        @param key: (路径, 查询字符串, 强ETag, 压缩算法)
+        @return: t.Optional[bytes]
+        """
+        data = self.items.get(key)
+        data is not None and self.items.move_to_end(key)
+        return data
+
+    def set(self, key: t.Tuple[t.Text, ...], data: bytes) -> None:
+        """ 写入并淘汰最久未使用的条目
+
+        @param key: (路径, 查询字符串, 强ETag, 压缩算法)
+        @param data: 压缩结果
+        @return: None
+        """
+        if len(data) > self.max_bytes:
+            return
+        old = self.items.pop(key, None)
+        self.size -= len(old) if old is not None else 0
+        self.items[key] = data
+        self.size += len(data)
+        while self.items and (len(self.items) > self.max_items or self.size > self.max_bytes):
+            _, data = self.items.popitem(last=False)
+            self.size -= len(data)
+
+
+class CompressionMiddleware(BaseMiddleware):
+    """ 响应压缩中间件类 """
+
+    def __init__(
+            self, *,
+            wsgi_app: WSGIApplication,
+            producer: Entrypoint,
+            min_size: int = 500,
+            max_buffer_size: int = 1 << 20,
+            compress_streaming: bool = False,
+            encodings: t.Optional[t.List[t.Text]] = None,
+            levels: t.Optional[t.Dict[t.Text, int]] = None,
+            exclude_mimetypes: t.Optional[t.List[t.Text]] = None,
+            cache_max_items: int = 256,
+            cache_max_bytes: int = 64 << 20
+    ) -> None:
+        """ 初始化实例
+
+        @param wsgi_app: 应用程序
+        @param producer: 服务提供者
+        @param min_size: 小于此字节数的响应不压缩
+        @param max_buffer_size: 超过此字节数或未知长度的响应视为流式响应
+        @param compress_streaming: 是否对流式响应进行流式压缩
+        @param encodings: 启用的压缩算法,按优先级排列
+        @param levels: 各压缩算法的压缩级别
+        @param exclude_mimetypes: 跳过的已压缩类型(前缀匹配)
+        @param cache_max_items: 压缩缓存最大条目数,0表示关闭
+        @param cache_max_bytes: 压缩缓存最大字节数
+        """
+        super(CompressionMiddleware, self).__init__(wsgi_app=wsgi_app, producer=producer)
+        available = get_available_encodings()
+        encodings = encodings or available
+        self.encodings = tuple(e for e in encodings if e in available)
+        self.min_size = min_size
+        self.max_buffer_size = max_buffer_size
+        self.compress_streaming = compress_streaming
+        self.levels = levels or {}
+        self.exclude_mimetypes = tuple(exclude_mimetypes or DEFAULT_EXCLUDE_MIMETYPES)
+        self.cache = CompressedCache(cache_max_items, cache_max_bytes) if cache_max_items else None
+
+    def is_compressible(self, status: t.Text, headers: t.List[t.Tuple[t.Text, t.Text]]) -> bool:
+        """ 根据状态和头部判断是否值得压缩
+
+        @param status: 响应状态
+        @param headers: 响应头部
+        @return: bool
+        """
+        code = int(status.split(' ', 1)[0])
+        # 无响应体以及部分内容响应都不能压缩
+        if code < 200 or code in (204, 206, 304):
+            return False
+        for name, value in headers:
+            name = name.lower()
+            if name == 'content-encoding':
+                return False
+            if name == 'cache-control' and 'no-transform' in value.lower():
+                return False
+            if name == 'content-length' and int(value) < self.min_size:
+                return False
+            if name != 'content-type':
+                continue
+            mimetype = value.split(';', 1)[0].strip().lower()
+            if mimetype in DEFAULT_INCLUDE_MIMETYPES:
+                continue
+            if mimetype.startswith(self.exclude_mimetypes):
+                return False
+        return True
+
+    @staticmethod
+    def gen_headers(
+            headers: t.List[t.Tuple[t.Text, t.Text]],
+            encoding: t.Text,
+            length: t.Optional[int] = None
+    ) -> t.List[t.Tuple[t.Text, t.Text]]:
+        """ 生成压缩后的响应头部
+
+        @param headers: 原始头部
+        @param encoding: 压缩算法
+        @param length: 压缩后长度,None表示未知
+        @return: t.List[t.Tuple[t.Text, t.Text]]
+        """
+        new_headers, vary = [], None
+        for name, value in headers:
+            lower_name = name.lower()
+            # 范围请求的偏移针对未压缩的响应体,压缩后不再支持
+            if lower_name in ('content-length', 'accept-ranges'):
+                continue
+            if lower_name == 'vary':
+                vary = value
+                continue
+            # 同一资源的不同编码字节不同,强ETag需降级为弱ETag
+            if lower_name == 'etag' and not value.startswith('W/'):
+                value = f'W/{value}'
+            new_headers.append((name, value))
+        if vary is None or vary.strip() == '':
+            vary = 'Accept-Encoding'
+        elif vary.strip() != '*' and 'accept-encoding' not in vary.lower():
+            vary = f'{vary}, Accept-Encoding'
+        new_headers.append(('Vary', vary))
+        new_headers.append(('Content-Encoding', encoding))
+        length is not None and new_headers.append(('Content-Length', str(length)))
+        return new_headers
+
+    def iter_compressed(self, app_iter: t.Iterable[bytes], first: t.List[bytes], encoding: t.Text) -> t.Iterator[bytes]:
+        """ 流式压缩响应体
+
+        @param app_iter: 原始响应体
+        @param first: 已预读的数据块
+        @param encoding: 压缩算法
+        @return: t.Iterator[bytes]
+        """
+        compressor = Compressor(encoding, level=self.levels.get(encoding))
+        try:
+            for chunk in first:
+                data = compressor.compress(chunk) + compressor.flush()
+                data and (yield data)
+            for chunk in app_iter:
+                if not chunk:
+                    continue
+                # 每块都同步刷出,保证SSE等流式响应在压缩后依然实时
+                data = compressor.compress(chunk) + compressor.flush()
+                data and (yield data)
+            yield compressor.finish()
+        finally:
+            close = getattr(app_iter, 'close', None)
+            close and close()
+
+    def __call__(self, environ: WSGIEnvironment, start_response: StartResponse) -> t.Iterable[bytes]:
+        """ 请求处理器
+
+        @param environ: 环境对象
+        @param start_response: 响应对象
+        @return: t.Iterable[bytes]
+        """
+        encoding = negotiate_encoding(environ.get('HTTP_ACCEPT_ENCODING'), self.encodings)
+        if encoding is None or environ.get('REQUEST_METHOD') == 'HEAD':
+            return self.wsgi_app(environ, start_response)
+        captured, written = [], []
+
+        def capture_response(status: t.Text, headers: t.List, exc_info: t.Optional[t.Tuple] = None):
+            """ 暂存响应状态和头部 """
+            captured[:] = [status, headers, exc_info]
+            return written.append
+
+        app_iter = self.wsgi_app(environ, capture_response)
+        first = list(written)
+        app_iter_iter = iter(app_iter)
+        # 兼容在首次迭代时才调用start_response的应用
+        if not captured:
+            for chunk in app_iter_iter:
+                first.append(chunk)
+                if captured: break
+        # 应用未调用start_response时原样透传,由服务器处理
+        if not captured:
+            return self.iter_response(first, app_iter, app_iter_iter)
+        status, headers, exc_info = captured
+        if not self.is_compressible(status, headers):
+            return self.passthrough(start_response, captured, first, app_iter, app_iter_iter)
+        length, etag = None, None
+        for name, value in headers:
+            name = name.lower()
+            if name == 'content-length':
+                length = int(value)
+            if name == 'etag':
+                etag = value
+        is_streaming = length is None or length > self.max_buffer_size
+        if is_streaming and not self.compress_streaming:
+            return self.passthrough(start_response, captured, first, app_iter, app_iter_iter)
+        if is_streaming:
+            start_response(status, self.gen_headers(headers, encoding), exc_info)
+            return self.iter_compressed(app_iter_iter, first, encoding)
+        # ETag只在同一资源内唯一,且弱ETag不保证字节相同
+        cacheable = etag and not etag.startswith('W/') and self.cache is not None
+        cache_key = (environ.get('PATH_INFO'), environ.get('QUERY_STRING'), etag, encoding) if cacheable else None
+        data = self.cache.get(cache_key) if cache_key else None
+        if data is None:
+            try:
+                body = b''.join(first) + b''.join(app_iter_iter)
+            finally:
+                close = getattr(app_iter, 'close', None)
+                close and close()
+            data = compress_bytes(body, encoding, level=self.levels.get(encoding))
+            cache_key and self.cache.set(cache_key, data)
+        else:
+            # 强ETag相同则内容相同,命中缓存时无需再读取原始响应体
+            close = getattr(app_iter, 'close', None)
+            close and close()
+        start_response(status, self.gen_headers(headers, encoding, len(data)), exc_info)
+        return [data]
+
+    @staticmethod
+    def passthrough(
+            start_response: StartResponse,
+            captured: t.List,
+            first: t.List[bytes],
+            app_iter: t.Iterable[bytes],
+            app_iter_iter: t.Iterator[bytes]
+    ) -> t.Iterable[bytes]:
+        """ 原样透传响应
+
+        @param start_response: 响应对象
+        @param captured: 暂存的状态和头部
+        @param first: 已预读的数据块
+        @param app_iter: 原始响应体
+        @param app_iter_iter: 原始响应体迭代器
+        @return: t.Iterable[bytes]
+        """
+        status, headers, exc_info = captured
+        start_response(status, headers, exc_info)
+        return CompressionMiddleware.iter_response(first, app_iter, app_iter_iter) if first else app_iter
+
+    @staticmethod
+    def iter_response(
+            first: t.List[bytes],
+            app_iter: t.Iterable[bytes],
+            app_iter_iter: t.Iterator[bytes]
+    ) -> t.Iterator[bytes]:
+        """ 先输出已预读的数据块再继续迭代原始响应体
+
+        @param first: 已预读的数据块
+        @param app_iter: 原始响应体
+        @param app_iter_iter: 原始响应体迭代器
+        @return: t.Iterator[bytes]
+        """
+        try:
+            yield from first
+            yield from app_iter_iter
+        finally:
+            close = getattr(app_iter, 'close', None)
+            close and close()
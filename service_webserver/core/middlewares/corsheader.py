@@ -4,9 +4,9 @@
 
 from __future__ import annotations
 
+import re
 import typing as t
 
-from werkzeug.datastructures import Headers
 from service_core.core.service.entrypoint import Entrypoint
 
 if t.TYPE_CHECKING:
@@ -24,6 +24,9 @@ HTTPIterHeaders = t.Iterable[t.Tuple[str, t.Union[str, int]]]
 # 响应头部
 HttpHeaders = t.Optional[t.Union[HTTPDictHeaders, HTTPIterHeaders]]
 
+# 缓存的来源和预检响应的最大数量,超出后清空重建
+DEFAULT_CORS_CACHE_MAX_ITEMS = 1024
+
 
 class CorsHeaderMiddleware(BaseMiddleware):
     """ 跨越配置中间件类 """
@@ -32,20 +35,150 @@ class CorsHeaderMiddleware(BaseMiddleware):
             self, *,
             wsgi_app: WSGIApplication,
             producer: Entrypoint,
-            headers: t.Optional[t.Dict[t.Text, t.Text]] = None
+            headers: t.Optional[t.Dict[t.Text, t.Text]] = None,
+            allow_origins: t.Optional[t.List[t.Text]] = None,
+            allow_origin_regex: t.Optional[t.Text] = None,
+            allow_methods: t.Optional[t.List[t.Text]] = None,
+            allow_headers: t.Optional[t.List[t.Text]] = None,
+            allow_credentials: bool = True,
+            expose_headers: t.Optional[t.List[t.Text]] = None,
+            max_age: int = 600
     ) -> None:
         """ 初始化实例
 
         @param wsgi_app: 应用程序
         @param producer: 服务提供者
-        @param headers: 跨域头部设置
+        @param headers: 跨域头部设置(兼容旧配置,同名选项会被覆盖)
+        @param allow_origins: 允许的来源列表,*表示任意来源,允许携带凭证时回显请求来源
+        @param allow_origin_regex: 允许的来源正则(完整匹配)
+        @param allow_methods: 允许的请求方法,*表示任意方法
+        @param allow_headers: 允许的请求头部,*表示任意头部
+        @param allow_credentials: 是否允许携带凭证
+        @param expose_headers: 暴露给前端的响应头部
+        @param max_age: 预检响应缓存秒数
         """
         super(CorsHeaderMiddleware, self).__init__(wsgi_app=wsgi_app, producer=producer)
-        self.headers = headers or {}
-        self.headers.setdefault('Access-Control-Allow-Origin', '*')
-        self.headers.setdefault('Access-Control-Allow-Credentials', 'true')
-        self.headers.setdefault('Access-Control-Allow-Headers', '*')
-        self.headers.setdefault('Access-Control-Allow-Methods', '*')
+        headers = {k.lower(): v for k, v in (headers or {}).items()}
+        split = lambda v: [i.strip() for i in v.split(',') if i.strip()]
+        origin = headers.pop('access-control-allow-origin', None)
+        allow_origins = allow_origins or (split(origin) if origin else ['*'])
+        methods = headers.pop('access-control-allow-methods', None)
+        allow_methods = allow_methods or (split(methods) if methods else ['*'])
+        allow_headers_value = headers.pop('access-control-allow-headers', None)
+        allow_headers = allow_headers or (split(allow_headers_value) if allow_headers_value else ['*'])
+        credentials = headers.pop('access-control-allow-credentials', None)
+        allow_credentials = allow_credentials if credentials is None else credentials.lower() == 'true'
+        expose = headers.pop('access-control-expose-headers', None)
+        expose_headers = expose_headers or (split(expose) if expose else [])
+        age = headers.pop('access-control-max-age', None)
+        max_age = max_age if age is None else int(age)
+        self.allow_any_origin = '*' in allow_origins
+        self.allow_origins = frozenset(o for o in allow_origins if o != '*')
+        self.allow_origin_regex = re.compile(allow_origin_regex) if allow_origin_regex else None
+        self.allow_any_method = '*' in allow_methods
+        self.allow_methods = frozenset(m.upper() for m in allow_methods)
+        self.allow_methods_value = ', '.join(m.upper() for m in allow_methods)
+        self.allow_any_header = '*' in allow_headers
+        self.allow_headers = frozenset(h.lower() for h in allow_headers)
+        self.allow_credentials = allow_credentials
+        # 其它旧配置中的自定义头部原样附加
+        self.extra_headers = [(k.title(), v) for k, v in headers.items()]
+        simple_headers = list(self.extra_headers)
+        allow_credentials and simple_headers.append(('Access-Control-Allow-Credentials', 'true'))
+        expose_headers and simple_headers.append(('Access-Control-Expose-Headers', ', '.join(expose_headers)))
+        preflight_headers = list(self.extra_headers)
+        allow_credentials and preflight_headers.append(('Access-Control-Allow-Credentials', 'true'))
+        preflight_headers.append(('Access-Control-Max-Age', str(max_age)))
+        self.simple_headers = simple_headers
+        self.preflight_headers = preflight_headers
+        # 任意来源且不携带凭证时头部与来源无关,直接复用同一份且无需Vary,携带凭证时浏览器不接受*,需回显来源
+        any_origin = self.allow_any_origin and not allow_credentials
+        self.any_origin_headers = [('Access-Control-Allow-Origin', '*')] + simple_headers if any_origin else None
+        self.origin_headers: t.Dict[t.Text, t.Optional[t.List[t.Tuple[t.Text, t.Text]]]] = {}
+        self.preflight_cache: t.Dict[t.Tuple[t.Text, t.Text, t.Text], t.Tuple[t.Text, t.List]] = {}
+
+    def is_allowed_origin(self, origin: t.Text) -> bool:
+        """ 来源是否被允许
+
+        @param origin: 请求来源
+        @return: bool
+        """
+        if self.allow_any_origin or origin in self.allow_origins:
+            return True
+        return self.allow_origin_regex is not None and self.allow_origin_regex.fullmatch(origin) is not None
+
+    def get_origin_headers(self, origin: t.Text) -> t.Optional[t.List[t.Tuple[t.Text, t.Text]]]:
+        """ 获取来源对应的预先计算的跨域头部
+
+        @param origin: 请求来源
+        @return: t.Optional[t.List[t.Tuple[t.Text, t.Text]]]
+        """
+        try:
+            return self.origin_headers[origin]
+        except KeyError:
+            pass
+        if not self.is_allowed_origin(origin):
+            headers = None
+        else:
+            headers = [('Access-Control-Allow-Origin', origin)] + self.simple_headers
+        len(self.origin_headers) >= DEFAULT_CORS_CACHE_MAX_ITEMS and self.origin_headers.clear()
+        self.origin_headers[origin] = headers
+        return headers
+
+    def get_preflight_response(
+            self,
+            origin: t.Text,
+            request_method: t.Text,
+            request_headers: t.Text
+    ) -> t.Tuple[t.Text, t.List[t.Tuple[t.Text, t.Text]]]:
+        """ 获取缓存的预检响应
+
+        @param origin: 请求来源
+        @param request_method: Access-Control-Request-Method
+        @param request_headers: Access-Control-Request-Headers
+        @return: t.Tuple[t.Text, t.List[t.Tuple[t.Text, t.Text]]]
+        """
+        cache_key = (origin, request_method, request_headers)
+        try:
+            return self.preflight_cache[cache_key]
+        except KeyError:
+            pass
+        names = [h.strip().lower() for h in request_headers.split(',') if h.strip()]
+        allowed = self.is_allowed_origin(origin)
+        if not self.allow_any_method and request_method.upper() not in self.allow_methods:
+            allowed = False
+        if not self.allow_any_header and not self.allow_headers.issuperset(names):
+            allowed = False
+        vary = ('Vary', 'Origin, Access-Control-Request-Method, Access-Control-Request-Headers')
+        if allowed:
+            allow_origin = origin if self.any_origin_headers is None else '*'
+            headers = [('Access-Control-Allow-Origin', allow_origin)] + self.preflight_headers
+            # 回显已校验过的请求方法和头部,*在携带凭证时不被浏览器接受
+            allow_methods = request_method.upper() if self.allow_any_method else self.allow_methods_value
+            headers.append(('Access-Control-Allow-Methods', allow_methods))
+            names and headers.append(('Access-Control-Allow-Headers', ', '.join(names)))
+            response = ('204 No Content', headers + [vary])
+        else:
+            response = ('403 Forbidden', [('Content-Length', '0'), vary])
+        len(self.preflight_cache) >= DEFAULT_CORS_CACHE_MAX_ITEMS and self.preflight_cache.clear()
+        self.preflight_cache[cache_key] = response
+        return response
+
+    @staticmethod
+    def add_vary_origin(headers: t.List[t.Tuple[t.Text, t.Text]]) -> None:
+        """ 原地合并Vary: Origin头部
+
+        @param headers: 响应头部
+        @return: None
+        """
+        for index, (name, value) in enumerate(headers):
+            if name.lower() != 'vary':
+                continue
+            if value.strip() == '*' or 'origin' in value.lower():
+                return
+            headers[index] = (name, f'{value}, Origin')
+            return
+        headers.append(('Vary', 'Origin'))
 
     def __call__(self, environ: WSGIEnvironment, start_response: StartResponse) -> t.Iterable[bytes]:
         """ 请求处理器
@@ -54,6 +187,19 @@ class CorsHeaderMiddleware(BaseMiddleware):
         @param start_response: 响应对象
         @return: t.Iterable[bytes]
         """
+        origin = environ.get('HTTP_ORIGIN')
+        request_method = environ.get('HTTP_ACCESS_CONTROL_REQUEST_METHOD')
+        # 预检请求直接由缓存应答,无需进入路由
+        if origin and request_method and environ['REQUEST_METHOD'] == 'OPTIONS':
+            request_headers = environ.get('HTTP_ACCESS_CONTROL_REQUEST_HEADERS', '')
+            status, headers = self.get_preflight_response(origin, request_method, request_headers)
+            start_response(status, list(headers))
+            return []
+        if self.any_origin_headers is not None:
+            cors_headers, vary = self.any_origin_headers, False
+        else:
+            # 即使来源不被允许或者没有来源也要声明Vary以免CDN缓存串用
+            cors_headers, vary = self.get_origin_headers(origin) if origin else None, True
 
         def add_cors_headers(status: t.Text, headers: HttpHeaders, exc_info: t.Optional[t.Tuple] = None):
             """ 添加跨域头部
@@ -62,9 +208,9 @@ class CorsHeaderMiddleware(BaseMiddleware):
             @param headers : 头部信息
             @param exc_info: 异常信息
             """
-            headers = Headers(headers)
-            headers.extend(**self.headers)
             headers = list(headers)
+            cors_headers and headers.extend(cors_headers)
+            vary and self.add_vary_origin(headers)
             return start_response(status, headers, exc_info)
 
         return self.wsgi_app(environ, add_cors_headers)  # type: ignore
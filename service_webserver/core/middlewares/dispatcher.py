@@ -19,6 +19,9 @@ from .base import BaseMiddleware
 class DispatcherMiddleware(BaseDispatcherMiddleware, BaseMiddleware):
     """ 请求代理中间件类 """
 
+    # 只转发挂载前缀下的请求,业务路由无需经过
+    apply_to_routes = False
+
     def __init__(self, *, wsgi_app: WSGIApplication, producer: Entrypoint, **kwargs: t.Any) -> None:
         """ 初始化实例
 
@@ -28,3 +31,10 @@ class DispatcherMiddleware(BaseDispatcherMiddleware, BaseMiddleware):
         """
         BaseDispatcherMiddleware.__init__(self, wsgi_app, **kwargs)
         BaseMiddleware.__init__(self, wsgi_app=wsgi_app, producer=producer)
+
+    def get_claimed_paths(self) -> t.Tuple[t.Iterable[t.Text], t.Iterable[t.Text]]:
+        """ 获取由中间件自身处理的路径
+
+        @return: t.Tuple[t.Iterable[t.Text], t.Iterable[t.Text]] - (完整路径, 路径前缀)
+        """
+        return self.mounts, tuple(f'{mount}/' for mount in self.mounts)
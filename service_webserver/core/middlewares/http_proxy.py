@@ -4,27 +4,407 @@
 
 from __future__ import annotations
 
+import time
 import typing as t
 
+from logging import getLogger
+from collections import deque
+from werkzeug.urls import url_parse
+from werkzeug.urls import url_quote
+from eventlet.green import socket
+from eventlet.semaphore import Semaphore
+from eventlet.green.http import client
+from werkzeug.wsgi import get_input_stream
+from werkzeug.datastructures import EnvironHeaders
+from werkzeug.exceptions import BadGateway
+from werkzeug.exceptions import GatewayTimeout
+from werkzeug.exceptions import ServiceUnavailable
+from werkzeug.http import is_hop_by_hop_header
 from service_core.core.service.entrypoint import Entrypoint
-from werkzeug.middleware.http_proxy import ProxyMiddleware as BaseProxyMiddleware
 
 if t.TYPE_CHECKING:
     # 由于其定义在存根文件所以需要在TYPE_CHECKING下
     from werkzeug.wsgi import WSGIApplication
+    from werkzeug.wsgi import WSGIEnvironment
+    from werkzeug.wrappers.response import StartResponse
 
 from .base import BaseMiddleware
 
+logger = getLogger(__name__)
 
-class HttpProxyMiddleware(BaseProxyMiddleware, BaseMiddleware):
-    """ 请求代理中间件类 """
+# 重复执行不会产生副作用的请求方法,只有这些方法在失败时可以重试
+IDEMPOTENT_METHODS = frozenset(('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE', 'TRACE'))
 
-    def __init__(self, *, wsgi_app: WSGIApplication, producer: Entrypoint, **kwargs: t.Any) -> None:
+
+class PoolExhausted(Exception):
+    """ 等待可用连接超时 """
+    pass
+
+
+class HttpConnectionPool(object):
+    """ 单个上游的保活连接池
+
+    使用中的连接数不超过max_per_host,只有空闲连接为空时才新建连接,因此总连接数也不会超过max_per_host
+    """
+
+    def __init__(
+            self,
+            target: t.Text,
+            ssl_context: t.Any = None,
+            connect_timeout: float = 3.0,
+            read_timeout: float = 10.0,
+            max_idle: int = 16,
+            max_per_host: int = 128,
+            idle_timeout: float = 30.0,
+            pool_timeout: float = 3.0
+    ) -> None:
+        """ 初始化实例
+
+        @param target: 上游地址
+        @param ssl_context: https上游的ssl上下文
+        @param connect_timeout: 连接超时秒数
+        @param read_timeout: 读写超时秒数
+        @param max_idle: 最多保留的空闲连接数
+        @param max_per_host: 最多同时使用的连接数
+        @param idle_timeout: 空闲连接的最长保留秒数,应小于上游的keep-alive超时
+        @param pool_timeout: 等待可用连接的超时秒数
+        """
+        url = url_parse(target)
+        if url.scheme not in ('http', 'https'):
+            raise ValueError(f"target scheme must be 'http' or 'https', got {url.scheme!r}")
+        self.scheme = url.scheme
+        self.host = url.ascii_host
+        self.port = url.port or (443 if url.scheme == 'https' else 80)
+        self.ssl_context = ssl_context
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.pool_timeout = pool_timeout
+        # 空闲连接 - [(连接, 归还时间)],后进先出以便较旧的连接自然过期
+        self.idle: t.Deque[t.Tuple[client.HTTPConnection, float]] = deque()
+        self.semaphore = Semaphore(max_per_host)
+        self.stats = {'created': 0, 'reused': 0, 'discarded': 0}
+
+    def new_connection(self) -> client.HTTPConnection:
+        """ 新建连接
+
+        @return: client.HTTPConnection
+        """
+        if self.scheme == 'https':
+            conn = client.HTTPSConnection(
+                self.host, self.port, timeout=self.connect_timeout, context=self.ssl_context
+            )
+        else:
+            conn = client.HTTPConnection(self.host, self.port, timeout=self.connect_timeout)
+        conn.connect()
+        conn.sock.settimeout(self.read_timeout)
+        self.stats['created'] += 1
+        return conn
+
+    def acquire(self) -> t.Tuple[client.HTTPConnection, bool]:
+        """ 取出一个连接
+
+        @return: t.Tuple[client.HTTPConnection, bool] (连接, 是否为复用的连接)
+        """
+        if not self.semaphore.acquire(timeout=self.pool_timeout):
+            raise PoolExhausted(f'no available connection to {self.host}:{self.port}')
+        now = time.monotonic()
+        while self.idle:
+            conn, released_time = self.idle.pop()
+            if now - released_time < self.idle_timeout:
+                self.stats['reused'] += 1
+                return conn, True
+            conn.close()
+        try:
+            return self.new_connection(), False
+        except BaseException:
+            self.semaphore.release()
+            raise
+
+    def release(self, conn: client.HTTPConnection, reusable: bool) -> None:
+        """ 归还连接
+
+        @param conn: 连接对象
+        @param reusable: 是否可以复用
+        @return: None
+        """
+        if reusable and len(self.idle) < self.max_idle:
+            self.idle.append((conn, time.monotonic()))
+        else:
+            self.stats['discarded'] += 1
+            conn.close()
+        self.semaphore.release()
+
+    def close(self) -> None:
+        """ 关闭所有空闲连接
+
+        @return: None
+        """
+        while self.idle:
+            self.idle.pop()[0].close()
+
+
+class UpstreamResponse(object):
+    """ 流式转发上游响应体,读完后归还连接 """
+
+    def __init__(
+            self,
+            pool: HttpConnectionPool,
+            conn: client.HTTPConnection,
+            response: client.HTTPResponse,
+            chunk_size: int
+    ) -> None:
+        """ 初始化实例
+
+        @param pool: 连接池
+        @param conn: 连接对象
+        @param response: 上游响应
+        @param chunk_size: 每次读取的最大字节数
+        """
+        self.pool = pool
+        self.conn = conn
+        self.response = response
+        self.chunk_size = chunk_size
+        self.released = False
+
+    def __iter__(self) -> t.Iterator[bytes]:
+        """ 逐块读取上游响应体
+
+        @return: t.Iterator[bytes]
+        """
+        try:
+            while True:
+                # read1有数据就返回,不会为凑满chunk_size而阻塞
+                data = self.response.read1(self.chunk_size)
+                if not data:
+                    break
+                yield data
+        except (OSError, client.HTTPException) as e:
+            # 响应头部已经发出,只能中断连接让客户端感知
+            logger.warning(f'proxy response from {self.pool.host}:{self.pool.port} interrupted, {e}')
+            self.response.close()
+            raise
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        """ 归还连接,客户端提前断开时上游响应未读完,连接不可复用
+
+        @return: None
+        """
+        if self.released:
+            return
+        self.released = True
+        # 按Content-Length读完时http.client不会自动关闭响应,需要根据剩余长度判断
+        finished = self.response.isclosed() or self.response.length == 0
+        reusable = finished and not self.response.will_close
+        # 关闭响应只释放其文件对象,连接在响应关闭后才能发送下一个请求
+        self.response.close()
+        self.pool.release(self.conn, reusable)
+
+
+class HttpProxyMiddleware(BaseMiddleware):
+    """ 请求代理中间件类
+
+    与werkzeug.middleware.http_proxy.ProxyMiddleware的targets配置兼容,但复用上游连接且双向流式转发
+    """
+
+    # 只转发挂载前缀下的请求,业务路由无需经过
+    apply_to_routes = False
+
+    def __init__(
+            self, *,
+            wsgi_app: WSGIApplication,
+            producer: Entrypoint,
+            targets: t.Dict[t.Text, t.Dict[t.Text, t.Any]],
+            chunk_size: int = 2 << 13,
+            timeout: float = 10,
+            connect_timeout: float = 3,
+            max_idle: int = 16,
+            max_per_host: int = 128,
+            idle_timeout: float = 30,
+            pool_timeout: float = 3,
+            retries: int = 1
+    ) -> None:
         """ 初始化实例
 
         @param wsgi_app: 应用程序
         @param producer: 服务提供者
-        @param kwargs: 命名参数
+        @param targets: 路径前缀到上游配置的映射,上游配置支持target/remove_prefix/host/headers/ssl_context
+        @param chunk_size: 每次转发的最大字节数
+        @param timeout: 读写上游的超时秒数
+        @param connect_timeout: 连接上游的超时秒数
+        @param max_idle: 每个上游最多保留的空闲连接数
+        @param max_per_host: 每个上游最多同时使用的连接数
+        @param idle_timeout: 空闲连接的最长保留秒数
+        @param pool_timeout: 等待可用连接的超时秒数
+        @param retries: 幂等且没有请求体的请求在发出前或读取响应头部失败时的重试次数
+        """
+        super(HttpProxyMiddleware, self).__init__(wsgi_app=wsgi_app, producer=producer)
+        self.targets = {}
+        self.pools: t.Dict[t.Text, HttpConnectionPool] = {}
+        for prefix, opts in targets.items():
+            opts = dict(opts)
+            opts.setdefault('remove_prefix', False)
+            opts.setdefault('host', '<auto>')
+            opts.setdefault('headers', {})
+            opts.setdefault('ssl_context', None)
+            prefix = f"/{prefix.strip('/')}/"
+            self.targets[prefix] = opts
+            self.pools[prefix] = HttpConnectionPool(
+                opts['target'], ssl_context=opts['ssl_context'],
+                connect_timeout=connect_timeout, read_timeout=timeout,
+                max_idle=max_idle, max_per_host=max_per_host,
+                idle_timeout=idle_timeout, pool_timeout=pool_timeout
+            )
+        self.chunk_size = chunk_size
+        self.retries = retries
+
+    def get_claimed_paths(self) -> t.Tuple[t.Iterable[t.Text], t.Iterable[t.Text]]:
+        """ 获取由中间件自身处理的路径
+
+        @return: t.Tuple[t.Iterable[t.Text], t.Iterable[t.Text]] - (完整路径, 路径前缀)
+        """
+        return (), tuple(self.targets)
+
+    def stop(self) -> None:
+        """ 生命周期 - 停止阶段
+
+        @return: None
+        """
+        for pool in self.pools.values():
+            pool.close()
+
+    def get_upstream_headers(
+            self,
+            environ: WSGIEnvironment,
+            opts: t.Dict[t.Text, t.Any],
+            pool: HttpConnectionPool
+    ) -> t.Tuple[t.List[t.Tuple[t.Text, t.Text]], bool]:
+        """ 生成发往上游的请求头部
+
+        @param environ: 环境对象
+        @param opts: 上游配置
+        @param pool: 连接池
+        @return: t.Tuple[t.List[t.Tuple[t.Text, t.Text]], bool] (头部, 请求体是否分块)
+        """
+        headers = [
+            (k, v) for k, v in EnvironHeaders(environ).items()
+            if not is_hop_by_hop_header(k) and k.lower() not in ('content-length', 'host')
+        ]
+        headers.append(('Connection', 'keep-alive'))
+        if opts['host'] == '<auto>':
+            default_port = 443 if pool.scheme == 'https' else 80
+            headers.append(('Host', pool.host if pool.port == default_port else f'{pool.host}:{pool.port}'))
+        elif opts['host'] is None:
+            headers.append(('Host', environ['HTTP_HOST']))
+        else:
+            headers.append(('Host', opts['host']))
+        headers.extend(opts['headers'].items())
+        content_length = environ.get('CONTENT_LENGTH')
+        chunked = 'chunked' in environ.get('HTTP_TRANSFER_ENCODING', '').lower()
+        if chunked:
+            headers.append(('Transfer-Encoding', 'chunked'))
+        elif content_length:
+            headers.append(('Content-Length', content_length))
+        return headers, chunked
+
+    def send_request(
+            self,
+            conn: client.HTTPConnection,
+            environ: WSGIEnvironment,
+            url: t.Text,
+            headers: t.List[t.Tuple[t.Text, t.Text]],
+            chunked: bool
+    ) -> client.HTTPResponse:
+        """ 流式发送请求并读取响应头部
+
+        @param conn: 连接对象
+        @param environ: 环境对象
+        @param url: 上游路径
+        @param headers: 请求头部
+        @param chunked: 请求体是否分块
+        @return: client.HTTPResponse
+        """
+        conn.putrequest(environ['REQUEST_METHOD'], url, skip_host=True, skip_accept_encoding=True)
+        for name, value in headers:
+            conn.putheader(name, value)
+        conn.endheaders()
+        # 分块上传时werkzeug会因没有Content-Length而返回空流,此时直接读取由服务器解码后的输入
+        stream = environ['wsgi.input'] if chunked else get_input_stream(environ)
+        while True:
+            data = stream.read(self.chunk_size)
+            if not data:
+                break
+            conn.send(b'%x\r\n%s\r\n' % (len(data), data) if chunked else data)
+        chunked and conn.send(b'0\r\n\r\n')
+        return conn.getresponse()
+
+    def proxy_to(
+            self,
+            prefix: t.Text,
+            environ: WSGIEnvironment,
+            start_response: StartResponse
+    ) -> t.Iterable[bytes]:
+        """ 转发到上游
+
+        @param prefix: 路径前缀
+        @param environ: 环境对象
+        @param start_response: 响应对象
+        @return: t.Iterable[bytes]
+        """
+        opts, pool = self.targets[prefix], self.pools[prefix]
+        headers, chunked = self.get_upstream_headers(environ, opts, pool)
+        remote_path = environ['PATH_INFO']
+        if opts['remove_prefix']:
+            remote_path = remote_path[len(prefix):].lstrip('/')
+            remote_path = f"{url_parse(opts['target']).path.rstrip('/')}/{remote_path}"
+        url = url_quote(remote_path)
+        query_string = environ.get('QUERY_STRING')
+        url = f'{url}?{query_string}' if query_string else url
+        has_body = chunked or environ.get('CONTENT_LENGTH') not in (None, '', '0')
+        # 请求体只能读取一次,因此只有幂等且没有请求体的请求可以重试
+        retryable = environ['REQUEST_METHOD'] in IDEMPOTENT_METHODS and not has_body
+        attempts = 1 + (self.retries if retryable else 0)
+        for attempt in range(attempts):
+            try:
+                conn, reused = pool.acquire()
+            except PoolExhausted as e:
+                logger.warning(f'proxy {remote_path} failed, {e}')
+                return ServiceUnavailable()(environ, start_response)
+            except socket.timeout as e:
+                logger.warning(f'proxy {remote_path} connect timeout, {e}')
+                return GatewayTimeout()(environ, start_response)
+            except OSError as e:
+                logger.warning(f'proxy {remote_path} connect failed, {e}')
+                return BadGateway()(environ, start_response)
+            try:
+                response = self.send_request(conn, environ, url, headers, chunked)
+            except (OSError, client.HTTPException) as e:
+                pool.release(conn, reusable=False)
+                # 复用的连接可能已被上游关闭,可重试时换一个连接再试
+                if attempt + 1 < attempts:
+                    logger.debug(f'proxy {remote_path} failed on {"reused" if reused else "new"} connection, retry')
+                    continue
+                logger.warning(f'proxy {remote_path} failed, {e}')
+                if isinstance(e, socket.timeout):
+                    return GatewayTimeout()(environ, start_response)
+                return BadGateway()(environ, start_response)
+            break
+        response_headers = [(k.title(), v) for k, v in response.getheaders() if not is_hop_by_hop_header(k)]
+        start_response(f'{response.status} {response.reason}', response_headers)
+        return UpstreamResponse(pool, conn, response, self.chunk_size)
+
+    def __call__(self, environ: WSGIEnvironment, start_response: StartResponse) -> t.Iterable[bytes]:
+        """ 请求处理器
+
+        @param environ: 环境对象
+        @param start_response: 响应对象
+        @return: t.Iterable[bytes]
         """
-        BaseProxyMiddleware.__init__(self, wsgi_app, **kwargs)
-        BaseMiddleware.__init__(self, wsgi_app=wsgi_app, producer=producer)
+        path = environ['PATH_INFO']
+        for prefix in self.targets:
+            if path.startswith(prefix):
+                return self.proxy_to(prefix, environ, start_response)
+        return self.wsgi_app(environ, start_response)
@@ -0,0 +1,87 @@
+#! -*- coding: utf-8 -*-
+#
+# author: forcemain@163.com
+
+from __future__ import annotations
+
+import typing as t
+
+from service_webserver.core.response import JsonResponse
+from service_webserver.core.response import PlainTextResponse
+from service_core.core.service.entrypoint import Entrypoint
+
+if t.TYPE_CHECKING:
+    # 由于其定义在存根文件所以需要在TYPE_CHECKING下
+    from werkzeug.wsgi import WSGIApplication
+    from werkzeug.wsgi import WSGIEnvironment
+    from werkzeug.wrappers.response import StartResponse
+
+from .base import BaseMiddleware
+
+# Prometheus文本格式的内容类型
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """ 指标中间件类
+
+    指标由WsgiApp和ReqConsumer写入ReqProducer.metrics,中间件只负责开启统计并以Prometheus文本格式导出
+    """
+
+    # 统计由WsgiApp完成,中间件只提供导出接口,业务路由无需经过
+    apply_to_routes = False
+
+    def __init__(
+            self, *,
+            wsgi_app: WSGIApplication,
+            producer: Entrypoint,
+            metrics_url: t.Text = '/metrics',
+            metrics_token: t.Optional[t.Text] = None,
+            buckets: t.Optional[t.List[float]] = None
+    ) -> None:
+        """ 初始化实例
+
+        @param wsgi_app: 应用程序
+        @param producer: 服务提供者
+        @param metrics_url: 导出接口地址
+        @param metrics_token: 导出接口令牌,通过Authorization: Bearer传入,未设置时不校验
+        @param buckets: 延迟直方图的桶上限(秒),默认为DEFAULT_LATENCY_BUCKETS
+        """
+        super(MetricsMiddleware, self).__init__(wsgi_app=wsgi_app, producer=producer)
+        self.metrics_url = metrics_url
+        self.metrics_token = metrics_token
+        self.buckets = buckets
+
+    def get_claimed_paths(self) -> t.Tuple[t.Iterable[t.Text], t.Iterable[t.Text]]:
+        """ 获取由中间件自身处理的路径
+
+        @return: t.Tuple[t.Iterable[t.Text], t.Iterable[t.Text]] - (完整路径, 路径前缀)
+        """
+        return (self.metrics_url,), ()
+    def start(self) -> None:
+        """ 生命周期 - 启动阶段
+
+        @return: None
+        """
+        self.producer.metrics.enable(self.buckets)
+
+    def stop(self) -> None:
+        """ 生命周期 - 停止阶段
+
+        @return: None
+        """
+        self.producer.metrics.disable()
+
+    def __call__(self, environ: WSGIEnvironment, start_response: StartResponse) -> t.Iterable[bytes]:
+        """ 请求处理器
+
+        @param environ: 环境对象
+        @param start_response: 响应对象
+        @return: t.Iterable[bytes]
+        """
+        if environ.get('PATH_INFO') != self.metrics_url:
+            return self.wsgi_app(environ, start_response)
+        if self.metrics_token is not None and environ.get('HTTP_AUTHORIZATION') != f'Bearer {self.metrics_token}':
+            return JsonResponse({'error': 'forbidden'}, status=403)(environ, start_response)
+        response = PlainTextResponse(self.producer.metrics.render(), content_type=PROMETHEUS_CONTENT_TYPE)
+        return response(environ, start_response)
@@ -4,12 +4,20 @@
 
 from __future__ import annotations
 
+import os
+import time
 import typing as t
 
-from werkzeug.wrappers import Request
+from eventlet import tpool
+from logging import getLogger
+from service_green.core.green import cjson
 from service_core.core.decorator import AsLazyProperty
+from service_webserver.core.metrics import format_float
+from service_webserver.core.response import StaticResponse
+from service_webserver.core.response import PrecompressedResponse
 from service_core.core.service.entrypoint import Entrypoint
 from service_webserver.core.middlewares.base import BaseMiddleware
+from service_webserver.constants import OPENAPI3_CACHE_PATH_ENV_KEY
 from service_webserver.core.openapi3.generate.assets import get_redoc_html
 from service_webserver.core.openapi3.generate.assets import get_swagger_ui_html
 from service_webserver.core.openapi3.generate.assets import get_swagger_ui_oauth2_redirect_html
@@ -20,12 +28,25 @@ if t.TYPE_CHECKING:
     from werkzeug.wsgi import WSGIEnvironment
     from werkzeug.wrappers.response import StartResponse
 
-from .generate import get_openapi_json
+from .cache import load_openapi_cache
+from .cache import dump_openapi_cache
+from .generate import OpenApiGenerator
+from .split import get_openapi_index
+from .split import get_tag_openapi_data
+from .cache import get_openapi_fingerprint
+
+logger = getLogger(__name__)
+
+# 拆分文档 - (文档数据, 标签集合, 标签文档索引响应)
+OpenApiSplit = t.Tuple[t.Dict[t.Text, t.Any], t.FrozenSet[t.Text], PrecompressedResponse]
 
 
 class OpenApi3Middleware(BaseMiddleware):
     """ OpenApi3 中间件类 """
 
+    # 只响应文档相关的地址,业务路由无需经过
+    apply_to_routes = False
+
     def __init__(
             self, *, wsgi_app: WSGIApplication, producer: Entrypoint,
             title: t.Text = '', description: t.Text = '',
@@ -38,7 +59,13 @@ class OpenApi3Middleware(BaseMiddleware):
             swagger_url: t.Optional[t.Text] = '/swagger',
             swagger_ui_oauth2_init: t.Optional[t.Dict[t.Text, t.Any]] = None,
             swagger_ui_oauth2_redirect_url: t.Optional[t.Text] = '/swagger/oauth2-redirect',
-            servers: t.Optional[t.List[t.Dict[t.Text: t.Union[t.Text, t.Any]]]] = None
+            servers: t.Optional[t.List[t.Dict[t.Text: t.Union[t.Text, t.Any]]]] = None,
+            cache_control: t.Optional[t.Text] = 'no-cache',
+            cache_path: t.Optional[t.Text] = None,
+            retry_after: int = 5,
+            split_by_tag: bool = False,
+            tag_url_prefix: t.Text = '/openapi3/',
+            tag_index_url: t.Text = '/openapi3/index.json'
     ) -> None:
         """ 初始化实例
 
@@ -56,6 +83,12 @@ class OpenApi3Middleware(BaseMiddleware):
         @param redoc_url: redoc文档的url地址
         @param swagger_url: swagger文档地址
         @param servers: 下拉选择的目标服务器
+        @param cache_control: 文档响应的Cache-Control,默认每次通过ETag协商
+        @param cache_path: 文档缓存文件路径,设置后启动时按路由指纹载入或生成
+        @param retry_after: 文档生成期间503响应的Retry-After秒数
+        @param split_by_tag: 是否按标签拆分文档,文档页面通过索引切换标签文档
+        @param tag_url_prefix: 标签文档地址前缀,地址为{tag_url_prefix}{tag}.json
+        @param tag_index_url: 标签文档索引地址,与标签文档地址相同时索引优先
         """
         self._title = title
         self._description = description
@@ -69,6 +102,28 @@ class OpenApi3Middleware(BaseMiddleware):
         self.openapi_url = openapi_url
         self.swagger_ui_oauth2_init = swagger_ui_oauth2_init
         self.swagger_ui_oauth2_redirect_url = swagger_ui_oauth2_redirect_url
+        self.cache_control = cache_control
+        # 用于快速判断是否为文档地址
+        self.doc_urls = frozenset((redoc_url, swagger_url, openapi_url))
+        self.cache_path = os.environ.get(OPENAPI3_CACHE_PATH_ENV_KEY) or cache_path
+        self.split_by_tag = split_by_tag
+        self.tag_url_prefix = tag_url_prefix
+        self.tag_index_url = tag_index_url
+        # 按路由缓存文档片段,重新生成时只计算变化的部分
+        self.generator = OpenApiGenerator()
+        # 文档在后台生成完成之前为None
+        self.openapi_json = None
+        self.openapi_json_response = None
+        self.generating = False
+        # 标签文档在首次访问时由完整文档拆分生成
+        self.openapi_split: t.Optional[OpenApiSplit] = None
+        self.tag_responses: t.Dict[t.Text, PrecompressedResponse] = {}
+        # 文档生成的统计信息,启用MetricsMiddleware时导出为openapi_generate_*指标
+        self.openapi_stats = {'generate_count': 0, 'generate_errors': 0, 'generate_seconds': 0.0}
+        headers = {'Retry-After': str(retry_after), 'Cache-Control': 'no-store'}
+        self.unavailable_response = StaticResponse(
+            'openapi3 document is being generated', status=503, headers=headers, mimetype='text/plain'
+        )
         super(OpenApi3Middleware, self).__init__(wsgi_app=wsgi_app, producer=producer)
 
     @AsLazyProperty
@@ -81,13 +136,19 @@ class OpenApi3Middleware(BaseMiddleware):
         """ 文档描述 """
         return self._description or self.producer.container.service.desc
 
+    @AsLazyProperty
+    def openapi_index_url(self) -> t.Optional[t.Text]:
+        """ 文档页面使用的标签文档索引地址 """
+        return f'{self.root_path}{self.tag_index_url}' if self.split_by_tag else None
+
     @AsLazyProperty
     def redoc_ui_html(self) -> t.Text:
         """ redoc网页 """
         openapi_url = f'{self.root_path}{self.openapi_url}'
         return get_redoc_html(
             openapi_url=openapi_url,
-            title=self.title + ' - Redoc'
+            title=self.title + ' - Redoc',
+            openapi_index_url=self.openapi_index_url
         )
 
     @AsLazyProperty
@@ -98,7 +159,8 @@ class OpenApi3Middleware(BaseMiddleware):
             openapi_url=openapi_url,
             title=self.title + ' - Swagger UI',
             oauth2_init=self.swagger_ui_oauth2_init,
-            oauth2_redirect_url=self.swagger_ui_oauth2_redirect_url
+            oauth2_redirect_url=self.swagger_ui_oauth2_redirect_url,
+            openapi_index_url=self.openapi_index_url
         )
 
     @AsLazyProperty
@@ -107,19 +169,221 @@ class OpenApi3Middleware(BaseMiddleware):
         return get_swagger_ui_oauth2_redirect_html()
 
     @AsLazyProperty
-    def openapi_json(self) -> t.Text:
-        """ /openapi.json内容 """
-        routers = self.producer.all_extensions
-        return get_openapi_json(
-            title=self.title,
-            routers=routers,
-            description=self.description,
-            version=self.version,
-            api_tags=self.api_tags,
-            servers=self.servers,
-            openapi_version=self.openapi_version,
-            root_path=self.root_path,
+    def openapi_options(self) -> t.Dict[t.Text, t.Any]:
+        """ 文档选项 """
+        return {
+            'title': self.title,
+            'description': self.description,
+            'version': self.version,
+            'api_tags': self.api_tags,
+            'servers': self.servers,
+            'openapi_version': self.openapi_version,
+            'root_path': self.root_path,
+        }
+
+    def build_openapi_json(
+            self,
+            routers: t.List[t.Any],
+            options: t.Dict[t.Text, t.Any]
+    ) -> t.Tuple[t.Text, PrecompressedResponse, t.Optional[t.Text]]:
+        """ 生成文档及其预压缩响应
+
+        注意: 在系统线程中执行,不能使用协程相关的对象,也不记录日志
+
+        @param routers: 路由列表
+        @param options: 文档选项
+        @return: t.Tuple[t.Text, PrecompressedResponse, t.Optional[t.Text]]
+        """
+        note, document = None, None
+        if self.cache_path:
+            # 路由/签名/模型均未变化时直接复用缓存的文档
+            fingerprint = get_openapi_fingerprint(routers, **options)
+            document = load_openapi_cache(self.cache_path, fingerprint)
+            note = f'load openapi3 cache {self.cache_path} succ' if document is not None else None
+            if document is None:
+                document = self.generator.generate(routers=routers, **options)
+                try:
+                    dump_openapi_cache(self.cache_path, fingerprint, document)
+                    note = f'dump openapi3 cache {self.cache_path} succ'
+                except OSError as e:
+                    note = f'dump openapi3 cache {self.cache_path} failed, {e}'
+        else:
+            document = self.generator.generate(routers=routers, **options)
+        headers = {'Content-Type': 'application/json'}
+        response = PrecompressedResponse(document, headers=headers, cache_control=self.cache_control)
+        return document, response, note
+
+    def generate_openapi_json(self) -> None:
+        """ 在系统线程中生成文档,避免阻塞处理其它请求的协程
+
+        @return: None
+        """
+        routers = list(self.producer.all_extensions)
+        start_time = time.monotonic()
+        try:
+            options = self.openapi_options
+            document, response, note = tpool.execute(self.build_openapi_json, routers, options)
+        except Exception:
+            self.openapi_stats['generate_errors'] += 1
+            # 生成失败时保持503,下次访问文档时会再次尝试
+            logger.error(f'generate openapi3 document failed', exc_info=True)
+            return
+        finally:
+            self.generating = False
+        cost_seconds = time.monotonic() - start_time
+        self.openapi_stats['generate_count'] += 1
+        self.openapi_stats['generate_seconds'] = cost_seconds
+        self.openapi_json, self.openapi_json_response = document, response
+        # 标签文档由新文档重新拆分
+        self.openapi_split = None
+        self.tag_responses.clear()
+        note and logger.debug(note)
+        logger.debug(f'generate openapi3 document with {len(routers)} routers in {cost_seconds:.3f}s')
+
+    def spawn_generate_openapi_json(self) -> None:
+        """ 创建生成文档的协程
+
+        @return: None
+        """
+        if self.generating:
+            return
+        self.generating = True
+        tid = f'{self}.self_generate_openapi_json'
+        self.producer.container.spawn_splits_thread(self.generate_openapi_json, tid=tid)
+
+    def start(self) -> None:
+        """ 生命周期 - 启动阶段
+
+        @return: None
+        """
+        self.producer.metrics.collectors.append(self.render_metrics)
+        self.spawn_generate_openapi_json()
+
+    def stop(self) -> None:
+        """ 生命周期 - 停止阶段
+
+        @return: None
+        """
+        collectors = self.producer.metrics.collectors
+        self.render_metrics in collectors and collectors.remove(self.render_metrics)
+
+    def render_metrics(self, lines: t.List[t.Text]) -> None:
+        """ 按Prometheus文本格式导出文档生成的统计信息
+
+        @param lines: 输出行
+        @return: None
+        """
+        stats = self.openapi_stats
+        metrics = (
+            ('openapi_generate_total', 'counter', 'Successful OpenAPI document generations.',
+             stats['generate_count']),
+            ('openapi_generate_errors_total', 'counter', 'Failed OpenAPI document generations.',
+             stats['generate_errors']),
+            ('openapi_generate_seconds', 'gauge', 'Duration of the latest successful OpenAPI document generation.',
+             format_float(stats['generate_seconds'])),
         )
+        for name, kind, help_text, value in metrics:
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            lines.append(f'{name} {value}')
+
+    def build_openapi_split(self, document: t.Text) -> OpenApiSplit:
+        """ 解析文档并生成标签文档索引的响应
+
+        注意: 在系统线程中执行,不能使用协程相关的对象,也不记录日志
+
+        @param document: 文档内容
+        @return: OpenApiSplit
+        """
+        data = cjson.loads(document)
+        index = get_openapi_index(data, f'{self.root_path}{self.tag_url_prefix}')
+        tags = frozenset(u['name'] for u in index['urls'])
+        headers = {'Content-Type': 'application/json'}
+        response = PrecompressedResponse(cjson.dumps(index), headers=headers, cache_control=self.cache_control)
+        return data, tags, response
+
+    def build_tag_response(self, data: t.Dict[t.Text, t.Any], tag: t.Text) -> PrecompressedResponse:
+        """ 生成标签文档的预压缩响应
+
+        注意: 在系统线程中执行,不能使用协程相关的对象,也不记录日志
+
+        @param data: 文档数据
+        @param tag: 标签名称
+        @return: PrecompressedResponse
+        """
+        tag_data = get_tag_openapi_data(data, tag)
+        headers = {'Content-Type': 'application/json'}
+        return PrecompressedResponse(cjson.dumps(tag_data), headers=headers, cache_control=self.cache_control)
+
+    def get_claimed_paths(self) -> t.Tuple[t.Iterable[t.Text], t.Iterable[t.Text]]:
+        """ 获取由中间件自身处理的路径
+
+        @return: t.Tuple[t.Iterable[t.Text], t.Iterable[t.Text]] - (完整路径, 路径前缀)
+        """
+        if not self.split_by_tag:
+            return self.doc_urls, ()
+        return self.doc_urls.union((self.tag_index_url,)), (self.tag_url_prefix,)
+
+    def is_tag_url(self, path: t.Text) -> bool:
+        """ 是否为标签文档或其索引地址
+
+        @param path: 请求路径
+        @return: bool
+        """
+        if not self.split_by_tag:
+            return False
+        return path == self.tag_index_url or (path.startswith(self.tag_url_prefix) and path.endswith('.json'))
+
+    def handle_tag_request(
+            self,
+            path: t.Text,
+            environ: WSGIEnvironment,
+            start_response: StartResponse
+    ) -> t.Iterable[bytes]:
+        """ 处理标签文档或其索引的请求
+
+        解析和拆分大文档较慢,因此在系统线程中执行,只阻塞当前请求的协程
+
+        @param path: 请求路径
+        @param environ: 环境对象
+        @param start_response: 响应对象
+        @return: t.Iterable[bytes]
+        """
+        document = self.openapi_json
+        if document is None:
+            self.spawn_generate_openapi_json()
+            return self.unavailable_response(environ, start_response)
+        openapi_split = self.openapi_split
+        if openapi_split is None:
+            openapi_split = tpool.execute(self.build_openapi_split, document)
+            # 解析期间文档可能已被重新生成,此时只用于本次请求
+            document is self.openapi_json and setattr(self, 'openapi_split', openapi_split)
+        data, tags, index_response = openapi_split
+        if path == self.tag_index_url:
+            return index_response(environ, start_response)
+        # PATH_INFO为按latin-1解码的原始字节
+        raw_tag = path[len(self.tag_url_prefix):-len('.json')]
+        tag = raw_tag.encode('latin-1').decode('utf-8', errors='replace')
+        # 只拆分索引中存在的标签,避免任意路径占用缓存
+        if tag not in tags:
+            return self.wsgi_app(environ, start_response)
+        response = self.tag_responses.get(tag)
+        if response is None:
+            response = tpool.execute(self.build_tag_response, data, tag)
+            openapi_split is self.openapi_split and self.tag_responses.setdefault(tag, response)
+        return response(environ, start_response)
+
+    @AsLazyProperty
+    def redoc_ui_response(self) -> PrecompressedResponse:
+        """ redoc网页响应 """
+        headers = {'Content-Type': 'text/html; charset=utf-8'}
+        return PrecompressedResponse(self.redoc_ui_html, headers=headers, cache_control=self.cache_control)
+
+    @AsLazyProperty
+    def swagger_ui_response(self) -> PrecompressedResponse:
+        """ swagger网页响应 """
+        headers = {'Content-Type': 'text/html; charset=utf-8'}
+        return PrecompressedResponse(self.swagger_ui_html, headers=headers, cache_control=self.cache_control)
 
     def __call__(self, environ: WSGIEnvironment, start_response: StartResponse) -> t.Iterable[bytes]:
         """ 请求处理器
@@ -128,14 +392,17 @@ class OpenApi3Middleware(BaseMiddleware):
         @param start_response: 响应对象
         @return: t.Iterable[bytes]
         """
-        request = Request(environ)
-        if request.path == self.redoc_url:
-            start_response('200 Ok', [('Content-Type', 'text/html')])
-            return [self.redoc_ui_html]
-        if request.path == self.swagger_url:
-            start_response('200 Ok', [('Content-Type', 'text/html')])
-            return [self.swagger_ui_html]
-        if request.path == self.openapi_url:
-            start_response('200 Ok', [('Content-Type', 'application/json')])
-            return [self.openapi_json]
-        return self.wsgi_app(environ, start_response)
+        path = environ.get('PATH_INFO') or '/'
+        if path not in self.doc_urls:
+            if self.is_tag_url(path):
+                return self.handle_tag_request(path, environ, start_response)
+            return self.wsgi_app(environ, start_response)
+        if path == self.redoc_url:
+            return self.redoc_ui_response(environ, start_response)
+        if path == self.swagger_url:
+            return self.swagger_ui_response(environ, start_response)
+        if self.openapi_json_response is not None:
+            return self.openapi_json_response(environ, start_response)
+        # 未随服务启动或者上次生成失败时在后台重新生成
+        self.spawn_generate_openapi_json()
+        return self.unavailable_response(environ, start_response)
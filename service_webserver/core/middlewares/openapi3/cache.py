@@ -0,0 +1,214 @@
+#! -*- coding: utf-8 -*-
+#
+# author: forcemain@163.com
+
+from __future__ import annotations
+
+import os
+import re
+import sys
+import enum
+import inspect
+import hashlib
+import functools
+import pydantic
+import typing as t
+
+from pydantic import BaseModel
+from service_webserver.constants import OPENAPI3_CACHE_FORMAT_VERSION
+from service_webserver.core.entrypoints.webserver.consumer import ReqConsumer
+from service_webserver.core.openapi3.generate.depent.typed import get_typed_signature
+
+# 递归生成指纹时的最大深度,防止对象之间循环引用
+DEFAULT_FINGERPRINT_MAX_DEPTH = 8
+# 生成依赖时会被回写的参数属性,不参与指纹计算
+DEFAULT_FINGERPRINT_SKIP_ATTRS = frozenset(('in_',))
+# 默认repr中的内存地址,在不同进程中不同
+MEMORY_ADDRESS_PATTERN = re.compile(r'(\s+at)?\s+0x[0-9a-fA-F]{8,}')
+
+
+def get_object_attrs(value: t.Any) -> t.Optional[t.Dict[t.Text, t.Any]]:
+    """ 获取对象的公开属性,包括__slots__中声明的属性
+
+    @param value: 任意对象
+    @return: t.Optional[t.Dict[t.Text, t.Any]]
+    """
+    attrs = dict(getattr(value, '__dict__', None) or {})
+    for cls in type(value).__mro__:
+        slots = getattr(cls, '__slots__', ())
+        for name in (slots,) if isinstance(slots, str) else slots:
+            hasattr(value, name) and attrs.setdefault(name, getattr(value, name))
+    attrs = {k: v for k, v in attrs.items() if not k.startswith('_') and k not in DEFAULT_FINGERPRINT_SKIP_ATTRS}
+    return attrs or None
+
+
+def get_qualified_name(value: t.Any) -> t.Text:
+    """ 获取对象的限定名称,自身没有时使用其类型的限定名称
+
+    注意: 默认的repr包含内存地址,在不同进程中不同,不能用于指纹
+
+    @param value: 任意对象
+    @return: t.Text
+    """
+    module, qualname = getattr(value, '__module__', None), getattr(value, '__qualname__', None)
+    if isinstance(module, str) and isinstance(qualname, str):
+        return f'{module}.{qualname}'
+    return f'{type(value).__module__}.{type(value).__qualname__}'
+
+
+def get_repr_fingerprint(value: t.Any) -> t.Text:
+    """ 生成没有公开属性的对象的指纹文本
+
+    如datetime/Decimal/UUID/哨兵对象等,其值只体现在repr中,去除其中的内存地址后使用
+
+    @param value: 任意对象
+    @return: t.Text
+    """
+    try:
+        text = repr(value)
+    except Exception:
+        return f'{get_qualified_name(value)}()'
+    return f'{get_qualified_name(type(value))}:{MEMORY_ADDRESS_PATTERN.sub("", text)}'
+
+
+def get_value_fingerprint(value: t.Any, depth: int = 0) -> t.Text:
+    """ 生成任意值的稳定指纹文本
+
+    @param value: 任意值
+    @param depth: 递归深度
+    @return: t.Text
+    """
+    if depth > DEFAULT_FINGERPRINT_MAX_DEPTH:
+        return '...'
+    depth += 1
+    if inspect.isclass(value) and issubclass(value, BaseModel):
+        return value.schema_json()
+    if inspect.isclass(value) and issubclass(value, enum.Enum):
+        return f'{value.__qualname__}{[(m.name, m.value) for m in value]!r}'
+    if inspect.isclass(value):
+        return f'{value.__module__}.{value.__qualname__}'
+    if inspect.isfunction(value) or inspect.ismethod(value):
+        return get_signature_fingerprint(value, depth)
+    if isinstance(value, functools.partial):
+        func = get_value_fingerprint(value.func, depth)
+        args, keywords = get_value_fingerprint(value.args, depth), get_value_fingerprint(value.keywords, depth)
+        return f'{get_qualified_name(value)}({func}, {args}, {keywords})'
+    origin, args = t.get_origin(value), t.get_args(value)
+    if origin is not None:
+        args = ', '.join(get_value_fingerprint(a, depth) for a in args)
+        return f'{origin!r}[{args}]'
+    if isinstance(value, dict):
+        items = sorted((get_value_fingerprint(k, depth), get_value_fingerprint(v, depth)) for k, v in value.items())
+        return f'{{{", ".join(f"{k}: {v}" for k, v in items)}}}'
+    if isinstance(value, (list, tuple)):
+        return f'[{", ".join(get_value_fingerprint(v, depth) for v in value)}]'
+    if isinstance(value, (set, frozenset)):
+        return f'{{{", ".join(sorted(get_value_fingerprint(v, depth) for v in value))}}}'
+    if isinstance(value, (str, bytes, int, float, bool, type(None), enum.Enum)):
+        return repr(value)
+    # 例如参数声明/依赖注入/安全方案等对象需要深入其属性
+    attrs = get_object_attrs(value)
+    if attrs is None:
+        return get_repr_fingerprint(value)
+    return f'{get_qualified_name(type(value))}({get_value_fingerprint(attrs, depth)})'
+
+
+def get_signature_fingerprint(call: t.Callable[..., t.Any], depth: int = 0) -> t.Text:
+    """ 生成调用对象签名的指纹文本
+
+    @param call: 调用对象
+    @param depth: 递归深度
+    @return: t.Text
+    """
+    try:
+        signature = get_typed_signature(call)
+    except (TypeError, ValueError, NameError):
+        return get_qualified_name(call)
+    params = []
+    for p in signature.parameters.values():
+        annotation = get_value_fingerprint(p.annotation, depth)
+        default = get_value_fingerprint(p.default, depth)
+        params.append(f'{p.name}:{p.kind}:{annotation}={default}')
+    return f'{call.__module__}.{call.__qualname__}({", ".join(params)}) {call.__doc__!r}'
+
+
+def get_router_fingerprint(router: ReqConsumer) -> t.Text:
+    """ 生成单个路由的指纹文本
+
+    @param router: 路由对象
+    @return: t.Text
+    """
+    return '\n'.join([
+        router.raw_url,
+        get_value_fingerprint(sorted(router.methods)),
+        get_value_fingerprint(router.tags),
+        get_value_fingerprint(router.summary),
+        get_value_fingerprint(router.description),
+        get_value_fingerprint(router.deprecated),
+        get_value_fingerprint(router.operation_id),
+        get_value_fingerprint(router.status_code),
+        get_value_fingerprint(router.include_in_doc),
+        get_value_fingerprint(router.response_class),
+        get_value_fingerprint(router.response_model),
+        get_value_fingerprint(router.response_description),
+        get_value_fingerprint(router.other_response),
+        get_signature_fingerprint(router.endpoint),
+    ])
+
+
+def get_openapi_fingerprint(routers: t.Sequence[ReqConsumer], **options: t.Any) -> t.Text:
+    """ 生成所有路由及文档选项的指纹
+
+    @param routers: 路由列表
+    @param options: 文档选项
+    @return: t.Text
+    """
+    sha256 = hashlib.sha256()
+    versions = (OPENAPI3_CACHE_FORMAT_VERSION, sys.version_info[:2], pydantic.VERSION)
+    sha256.update(repr(versions).encode('utf-8'))
+    sha256.update(get_value_fingerprint(options).encode('utf-8'))
+    # 路由注册顺序会影响生成的文档,因此不排序
+    for router in routers:
+        sha256.update(get_router_fingerprint(router).encode('utf-8'))
+    return sha256.hexdigest()
+
+
+def load_openapi_cache(path: t.Text, fingerprint: t.Text) -> t.Optional[t.Text]:
+    """ 载入指纹匹配的文档缓存
+
+    缓存文件首行为指纹,其余为文档内容
+
+    @param path: 缓存文件路径
+    @param fingerprint: 当前指纹
+    @return: t.Optional[t.Text]
+    """
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            cached_fingerprint = f.readline().strip()
+            return f.read() if cached_fingerprint == fingerprint else None
+    except OSError:
+        return None
+
+
+def dump_openapi_cache(path: t.Text, fingerprint: t.Text, document: t.Text) -> None:
+    """ 写入文档缓存
+
+    先写临时文件再原子替换,防止并发启动的进程读到不完整的缓存
+
+    注意: 会在系统线程中调用,因此这里不记录日志而是抛出异常交由调用方处理
+
+    @param path: 缓存文件路径
+    @param fingerprint: 当前指纹
+    @param document: 文档内容
+    @return: None
+    """
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(f'{fingerprint}\n')
+            f.write(document)
+        os.replace(temp_path, path)
+    except OSError:
+        os.path.exists(temp_path) and os.remove(temp_path)
+        raise
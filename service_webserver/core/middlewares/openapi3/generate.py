@@ -6,8 +6,12 @@ from __future__ import annotations
 
 import typing as t
 
+from pydantic import BaseModel
 from service_green.core.green import cjson
+from pydantic.schema import TypeModelSet
+from pydantic.schema import TypeModelOrEnum
 from pydantic.schema import get_model_name_map
+from pydantic.schema import get_flat_models_from_model
 from service_webserver.core.openapi3.models import OpenAPI
 from service_webserver.core.openapi3.encoder import jsonable_encoder
 from service_webserver.core.entrypoints.webserver.consumer import ReqConsumer
@@ -16,6 +20,141 @@ from .path import gen_openapi_path
 from .flat_models import get_flat_models
 from .definitions import gen_openapi_model_definitions
 
+# 路由片段 - (生成时的模型名称, 路径, 安全定义, 路径中的模型定义)
+RouterFragment = t.Tuple[t.Dict[TypeModelOrEnum, t.Text], t.Dict, t.Dict, t.Dict]
+# 模型片段 - (生成时的模型名称, 模型定义)
+ModelFragment = t.Tuple[t.Dict[TypeModelOrEnum, t.Text], t.Dict]
+
+
+class OpenApiGenerator(object):
+    """ 增量的openapi.json生成器
+
+    按路由缓存路径片段,按模型缓存模型定义,只有新增的路由以及模型名称发生变化的片段才会重新生成
+    """
+
+    def __init__(self) -> None:
+        """ 初始化实例 """
+        # 每个路由引用的扁平模型
+        self.router_models: t.Dict[ReqConsumer, TypeModelSet] = {}
+        # 每个路由的路径片段
+        self.router_fragments: t.Dict[ReqConsumer, RouterFragment] = {}
+        # 每个模型引用的扁平模型
+        self.model_models: t.Dict[TypeModelOrEnum, TypeModelSet] = {}
+        # 每个模型的模型定义
+        self.model_fragments: t.Dict[TypeModelOrEnum, ModelFragment] = {}
+
+    def invalidate(self, router: t.Optional[ReqConsumer] = None) -> None:
+        """ 使路由的缓存失效
+
+        @param router: 路由对象,为None时清空所有缓存
+        @return: None
+        """
+        if router is None:
+            self.router_models.clear()
+            self.router_fragments.clear()
+            self.model_models.clear()
+            self.model_fragments.clear()
+            return
+        self.router_models.pop(router, None)
+        self.router_fragments.pop(router, None)
+
+    def get_router_models(self, router: ReqConsumer) -> TypeModelSet:
+        """ 获取路由引用的扁平模型
+
+        @param router: 路由对象
+        @return: TypeModelSet
+        """
+        models = self.router_models.get(router)
+        if models is None:
+            models = self.router_models[router] = get_flat_models([router])
+        return models
+
+    def get_router_fragment(
+            self,
+            router: ReqConsumer,
+            model_name_map: t.Dict[TypeModelOrEnum, t.Text]
+    ) -> RouterFragment:
+        """ 获取路由的路径片段
+
+        @param router: 路由对象
+        @param model_name_map: 模型映射
+        @return: RouterFragment
+        """
+        names = {m: model_name_map[m] for m in self.get_router_models(router)}
+        fragment = self.router_fragments.get(router)
+        # 其它路由引入同名模型时名称会变化,此时引用该模型的片段需要重新生成
+        if fragment is not None and fragment[0] == names:
+            return fragment
+        path, security_schemes, path_definitions = gen_openapi_path(router, model_name_map)
+        fragment = self.router_fragments[router] = (names, path, security_schemes, path_definitions)
+        return fragment
+
+    def get_model_fragment(
+            self,
+            model: TypeModelOrEnum,
+            model_name_map: t.Dict[TypeModelOrEnum, t.Text]
+    ) -> ModelFragment:
+        """ 获取模型的模型定义
+
+        @param model: 模型对象
+        @param model_name_map: 模型映射
+        @return: ModelFragment
+        """
+        models = self.model_models.get(model)
+        if models is None:
+            # 枚举没有嵌套模型
+            models = get_flat_models_from_model(model) if issubclass(model, BaseModel) else set()
+            models = self.model_models[model] = models | {model}
+        names = {m: model_name_map[m] for m in models}
+        fragment = self.model_fragments.get(model)
+        if fragment is not None and fragment[0] == names:
+            return fragment
+        definitions = gen_openapi_model_definitions({model}, model_name_map)
+        fragment = self.model_fragments[model] = (names, definitions)
+        return fragment
+
+    def generate(
+            self,
+            title: t.Text,
+            routers: t.Sequence[ReqConsumer],
+            description: t.Text = '',
+            version: t.Text = '0.0.1',
+            openapi_version: t.Text = '3.0.3',
+            root_path: t.Optional[t.Text] = '',
+            api_tags: t.Optional[t.List[t.Dict[t.Text: t.Any]]] = None,
+            servers: t.Optional[t.List[t.Dict[t.Text: t.Union[t.Text, t.Any]]]] = None
+    ) -> t.Text:
+        """ 生成openapi.json """
+        # 已移除的路由不再保留缓存
+        for router in set(self.router_fragments).difference(routers):
+            self.invalidate(router)
+        # https://swagger.io/specification/#info-object
+        info = {'title': title, 'version': version}
+        description and info.update({'description': description})
+        # https://swagger.io/specification/#openapi-object
+        data = {'openapi': openapi_version, 'info': info}
+        # https://swagger.io/specification/#server-object
+        servers and data.update({'servers': servers})
+        # https://swagger.io/specification/#components-object
+        components: t.Dict[t.Text, t.Dict[t.Text, t.Any]] = {}
+        # https://swagger.io/specification/#paths-object
+        paths: t.Dict[t.Text, t.Dict[t.Text, t.Any]] = {}
+        flat_models = set()
+        for router in routers:
+            flat_models.update(self.get_router_models(router))
+        model_name_map = get_model_name_map(flat_models)
+        definitions = {}
+        for model in flat_models:
+            definitions.update(self.get_model_fragment(model, model_name_map)[1])
+        for consumer in routers:
+            _, path, security_schemes, path_definitions = self.get_router_fragment(consumer, model_name_map)
+            path and paths.setdefault(f'{root_path}{consumer.path}', {}).update(path)
+            security_schemes and components.setdefault('SecuritySchemes', {}).update(security_schemes)
+            path_definitions and definitions.update(path_definitions)
+        components['schemas'] = {k: definitions[k] for k in sorted(definitions)}
+        data.update({'paths': paths, 'tags': api_tags, 'components': components})
+        return cjson.dumps(jsonable_encoder(OpenAPI(**data), exclude_none=True))
+
 
 def get_openapi_json(
         title: t.Text,
@@ -28,25 +167,13 @@ def get_openapi_json(
         servers: t.Optional[t.List[t.Dict[t.Text: t.Union[t.Text, t.Any]]]] = None
 ) -> t.Text:
     """ 获取openapi.json """
-    # https://swagger.io/specification/#info-object
-    info = {'title': title, 'version': version}
-    description and info.update({'description': description})
-    # https://swagger.io/specification/#openapi-object
-    data = {'openapi': openapi_version, 'info': info}
-    # https://swagger.io/specification/#server-object
-    servers and data.update({'servers': servers})
-    # https://swagger.io/specification/#components-object
-    components: t.Dict[t.Text, t.Dict[t.Text, t.Any]] = {}
-    # https://swagger.io/specification/#paths-object
-    paths: t.Dict[t.Text, t.Dict[t.Text, t.Any]] = {}
-    flat_models = get_flat_models(routers)
-    model_name_map = get_model_name_map(flat_models)
-    definitions = gen_openapi_model_definitions(flat_models, model_name_map)
-    for consumer in routers:
-        path, security_schemes, path_definitions = gen_openapi_path(consumer, model_name_map)
-        path and paths.setdefault(f'{root_path}{consumer.path}', {}).update(path)
-        security_schemes and components.setdefault('SecuritySchemes', {}).update(security_schemes)
-        path_definitions and definitions.update(path_definitions)
-    components['schemas'] = {k: definitions[k] for k in sorted(definitions)}
-    data.update({'paths': paths, 'tags': api_tags, 'components': components})
-    return cjson.dumps(jsonable_encoder(OpenAPI(**data), exclude_none=True))
+    return OpenApiGenerator().generate(
+        title=title,
+        routers=routers,
+        description=description,
+        version=version,
+        openapi_version=openapi_version,
+        root_path=root_path,
+        api_tags=api_tags,
+        servers=servers
+    )
@@ -217,29 +217,31 @@ def gen_openapi_path(
     security_schemes: t.Dict[t.Text, t.Any] = {}
     # 自动忽略掉不想暴露在支持openapi的文档的接口
     if not router.include_in_doc:
-        return path, path_definitions, security_schemes
+        return path, security_schemes, path_definitions
+    # 参数/安全/请求体/响应与请求方法无关,只需计算一次
+    flat_dependent = get_flat_dependent(router.dependent, skip_repeats=True)
+    security_definitions, security_scopes = gen_openapi_security_definitions(
+        flat_dependent=flat_dependent
+    )
+    security_definitions and security_schemes.update(security_definitions)
+    flat_params = get_flat_params(router.dependent)
+    path_parameters = gen_openapi_path_parameters(
+        flat_params=flat_params, model_name_map=model_name_map
+    )
+    path_request_body = {}
+    if DEFAULT_METHODS_THAT_WITH_BODY.intersection(router.methods):
+        path_request_body = gen_openapi_path_request_body(
+            body_field=router.body_field, model_name_map=model_name_map
+        )
+    path_responses = gen_openapi_path_responses(
+        router=router, model_name_map=model_name_map
+    )
     for method in router.methods:
         path_definition = gen_openapi_path_metadata(router=router, method=method)
-        flat_dependent = get_flat_dependent(router.dependent, skip_repeats=True)
-        security_definitions, security_scopes = gen_openapi_security_definitions(
-            flat_dependent=flat_dependent
-        )
         security_scopes and path_definition.setdefault('security', []).extend(security_scopes)
-        security_definitions and security_schemes.update(security_definitions)
-        flat_params = get_flat_params(router.dependent)
-        path_parameters = gen_openapi_path_parameters(
-            flat_params=flat_params, model_name_map=model_name_map
-        )
         path_parameters and path_definition.setdefault('parameters', []).extend(path_parameters)
-        path_request_body = {}
         if method in DEFAULT_METHODS_THAT_WITH_BODY:
-            path_request_body = gen_openapi_path_request_body(
-                body_field=router.body_field, model_name_map=model_name_map
-            )
-        path_request_body and path_definition.setdefault('requestBody', {}).update(path_request_body)
-        path_responses = gen_openapi_path_responses(
-            router=router, model_name_map=model_name_map
-        )
+            path_request_body and path_definition.setdefault('requestBody', {}).update(path_request_body)
         path_responses and path_definition.setdefault('responses', {}).update(path_responses)
         path[method.lower()] = path_definition
     return path, security_schemes, path_definitions
@@ -0,0 +1,74 @@
+#! -*- coding: utf-8 -*-
+#
+# author: forcemain@163.com
+
+from __future__ import annotations
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import subprocess
+import typing as t
+
+from service_webserver.constants import OPENAPI3_CACHE_PATH_ENV_KEY
+
+# 等待服务生成文档缓存时的轮询间隔
+DEFAULT_PREGENERATE_POLL_INTERVAL = 0.2
+
+
+def parse_args(argv: t.Optional[t.List[t.Text]] = None) -> argparse.Namespace:
+    """ 解析命令行参数
+
+    @param argv: 命令行参数
+    @return: argparse.Namespace
+    """
+    parser = argparse.ArgumentParser(
+        prog='service-webserver-openapi3',
+        description='pre-generate the openapi3 document cache at build time'
+    )
+    parser.add_argument('facade', help='service facade module, same as `service start <facade>`')
+    parser.add_argument('-o', '--output', required=True, help='openapi3 cache file path')
+    parser.add_argument('-t', '--timeout', type=float, default=300, help='seconds to wait for the document')
+    parser.add_argument('options', nargs=argparse.REMAINDER, help='extra options passed to `service start`')
+    return parser.parse_args(argv)
+
+
+def main(argv: t.Optional[t.List[t.Text]] = None) -> int:
+    """ 构建时预生成文档缓存
+
+    以缓存路径环境变量启动服务,OpenApi3Middleware在启动时生成并写入缓存,写入后结束服务
+
+    @param argv: 命令行参数
+    @return: int
+    """
+    args = parse_args(argv)
+    output = os.path.abspath(args.output)
+    # 删除旧缓存以强制重新生成
+    os.path.exists(output) and os.remove(output)
+    env = dict(os.environ, **{OPENAPI3_CACHE_PATH_ENV_KEY: output})
+    command = [shutil.which('service') or 'service', 'start', args.facade, *args.options]
+    process = subprocess.Popen(command, env=env)
+    deadline = time.monotonic() + args.timeout
+    try:
+        while not os.path.exists(output):
+            if process.poll() is not None:
+                sys.stderr.write(f'service exited with {process.returncode} before {output} was written\n')
+                return process.returncode or 1
+            if time.monotonic() > deadline:
+                sys.stderr.write(f'timeout waiting for {output}\n')
+                return 1
+            time.sleep(DEFAULT_PREGENERATE_POLL_INTERVAL)
+    finally:
+        process.poll() is None and process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+    sys.stdout.write(f'openapi3 document cached to {output}\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,120 @@
+#! -*- coding: utf-8 -*-
+#
+# author: forcemain@163.com
+
+from __future__ import annotations
+
+import typing as t
+
+from urllib.parse import quote
+
+# 未设置标签的接口归入的默认标签,与Swagger UI的默认分组名称一致
+DEFAULT_OPENAPI_TAG = 'default'
+# 模型定义的引用前缀
+SCHEMA_REF_PREFIX = '#/components/schemas/'
+# https://swagger.io/specification/#path-item-object
+OPENAPI_OPERATION_METHODS = frozenset(('get', 'put', 'post', 'delete', 'options', 'head', 'patch', 'trace'))
+
+
+def get_operation_tags(operation: t.Dict[t.Text, t.Any]) -> t.List[t.Text]:
+    """ 获取接口的标签
+
+    @param operation: 接口定义
+    @return: t.List[t.Text]
+    """
+    return operation.get('tags') or [DEFAULT_OPENAPI_TAG]
+
+
+def get_openapi_tags(data: t.Dict[t.Text, t.Any]) -> t.List[t.Text]:
+    """ 获取文档中的所有标签
+
+    先按文档声明的标签顺序,再按接口中出现的顺序,没有接口的标签会被忽略
+
+    @param data: 文档数据
+    @return: t.List[t.Text]
+    """
+    used = {}
+    for path_item in data.get('paths', {}).values():
+        for method, operation in path_item.items():
+            if method not in OPENAPI_OPERATION_METHODS:
+                continue
+            used.update(dict.fromkeys(get_operation_tags(operation)))
+    names = [tag['name'] for tag in data.get('tags') or [] if tag.get('name') in used]
+    return names + [name for name in used if name not in names]
+
+
+def get_schema_refs(value: t.Any, refs: t.Set[t.Text]) -> t.Set[t.Text]:
+    """ 收集值中引用的模型名称
+
+    @param value: 任意文档数据
+    @param refs: 已收集的模型名称
+    @return: t.Set[t.Text]
+    """
+    if isinstance(value, dict):
+        ref = value.get('$ref')
+        isinstance(ref, str) and ref.startswith(SCHEMA_REF_PREFIX) and refs.add(ref[len(SCHEMA_REF_PREFIX):])
+        for v in value.values():
+            get_schema_refs(v, refs)
+    if isinstance(value, list):
+        for v in value:
+            get_schema_refs(v, refs)
+    return refs
+
+
+def get_tag_openapi_data(data: t.Dict[t.Text, t.Any], tag: t.Text) -> t.Optional[t.Dict[t.Text, t.Any]]:
+    """ 获取只包含标签下接口及其引用模型的文档数据
+
+    @param data: 文档数据
+    @param tag: 标签名称
+    @return: t.Optional[t.Dict[t.Text, t.Any]]
+    """
+    paths = {}
+    for path, path_item in data.get('paths', {}).items():
+        item = {}
+        for method, operation in path_item.items():
+            if method in OPENAPI_OPERATION_METHODS and tag not in get_operation_tags(operation):
+                continue
+            item[method] = operation
+        # 只剩下路径级的公共参数等定义时说明此路径下没有该标签的接口
+        if any(method in OPENAPI_OPERATION_METHODS for method in item):
+            paths[path] = item
+    if not paths:
+        return None
+    components = dict(data.get('components') or {})
+    schemas = components.pop('schemas', None) or {}
+    # 模型之间也会相互引用,需要逐层展开直至没有新的引用
+    refs, pending = set(), get_schema_refs(paths, set())
+    while pending:
+        refs.update(pending)
+        found = set()
+        for name in pending:
+            get_schema_refs(schemas.get(name), found)
+        pending = found - refs
+    components['schemas'] = {k: schemas[k] for k in sorted(refs) if k in schemas}
+    tag_data = {k: v for k, v in data.items() if k not in ('paths', 'tags', 'components')}
+    tags = [item for item in data.get('tags') or [] if item.get('name') == tag]
+    tags and tag_data.update({'tags': tags})
+    tag_data.update({'paths': paths, 'components': components})
+    return tag_data
+
+
+def get_tag_openapi_url(url_prefix: t.Text, tag: t.Text) -> t.Text:
+    """ 获取标签文档的地址
+
+    @param url_prefix: 标签文档地址前缀
+    @param tag: 标签名称
+    @return: t.Text
+    """
+    return f'{url_prefix}{quote(tag, safe="")}.json'
+
+
+def get_openapi_index(data: t.Dict[t.Text, t.Any], url_prefix: t.Text) -> t.Dict[t.Text, t.Any]:
+    """ 获取标签文档的索引
+
+    格式与Swagger UI的urls配置一致
+
+    @param data: 文档数据
+    @param url_prefix: 标签文档地址前缀
+    @return: t.Dict[t.Text, t.Any]
+    """
+    return {'urls': [{'name': tag, 'url': get_tag_openapi_url(url_prefix, tag)} for tag in get_openapi_tags(data)]}
@@ -19,6 +19,9 @@ from .base import BaseMiddleware
 class ProxyFixMiddleware(BaseProxyFix, BaseMiddleware):
     """ 代理修复中间件类 """
 
+    # 改写后的主机/路径前缀需参与路由匹配
+    before_routing = True
+
     def __init__(self, *, wsgi_app: WSGIApplication, producer: Entrypoint, **kwargs: t.Any) -> None:
         """ 初始化实例
 
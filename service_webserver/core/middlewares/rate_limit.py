@@ -0,0 +1,240 @@
+#! -*- coding: utf-8 -*-
+#
+# author: forcemain@163.com
+
+from __future__ import annotations
+
+import re
+import math
+import time
+import typing as t
+
+from collections import OrderedDict
+from service_webserver.core.response import StaticResponse
+from service_core.core.service.entrypoint import Entrypoint
+from service_webserver.core.entrypoints.webserver.pipeline import ROUTE_ENVIRON_KEY
+
+if t.TYPE_CHECKING:
+    # 由于其定义在存根文件所以需要在TYPE_CHECKING下
+    from werkzeug.wsgi import WSGIApplication
+    from werkzeug.wsgi import WSGIEnvironment
+    from werkzeug.wrappers.response import StartResponse
+
+from .base import BaseMiddleware
+from .proxy_fix import ProxyFixMiddleware
+
+# 限流预算的格式,如10/s,100/m,1000/5m
+RATE_LIMIT_PATTERN = re.compile(r'^\s*(\d+)\s*/\s*(\d*)\s*(s|sec|second|m|min|minute|h|hour|d|day)s?\s*$')
+# 时间单位对应的秒数
+RATE_LIMIT_PERIODS = {'s': 1, 'sec': 1, 'second': 1, 'm': 60, 'min': 60, 'minute': 60,
+                      'h': 3600, 'hour': 3600, 'd': 86400, 'day': 86400}
+# 可用于组成限流键的部分
+RATE_LIMIT_KEY_PARTS = ('ip', 'api_key', 'route')
+
+
+class RateLimit(object):
+    """ 令牌桶限流预算
+
+    桶容量为周期内允许的请求数,令牌按count/period的速率匀速补充
+    """
+
+    __slots__ = ('spec', 'count', 'period', 'rate', 'limited_response')
+
+    def __init__(self, spec: t.Text) -> None:
+        """ 初始化实例
+
+        @param spec: 预算,如100/m
+        """
+        match = RATE_LIMIT_PATTERN.match(spec)
+        if match is None:
+            raise ValueError(f'invalid rate limit {spec!r}, expected like 10/s, 100/m or 1000/5m')
+        count, multiple, unit = match.groups()
+        self.spec = spec
+        self.count = int(count)
+        self.period = int(multiple or 1) * RATE_LIMIT_PERIODS[unit]
+        if self.count <= 0 or self.period <= 0:
+            raise ValueError(f'invalid rate limit {spec!r}, count and period must be positive')
+        self.rate = self.count / self.period
+        # 被限流时令牌刚好耗尽,补充一个令牌所需的时间是固定的,因此响应可以预先生成
+        reset = math.ceil(1 / self.rate)
+        headers = {
+            'RateLimit-Limit': str(self.count),
+            'RateLimit-Remaining': '0',
+            'RateLimit-Reset': str(reset),
+            'RateLimit-Policy': f'{self.count};w={self.period}',
+            'Retry-After': str(reset),
+        }
+        self.limited_response = StaticResponse(
+            'rate limit exceeded', status=429, headers=headers, mimetype='text/plain'
+        )
+
+    def __repr__(self) -> t.Text:
+        return f'<RateLimit {self.spec}>'
+
+
+class RateLimitMiddleware(BaseMiddleware):
+    """ 令牌桶限流中间件类
+
+    令牌桶保存在按最近使用淘汰的有界字典中,每次请求只有O(1)的更新,
+    大量不同的客户端只会淘汰最久未访问的桶,被淘汰的客户端再次访问时视为新的满桶
+    """
+
+    def __init__(
+            self, *,
+            wsgi_app: WSGIApplication,
+            producer: Entrypoint,
+            default_limit: t.Optional[t.Text] = None,
+            key_by: t.Optional[t.List[t.Text]] = None,
+            api_key_header: t.Text = 'X-Api-Key',
+            max_keys: int = 100000,
+            expose_headers: bool = False
+    ) -> None:
+        """ 初始化实例
+
+        @param wsgi_app: 应用程序
+        @param producer: 服务提供者
+        @param default_limit: 默认预算,如100/m,未设置时只限制声明了rate_limit的路由
+        @param key_by: 限流键的组成部分,可选ip/api_key/route,默认为ip
+        @param api_key_header: 按api_key限流时读取的头部,请求未携带时按ip限流
+        @param max_keys: 最多保留的令牌桶数量,用于限制内存
+        @param expose_headers: 是否在正常响应中也添加RateLimit-*头部
+        """
+        super(RateLimitMiddleware, self).__init__(wsgi_app=wsgi_app, producer=producer)
+        self.default_limit = RateLimit(default_limit) if default_limit else None
+        self.key_by = tuple(key_by or ['ip'])
+        unknown = set(self.key_by).difference(RATE_LIMIT_KEY_PARTS)
+        if unknown:
+            raise ValueError(f'invalid rate limit key_by {sorted(unknown)}, choices are {RATE_LIMIT_KEY_PARTS}')
+        self.api_key_environ = f'HTTP_{api_key_header.upper().replace("-", "_")}'
+        self.max_keys = max_keys
+        self.expose_headers = expose_headers
+        # 令牌桶 - {(预算, *键): [剩余令牌, 更新时间]}
+        self.buckets: OrderedDict[t.Tuple, t.List[float]] = OrderedDict()
+        # 路由对应的预算,首次请求时解析
+        self.route_limits: t.Dict[t.Any, t.Optional[RateLimit]] = {}
+        self.proxy_fix: t.Optional[ProxyFixMiddleware] = None
+        self.limited_count = 0
+
+    def start(self) -> None:
+        """ 生命周期 - 启动阶段
+
+        @return: None
+        """
+        for middleware, _ in self.producer.loaded_middlewares:
+            isinstance(middleware, ProxyFixMiddleware) and setattr(self, 'proxy_fix', middleware)
+
+    def applies_to(self, consumer: t.Any) -> bool:
+        """ 是否作用于此路由
+
+        声明了rate_limit的路由总是生效,编译管道时同时校验其格式
+
+        @param consumer: 路由对象
+        @return: bool
+        """
+        if getattr(consumer, 'rate_limit', None):
+            return self.get_route_limit(consumer) is not None
+        return self.default_limit is not None and super(RateLimitMiddleware, self).applies_to(consumer)
+
+    def get_route_limit(self, route: t.Any) -> t.Optional[RateLimit]:
+        """ 获取路由的预算
+
+        @param route: 路由对象,None表示未匹配到路由
+        @return: t.Optional[RateLimit]
+        """
+        try:
+            return self.route_limits[route]
+        except KeyError:
+            pass
+        spec = getattr(route, 'rate_limit', None)
+        limit = self.route_limits[route] = RateLimit(spec) if spec else self.default_limit
+        return limit
+
+    def get_client_ip(self, environ: WSGIEnvironment) -> t.Text:
+        """ 获取客户端地址
+
+        ProxyFixMiddleware尚未处理此请求时按其x_for配置从X-Forwarded-For中取出
+
+        @param environ: 环境对象
+        @return: t.Text
+        """
+        remote_addr = environ.get('REMOTE_ADDR', '')
+        if self.proxy_fix is None or 'werkzeug.proxy_fix.orig' in environ:
+            return remote_addr
+        forwarded_for = environ.get('HTTP_X_FORWARDED_FOR')
+        return self.proxy_fix._get_real_value(self.proxy_fix.x_for, forwarded_for) or remote_addr
+
+    def get_key(self, environ: WSGIEnvironment, route: t.Any, limit: RateLimit) -> t.Tuple:
+        """ 生成限流键
+
+        @param environ: 环境对象
+        @param route: 路由对象
+        @param limit: 预算
+        @return: t.Tuple
+        """
+        key = [limit]
+        for part in self.key_by:
+            if part == 'route':
+                key.append(route)
+            elif part == 'api_key':
+                api_key = environ.get(self.api_key_environ)
+                key.append(('api_key', api_key) if api_key else ('ip', self.get_client_ip(environ)))
+            else:
+                key.append(self.get_client_ip(environ))
+        return tuple(key)
+
+    def consume(self, key: t.Tuple, limit: RateLimit) -> float:
+        """ 从令牌桶中取出一个令牌
+
+        @param key: 限流键
+        @param limit: 预算
+        @return: float 取出后剩余的令牌数,小于0表示被限流
+        """
+        now = time.monotonic()
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            self.buckets[key] = bucket = [float(limit.count), now]
+            len(self.buckets) > self.max_keys and self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+            bucket[0] = min(float(limit.count), bucket[0] + (now - bucket[1]) * limit.rate)
+            bucket[1] = now
+        if bucket[0] < 1:
+            return -1.0
+        bucket[0] -= 1
+        return bucket[0]
+
+    def __call__(self, environ: WSGIEnvironment, start_response: StartResponse) -> t.Iterable[bytes]:
+        """ 请求处理器
+
+        @param environ: 环境对象
+        @param start_response: 响应对象
+        @return: t.Iterable[bytes]
+        """
+        route = environ.get(ROUTE_ENVIRON_KEY, (None,))[0]
+        limit = self.get_route_limit(route)
+        if limit is None:
+            return self.wsgi_app(environ, start_response)
+        remaining = self.consume(self.get_key(environ, route, limit), limit)
+        if remaining < 0:
+            self.limited_count += 1
+            return limit.limited_response(environ, start_response)
+        if not self.expose_headers:
+            return self.wsgi_app(environ, start_response)
+        rate_limit_headers = [
+            ('RateLimit-Limit', str(limit.count)),
+            ('RateLimit-Remaining', str(int(remaining))),
+            # 令牌补满所需的秒数
+            ('RateLimit-Reset', str(math.ceil((limit.count - remaining) / limit.rate))),
+            ('RateLimit-Policy', f'{limit.count};w={limit.period}'),
+        ]
+
+        def add_rate_limit_headers(status: t.Text, headers: t.List, exc_info: t.Optional[t.Tuple] = None):
+            """ 添加限流头部
+
+            @param status  : 响应状态
+            @param headers : 头部信息
+            @param exc_info: 异常信息
+            """
+            return start_response(status, list(headers) + rate_limit_headers, exc_info)
+
+        return self.wsgi_app(environ, add_rate_limit_headers)  # type: ignore
@@ -0,0 +1,345 @@
+#! -*- coding: utf-8 -*-
+#
+# author: forcemain@163.com
+
+from __future__ import annotations
+
+import os
+import sys
+import typing as t
+
+from eventlet import patcher
+from logging import getLogger
+from urllib.parse import parse_qs
+from eventlet.hubs import get_hub
+from service_webserver.core.response import JsonResponse
+from service_webserver.core.response import PlainTextResponse
+from service_core.core.service.entrypoint import Entrypoint
+
+if t.TYPE_CHECKING:
+    # 由于其定义在存根文件所以需要在TYPE_CHECKING下
+    from werkzeug.wsgi import WSGIApplication
+    from werkzeug.wsgi import WSGIEnvironment
+    from werkzeug.wrappers.response import StartResponse
+
+from .base import BaseMiddleware
+from .base import is_admin_authorized
+
+# 采样线程必须是真正的系统线程,不能被eventlet打补丁
+threading = patcher.original('threading')
+original_time = patcher.original('time')
+
+logger = getLogger(__name__)
+
+# 超出最大栈数量后新出现的栈归入此帧
+TRUNCATED_FRAME = '[truncated]'
+
+
+class SamplingProfilerMiddleware(BaseMiddleware):
+    """ 采样分析中间件类
+
+    在系统线程中定时采集所有系统线程以及在途请求协程的调用栈,按路由聚合为火焰图使用的折叠栈格式
+
+    管理接口(设置admin_token后启用):
+        GET  {admin_url}            采样状态及各路由的样本数
+        GET  {admin_url}/collapsed  折叠栈,可直接交给flamegraph.pl或speedscope
+        POST {admin_url}/start      开始采样,可选?interval=秒数
+        POST {admin_url}/stop       停止采样
+        POST {admin_url}/reset      清空样本
+    """
+
+    # 请求登记由WsgiApp完成,中间件只提供管理接口,业务路由无需经过
+    apply_to_routes = False
+
+    def __init__(
+            self, *,
+            wsgi_app: WSGIApplication,
+            producer: Entrypoint,
+            admin_url: t.Text = '/_profiler',
+            admin_token: t.Optional[t.Text] = None,
+            interval: float = 0.01,
+            max_stacks: int = 10000,
+            max_depth: int = 64,
+            include_idle: bool = False,
+            autostart: bool = False
+    ) -> None:
+        """ 初始化实例
+
+        @param wsgi_app: 应用程序
+        @param producer: 服务提供者
+        @param admin_url: 管理接口地址
+        @param admin_token: 管理接口令牌,通过Authorization: Bearer传入,未设置时关闭管理接口
+        @param interval: 采样间隔秒数
+        @param max_stacks: 最多保留的不同栈数量,用于限制内存
+        @param max_depth: 每个栈最多保留的帧数(靠近栈顶的部分)
+        @param include_idle: 是否统计事件循环空闲等待时的样本
+        @param autostart: 是否随服务启动开始采样
+        """
+        super(SamplingProfilerMiddleware, self).__init__(wsgi_app=wsgi_app, producer=producer)
+        self.admin_url = admin_url.rstrip('/')
+        self.admin_token = admin_token
+        self.interval = interval
+        self.max_stacks = max_stacks
+        self.max_depth = max_depth
+        self.include_idle = include_idle
+        self.autostart = autostart
+        self.running = False
+        self.thread = None
+        # 事件循环所在的系统线程及其主协程,在开始采样时获取
+        self.hub_ident = None
+        self.hub_greenlet = None
+        # 折叠栈 - {(根帧, 状态, *帧): 样本数}
+        self.stacks: t.Dict[t.Tuple[t.Text, ...], int] = {}
+        self.route_samples: t.Dict[t.Text, int] = {}
+        self.sample_count = 0
+        self.sample_errors = 0
+        # 代码对象到帧名称的缓存
+        self.code_names: t.Dict[t.Any, t.Text] = {}
+        self.route_names: t.Dict[t.Any, t.Text] = {}
+
+    def get_claimed_paths(self) -> t.Tuple[t.Iterable[t.Text], t.Iterable[t.Text]]:
+        """ 获取由中间件自身处理的路径
+
+        @return: t.Tuple[t.Iterable[t.Text], t.Iterable[t.Text]] - (完整路径, 路径前缀)
+        """
+        # 未设置令牌时不提供管理接口
+        return ((), ()) if self.admin_token is None else ((self.admin_url,), (f'{self.admin_url}/',))
+    def get_code_name(self, code: t.Any) -> t.Text:
+        """ 获取代码对象对应的帧名称
+
+        @param code: 代码对象
+        @return: t.Text
+        """
+        name = self.code_names.get(code)
+        if name is None:
+            filename = os.path.basename(code.co_filename)
+            name = self.code_names[code] = f'{code.co_name} ({filename}:{code.co_firstlineno})'
+        return name
+
+    def get_route_name(self, route: t.Any) -> t.Text:
+        """ 获取路由的根帧名称
+
+        @param route: 路由对象,None表示未匹配到路由
+        @return: t.Text
+        """
+        if route is None:
+            return '[fallback]'
+        name = self.route_names.get(route)
+        if name is None:
+            name = self.route_names[route] = f'{",".join(sorted(route.methods))} {route.raw_url}'
+        return name
+
+    def get_frame_names(self, frame: t.Any) -> t.List[t.Text]:
+        """ 获取由栈底到栈顶的帧名称
+
+        @param frame: 栈顶帧
+        @return: t.List[t.Text]
+        """
+        names = []
+        while frame is not None and len(names) < self.max_depth:
+            names.append(self.get_code_name(frame.f_code))
+            frame = frame.f_back
+        names.reverse()
+        return names
+
+    def add_stack(self, root: t.Text, state: t.Text, frame: t.Any) -> None:
+        """ 累加一个样本
+
+        @param root: 根帧名称
+        @param state: 协程/线程状态
+        @param frame: 栈顶帧
+        @return: None
+        """
+        key = (root, state, *self.get_frame_names(frame))
+        if key not in self.stacks and len(self.stacks) >= self.max_stacks:
+            key = (root, state, TRUNCATED_FRAME)
+        self.stacks[key] = self.stacks.get(key, 0) + 1
+        self.route_samples[root] = self.route_samples.get(root, 0) + 1
+
+    @staticmethod
+    def is_idle_frame(frame: t.Any) -> bool:
+        """ 是否为事件循环空闲等待的帧
+
+        @param frame: 栈顶帧
+        @return: bool
+        """
+        code = frame.f_code
+        return code.co_name == 'wait' and f'{os.sep}hubs{os.sep}' in code.co_filename
+
+    def take_sample(self) -> None:
+        """ 采集一次样本
+
+        注意: 在系统线程中执行,不能使用协程相关的对象,也不记录日志
+
+        @return: None
+        """
+        frames = sys._current_frames()
+        frames.pop(threading.get_ident(), None)
+        hub_frame = frames.pop(self.hub_ident, None)
+        inflight = self.producer.inflight
+        current = inflight.current
+        requests = dict(inflight.requests)
+        if hub_frame is not None:
+            request = requests.get(current)
+            if request is not None:
+                self.add_stack(self.get_route_name(request.route), '[running]', hub_frame)
+            elif current is self.hub_greenlet:
+                idle = self.is_idle_frame(hub_frame)
+                (self.include_idle or not idle) and self.add_stack('[hub]', '[idle]' if idle else '[busy]', hub_frame)
+            else:
+                self.add_stack('[greenlet]', '[running]', hub_frame)
+        for gt, request in requests.items():
+            # 正在运行的协程没有gr_frame,其栈已经在事件循环线程中采集
+            frame = None if gt is current else gt.gr_frame
+            frame is None or self.add_stack(self.get_route_name(request.route), '[waiting]', frame)
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in frames.items():
+            self.add_stack('[thread]', names.get(ident, str(ident)), frame)
+        self.sample_count += 1
+
+    def run_sampler(self) -> None:
+        """ 采样线程的主循环
+
+        注意: 在系统线程中执行,不能使用协程相关的对象,也不记录日志
+
+        @return: None
+        """
+        while self.running:
+            original_time.sleep(self.interval)
+            if not self.running:
+                break
+            try:
+                self.take_sample()
+            except Exception:
+                # 采集时其它线程可能正在修改栈,丢弃此次样本即可
+                self.sample_errors += 1
+
+    def start_sampling(self, interval: t.Optional[float] = None) -> None:
+        """ 开始采样
+
+        注意: 需在事件循环所在的线程中调用
+
+        @param interval: 采样间隔秒数
+        @return: None
+        """
+        if self.running:
+            return
+        interval and setattr(self, 'interval', interval)
+        self.hub_ident = threading.get_ident()
+        self.hub_greenlet = get_hub().greenlet
+        self.producer.inflight.enable()
+        self.producer.inflight.watch_switches()
+        self.running = True
+        self.thread = threading.Thread(target=self.run_sampler, name=f'{self}.self_run_sampler', daemon=True)
+        self.thread.start()
+        logger.debug(f'sampling profiler started with interval={self.interval}s')
+
+    def stop_sampling(self) -> None:
+        """ 停止采样
+
+        @return: None
+        """
+        if not self.running:
+            return
+        self.running = False
+        self.producer.inflight.unwatch_switches()
+        self.producer.inflight.disable()
+        self.thread = None
+        logger.debug(f'sampling profiler stopped with {self.sample_count} samples')
+
+    def reset(self) -> None:
+        """ 清空样本
+
+        @return: None
+        """
+        # 采样线程可能同时在写,替换而不是清空
+        self.stacks, self.route_samples = {}, {}
+        self.sample_count, self.sample_errors = 0, 0
+
+    def get_collapsed(self) -> t.Text:
+        """ 获取折叠栈文本
+
+        @return: t.Text
+        """
+        stacks = dict(self.stacks)
+        return ''.join(f'{";".join(key)} {count}\n' for key, count in sorted(stacks.items()))
+
+    def get_status(self) -> t.Dict[t.Text, t.Any]:
+        """ 获取采样状态
+
+        @return: t.Dict[t.Text, t.Any]
+        """
+        route_samples = dict(self.route_samples)
+        return {
+            'running': self.running,
+            'interval': self.interval,
+            'samples': self.sample_count,
+            'errors': self.sample_errors,
+            'stacks': len(self.stacks),
+            'max_stacks': self.max_stacks,
+            'routes': dict(sorted(route_samples.items(), key=lambda i: i[1], reverse=True)),
+        }
+
+    def start(self) -> None:
+        """ 生命周期 - 启动阶段
+
+        @return: None
+        """
+        self.autostart and self.start_sampling()
+
+    def stop(self) -> None:
+        """ 生命周期 - 停止阶段
+
+        @return: None
+        """
+        self.stop_sampling()
+
+    def handle_admin(
+            self,
+            action: t.Text,
+            environ: WSGIEnvironment,
+            start_response: StartResponse
+    ) -> t.Iterable[bytes]:
+        """ 处理管理接口请求
+
+        @param action: 操作名称
+        @param environ: 环境对象
+        @param start_response: 响应对象
+        @return: t.Iterable[bytes]
+        """
+        if not is_admin_authorized(environ, self.admin_token):
+            return JsonResponse({'error': 'forbidden'}, status=403)(environ, start_response)
+        method = environ['REQUEST_METHOD']
+        if action == '' and method == 'GET':
+            return JsonResponse(self.get_status())(environ, start_response)
+        if action == 'collapsed' and method == 'GET':
+            return PlainTextResponse(self.get_collapsed())(environ, start_response)
+        if action not in ('start', 'stop', 'reset'):
+            return JsonResponse({'error': 'not found'}, status=404)(environ, start_response)
+        if method != 'POST':
+            return JsonResponse({'error': 'method not allowed'}, status=405)(environ, start_response)
+        if action == 'start':
+            query = parse_qs(environ.get('QUERY_STRING', ''))
+            try:
+                interval = float(query['interval'][0]) if 'interval' in query else None
+            except ValueError:
+                return JsonResponse({'error': 'invalid interval'}, status=400)(environ, start_response)
+            if interval is not None and interval <= 0:
+                return JsonResponse({'error': 'invalid interval'}, status=400)(environ, start_response)
+            self.start_sampling(interval)
+        action == 'stop' and self.stop_sampling()
+        action == 'reset' and self.reset()
+        return JsonResponse(self.get_status())(environ, start_response)
+
+    def __call__(self, environ: WSGIEnvironment, start_response: StartResponse) -> t.Iterable[bytes]:
+        """ 请求处理器
+
+        @param environ: 环境对象
+        @param start_response: 响应对象
+        @return: t.Iterable[bytes]
+        """
+        path = environ.get('PATH_INFO') or '/'
+        # 未设置令牌时不提供管理接口
+        if self.admin_token is not None and (path == self.admin_url or path.startswith(f'{self.admin_url}/')):
+            return self.handle_admin(path[len(self.admin_url) + 1:], environ, start_response)
+        return self.wsgi_app(environ, start_response)
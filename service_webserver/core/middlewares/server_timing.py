@@ -0,0 +1,81 @@
+#! -*- coding: utf-8 -*-
+#
+# author: forcemain@163.com
+
+from __future__ import annotations
+
+import typing as t
+
+from service_webserver.core.timing import TIMING_ENVIRON_KEY
+from service_core.core.service.entrypoint import Entrypoint
+
+if t.TYPE_CHECKING:
+    # 由于其定义在存根文件所以需要在TYPE_CHECKING下
+    from werkzeug.wsgi import WSGIApplication
+    from werkzeug.wsgi import WSGIEnvironment
+    from werkzeug.wrappers.response import StartResponse
+
+from .base import BaseMiddleware
+
+
+class ServerTimingMiddleware(BaseMiddleware):
+    """ 分阶段计时中间件类
+
+    开启ReqProducer.timing的分阶段计时,可选在响应中添加Server-Timing头部,
+    同时启用MetricsMiddleware时各阶段耗时会汇总到指标中
+
+    注意: 头部在响应开始时生成,不包括外层中间件返回途中及发送响应体的耗时
+    """
+
+    def __init__(
+            self, *,
+            wsgi_app: WSGIApplication,
+            producer: Entrypoint,
+            expose_header: bool = True
+    ) -> None:
+        """ 初始化实例
+
+        @param wsgi_app: 应用程序
+        @param producer: 服务提供者
+        @param expose_header: 是否在响应中添加Server-Timing头部,关闭时只汇总到指标
+        """
+        super(ServerTimingMiddleware, self).__init__(wsgi_app=wsgi_app, producer=producer)
+        self.expose_header = expose_header
+        # 计时由WsgiApp完成,不添加头部时无需经过此中间件
+        expose_header or self.set_route_options(apply_to_routes=False, apply_to_fallback=False)
+
+    def start(self) -> None:
+        """ 生命周期 - 启动阶段
+
+        @return: None
+        """
+        self.producer.timing.enable()
+
+    def stop(self) -> None:
+        """ 生命周期 - 停止阶段
+
+        @return: None
+        """
+        self.producer.timing.disable()
+
+    def __call__(self, environ: WSGIEnvironment, start_response: StartResponse) -> t.Iterable[bytes]:
+        """ 请求处理器
+
+        @param environ: 环境对象
+        @param start_response: 响应对象
+        @return: t.Iterable[bytes]
+        """
+        timing = environ.get(TIMING_ENVIRON_KEY)
+        if not self.expose_header or timing is None:
+            return self.wsgi_app(environ, start_response)
+
+        def add_server_timing(status: t.Text, headers: t.List, exc_info: t.Optional[t.Tuple] = None):
+            """ 添加Server-Timing头部
+
+            @param status  : 响应状态
+            @param headers : 头部信息
+            @param exc_info: 异常信息
+            """
+            return start_response(status, list(headers) + [('Server-Timing', timing.get_server_timing())], exc_info)
+
+        return self.wsgi_app(environ, add_server_timing)  # type: ignore
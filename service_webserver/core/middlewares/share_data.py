@@ -4,27 +4,359 @@
 
 from __future__ import annotations
 
+import os
+import mmap
+import eventlet
+import mimetypes
 import typing as t
 
+from eventlet import tpool
+from logging import getLogger
+from werkzeug.http import http_date
+from werkzeug.wsgi import get_path_info
+from werkzeug.http import generate_etag
+from werkzeug.security import safe_join
+from werkzeug.utils import get_content_type
+from service_webserver.core.response import PrecompressedResponse
 from service_core.core.service.entrypoint import Entrypoint
 from werkzeug.middleware.shared_data import SharedDataMiddleware as BaseSharedDataMiddleware
 
 if t.TYPE_CHECKING:
     # 由于其定义在存根文件所以需要在TYPE_CHECKING下
     from werkzeug.wsgi import WSGIApplication
+    from werkzeug.wsgi import WSGIEnvironment
+    from werkzeug.wrappers.response import StartResponse
 
 from .base import BaseMiddleware
 
+logger = getLogger(__name__)
+
+# 预压缩的同名文件后缀,按服务端优先顺序排列
+STATIC_ENCODING_SUFFIXES = (('br', '.br'), ('gzip', '.gz'))
+# 304响应只保留缓存相关的头部
+NOT_MODIFIED_KEEP_HEADERS = ('etag', 'cache-control', 'vary', 'last-modified', 'expires')
+
+# 文件状态 - {文件路径: (修改时间, 文件大小)}
+StaticStats = t.Dict[t.Text, t.Tuple[int, int]]
+# 编码变体 - (头部列表, 响应体, 304头部列表, ETag)
+StaticVariant = t.Tuple[t.List[t.Tuple[t.Text, t.Text]], t.Union[bytes, mmap.mmap], t.List, t.Text]
+
+
+class StaticFile(object):
+    """ 缓存在内存中的静态文件 """
+
+    # 使用mmap时每次写出的块大小
+    block_size = 65536
+
+    def __init__(self, stats: StaticStats, variants: t.Dict[t.Text, StaticVariant], last_modified: int) -> None:
+        """ 初始化实例
+
+        @param stats: 文件及其预压缩文件的状态,用于检查是否变化
+        @param variants: 各编码变体,identity为原始文件
+        @param last_modified: 原始文件的修改时间戳
+        """
+        self.stats = stats
+        self.variants = variants
+        self.last_modified = last_modified
+        self.encodings = tuple(e for e, _ in STATIC_ENCODING_SUFFIXES if e in variants)
+        # 只统计读入内存的字节数,mmap由系统页缓存管理
+        self.memory_size = sum(len(v[1]) for v in variants.values() if isinstance(v[1], bytes))
+
+    def iter_mmap(self, body: mmap.mmap) -> t.Iterator[bytes]:
+        """ 分块写出mmap的内容
+
+        @param body: 映射的文件
+        @return: t.Iterator[bytes]
+        """
+        for offset in range(0, len(body), self.block_size):
+            yield body[offset:offset + self.block_size]
+
+    def __call__(self, environ: WSGIEnvironment, start_response: StartResponse) -> t.Iterable[bytes]:
+        """ 请求处理器
+
+        @param environ: 环境对象
+        @param start_response: 响应对象
+        @return: t.Iterable[bytes]
+        """
+        # 与预压缩响应共用变体选择及协商缓存逻辑
+        body = PrecompressedResponse.respond_variant(
+            environ, start_response, self.variants, self.encodings, '200 OK', self.last_modified
+        )
+        if body is None:
+            return []
+        return (body,) if isinstance(body, bytes) else self.iter_mmap(body)
+
 
 class ShareDataMiddleware(BaseSharedDataMiddleware, BaseMiddleware):
-    """ 静态文件中间件类 """
+    """ 静态文件中间件类
+
+    注意: 只有文件总是以原子方式替换(写入新文件后rename)时才能设置memory_mmap_min_size,
+    原地截断重写被映射的文件会使正在发送它的请求触发SIGBUS并导致进程退出,
+    未使用mmap时文件变化后会在下次检查时失效并重新读取
+    """
 
-    def __init__(self, *, wsgi_app: WSGIApplication, producer: Entrypoint, **kwargs: t.Any) -> None:
+    # 只服务静态目录下的文件,业务路由无需经过
+    apply_to_routes = False
+
+    def __init__(
+            self, *,
+            wsgi_app: WSGIApplication,
+            producer: Entrypoint,
+            memory_cache: bool = False,
+            memory_preload: bool = False,
+            memory_max_file_size: int = 8 * 1024 * 1024,
+            memory_max_total_size: int = 128 * 1024 * 1024,
+            memory_mmap_min_size: t.Optional[int] = None,
+            memory_check_interval: float = 2.0,
+            **kwargs: t.Any
+    ) -> None:
         """ 初始化实例
 
         @param wsgi_app: 应用程序
         @param producer: 服务提供者
+        @param memory_cache: 是否在内存中缓存文件系统中的静态文件,包内资源依然按原方式读取
+        @param memory_preload: 是否在启动时预先载入不需要mmap的文件
+        @param memory_max_file_size: 可缓存的最大文件字节数,超出的文件按原方式读取
+        @param memory_max_total_size: 读入内存的最大总字节数,超出后新文件按原方式读取
+        @param memory_mmap_min_size: 达到此字节数的文件使用mmap而不读入内存,None表示不使用mmap
+        @param memory_check_interval: 后台检查文件变化的间隔秒数
         @param kwargs: 命名参数
         """
         BaseSharedDataMiddleware.__init__(self, wsgi_app, **kwargs)
         BaseMiddleware.__init__(self, wsgi_app=wsgi_app, producer=producer)
+        self.memory_cache = memory_cache
+        self.memory_preload = memory_preload
+        self.memory_max_file_size = memory_max_file_size
+        self.memory_max_total_size = memory_max_total_size
+        self.memory_mmap_min_size = memory_mmap_min_size
+        self.memory_check_interval = memory_check_interval
+        exports = kwargs.get('exports', {})
+        exports = exports.items() if isinstance(exports, dict) else exports
+        # 包内资源没有真实的文件路径,无法检查变化,因此不缓存
+        self.export_paths = [(k, v) for k, v in exports if isinstance(v, str)]
+        self.static_files: t.Dict[t.Text, StaticFile] = {}
+        self.memory_used = 0
+        self.stopped = False
+
+    def get_claimed_paths(self) -> t.Tuple[t.Iterable[t.Text], t.Iterable[t.Text]]:
+        """ 获取由中间件自身处理的路径
+
+        @return: t.Tuple[t.Iterable[t.Text], t.Iterable[t.Text]] - (完整路径, 路径前缀)
+        """
+        search_paths = [search_path for search_path, _ in self.exports]
+        return search_paths, tuple(p if p.endswith('/') else f'{p}/' for p in search_paths)
+    def resolve_filename(self, path: t.Text) -> t.Optional[t.Text]:
+        """ 按导出规则解析请求路径对应的文件
+
+        @param path: 请求路径
+        @return: t.Optional[t.Text]
+        """
+        for search_path, export_path in self.export_paths:
+            if os.path.isfile(export_path):
+                filename = export_path if path == search_path else None
+            elif path == search_path:
+                filename = export_path
+            else:
+                prefix = search_path if search_path.endswith('/') else f'{search_path}/'
+                filename = safe_join(export_path, path[len(prefix):]) if path.startswith(prefix) else None
+            if filename is not None and os.path.isfile(filename):
+                return filename
+        return None
+
+    def get_stat(self, filename: t.Text) -> t.Optional[t.Tuple[int, int]]:
+        """ 获取文件的修改时间和大小
+
+        @param filename: 文件路径
+        @return: t.Optional[t.Tuple[int, int]]
+        """
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def read_file(self, filename: t.Text, size: int) -> t.Union[bytes, mmap.mmap]:
+        """ 读入文件,较大的文件使用mmap
+
+        @param filename: 文件路径
+        @param size: 文件大小
+        @return: t.Union[bytes, mmap.mmap]
+        """
+        with open(filename, 'rb') as f:
+            # 空文件无法mmap
+            if self.memory_mmap_min_size is None or size < self.memory_mmap_min_size or size == 0:
+                return f.read()
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def load_static_file(self, filename: t.Text) -> t.Optional[StaticFile]:
+        """ 载入静态文件及其预压缩文件
+
+        注意: 在系统线程中执行,不能使用协程相关的对象,也不记录日志
+
+        @param filename: 文件路径
+        @return: t.Optional[StaticFile]
+        """
+        stat = self.get_stat(filename)
+        if stat is None or stat[1] > self.memory_max_file_size:
+            return None
+        body = self.read_file(filename, stat[1])
+        # 强ETag根据内容计算,文件内容不变时即使重新部署也不会失效
+        etag = generate_etag(body)
+        last_modified = stat[0] // 1000000000
+        guessed_type = mimetypes.guess_type(filename)
+        headers = [('Content-Type', get_content_type(guessed_type[0] or self.fallback_mimetype, 'utf-8'))]
+        self.cache and headers.append(('Cache-Control', f'max-age={self.cache_timeout}, public'))
+        headers.append(('Last-Modified', http_date(last_modified)))
+        stats, variants = {filename: stat}, {}
+        for encoding, suffix in STATIC_ENCODING_SUFFIXES:
+            sibling_stat = self.get_stat(f'{filename}{suffix}')
+            # 预压缩文件比原文件还大时没有意义
+            if sibling_stat is None or sibling_stat[1] >= stat[1]:
+                continue
+            stats[f'{filename}{suffix}'] = sibling_stat
+            variant_body = self.read_file(f'{filename}{suffix}', sibling_stat[1])
+            variant_headers = headers + [('Content-Encoding', encoding)]
+            variants[encoding] = (variant_headers, variant_body, f'"{etag}-{encoding}"')
+        variants['identity'] = (headers, body, f'"{etag}"')
+        static_variants = {}
+        for encoding, (variant_headers, variant_body, variant_etag) in variants.items():
+            variant_headers = variant_headers + [('ETag', variant_etag), ('Content-Length', str(len(variant_body)))]
+            # 存在预压缩文件时不同客户端会拿到不同的内容
+            len(variants) > 1 and variant_headers.append(('Vary', 'Accept-Encoding'))
+            not_modified_headers = [(k, v) for k, v in variant_headers if k.lower() in NOT_MODIFIED_KEEP_HEADERS]
+            static_variants[encoding] = (variant_headers, variant_body, not_modified_headers, variant_etag)
+        return StaticFile(stats, static_variants, last_modified)
+
+    def add_static_file(self, path: t.Text, static_file: t.Optional[StaticFile]) -> bool:
+        """ 在内存预算内缓存静态文件
+
+        @param path: 请求路径
+        @param static_file: 静态文件
+        @return: bool
+        """
+        if static_file is None:
+            return False
+        if self.memory_used + static_file.memory_size > self.memory_max_total_size:
+            return False
+        old_file = self.static_files.get(path)
+        old_file is None or setattr(self, 'memory_used', self.memory_used - old_file.memory_size)
+        self.static_files[path] = static_file
+        self.memory_used += static_file.memory_size
+        return True
+
+    def remove_static_file(self, path: t.Text) -> None:
+        """ 移除缓存的静态文件
+
+        注意: 正在发送的响应依然持有mmap,因此不主动关闭,由垃圾回收释放
+
+        @param path: 请求路径
+        @return: None
+        """
+        static_file = self.static_files.pop(path, None)
+        static_file is None or setattr(self, 'memory_used', self.memory_used - static_file.memory_size)
+
+    def preload_static_files(self) -> t.List[t.Tuple[t.Text, StaticFile]]:
+        """ 预先载入导出目录中不需要mmap的文件
+
+        注意: 在系统线程中执行,不能使用协程相关的对象,也不记录日志
+
+        @return: t.List[t.Tuple[t.Text, StaticFile]]
+        """
+        static_files = []
+        for search_path, export_path in self.export_paths:
+            if os.path.isfile(export_path):
+                files = [(search_path, export_path)]
+            else:
+                files = []
+                prefix = search_path if search_path.endswith('/') else f'{search_path}/'
+                for root, _, names in os.walk(export_path):
+                    for name in names:
+                        filename = os.path.join(root, name)
+                        relpath = os.path.relpath(filename, export_path).replace(os.sep, '/')
+                        files.append((f'{prefix}{relpath}', filename))
+            for path, filename in files:
+                if not self.is_allowed(os.path.basename(filename)):
+                    continue
+                stat = self.get_stat(filename)
+                mmap_min_size = self.memory_mmap_min_size
+                if stat is None or mmap_min_size is not None and stat[1] >= mmap_min_size:
+                    continue
+                static_file = self.load_static_file(filename)
+                static_file is None or static_files.append((path, static_file))
+        return static_files
+
+    def get_changed_paths(self, static_files: t.List[t.Tuple[t.Text, StaticFile]]) -> t.List[t.Text]:
+        """ 获取文件或其预压缩文件发生变化的请求路径
+
+        注意: 在系统线程中执行,不能使用协程相关的对象,也不记录日志
+
+        @param static_files: 缓存的静态文件
+        @return: t.List[t.Text]
+        """
+        changed = []
+        for path, static_file in static_files:
+            filename = next(iter(static_file.stats))
+            # 新增的预压缩文件同样需要重新载入
+            siblings = {f'{filename}{suffix}' for _, suffix in STATIC_ENCODING_SUFFIXES}
+            names = siblings.union(static_file.stats)
+            if any(self.get_stat(name) != static_file.stats.get(name) for name in names):
+                changed.append(path)
+        return changed
+
+    def check_static_files(self) -> None:
+        """ 定时检查文件变化并使对应的缓存失效
+
+        @return: None
+        """
+        if self.memory_preload:
+            static_files = tpool.execute(self.preload_static_files)
+            for path, static_file in static_files:
+                self.add_static_file(path, static_file)
+            logger.debug(f'preload {len(self.static_files)} static files with {self.memory_used} bytes')
+        while not self.stopped:
+            eventlet.sleep(self.memory_check_interval)
+            if not self.static_files:
+                continue
+            changed = tpool.execute(self.get_changed_paths, list(self.static_files.items()))
+            for path in changed:
+                self.remove_static_file(path)
+            changed and logger.debug(f'invalidate {len(changed)} changed static files')
+
+    def start(self) -> None:
+        """ 生命周期 - 启动阶段
+
+        @return: None
+        """
+        if not self.memory_cache:
+            return
+        tid = f'{self}.self_check_static_files'
+        self.producer.container.spawn_splits_thread(self.check_static_files, tid=tid)
+
+    def stop(self) -> None:
+        """ 生命周期 - 停止阶段
+
+        @return: None
+        """
+        self.stopped = True
+
+    def __call__(self, environ: WSGIEnvironment, start_response: StartResponse) -> t.Iterable[bytes]:
+        """ 请求处理器
+
+        @param environ: 环境对象
+        @param start_response: 响应对象
+        @return: t.Iterable[bytes]
+        """
+        if not self.memory_cache:
+            return BaseSharedDataMiddleware.__call__(self, environ, start_response)
+        path = get_path_info(environ)
+        static_file = self.static_files.get(path)
+        if static_file is not None:
+            return static_file(environ, start_response)
+        filename = self.resolve_filename(path)
+        if filename is None or not self.is_allowed(os.path.basename(filename)):
+            return BaseSharedDataMiddleware.__call__(self, environ, start_response)
+        # 读文件以及计算ETag在系统线程中执行,只阻塞当前请求的协程
+        static_file = tpool.execute(self.load_static_file, filename)
+        if not self.add_static_file(path, static_file):
+            return BaseSharedDataMiddleware.__call__(self, environ, start_response)
+        return static_file(environ, start_response)
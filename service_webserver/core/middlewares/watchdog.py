@@ -0,0 +1,259 @@
+#! -*- coding: utf-8 -*-
+#
+# author: forcemain@163.com
+
+from __future__ import annotations
+
+import time
+import eventlet
+import traceback
+import typing as t
+
+from logging import getLogger
+from urllib.parse import parse_qs
+from service_webserver.core.response import JsonResponse
+from service_core.core.service.entrypoint import Entrypoint
+
+if t.TYPE_CHECKING:
+    # 由于其定义在存根文件所以需要在TYPE_CHECKING下
+    from werkzeug.wsgi import WSGIApplication
+    from werkzeug.wsgi import WSGIEnvironment
+    from werkzeug.wrappers.response import StartResponse
+    from service_webserver.core.inflight import InflightRequest
+
+from .base import BaseMiddleware
+from .base import is_admin_authorized
+
+logger = getLogger(__name__)
+
+
+class WatchdogMiddleware(BaseMiddleware):
+    """ 慢请求看门狗中间件类
+
+    后台协程定时扫描在途请求,处理时间超过阈值的请求记录一次告警日志,包括路由/请求标识/耗时及工作协程的调用栈,
+    告警日志按时间窗口限流
+
+    注意: 看门狗本身也是协程,视图函数阻塞事件循环时无法执行
+
+    管理接口(设置admin_token后启用):
+        GET  {admin_url}            在途请求及其处理时间,可选?stacks=1返回调用栈
+    """
+
+    # 请求登记由WsgiApp完成,中间件只提供管理接口,业务路由无需经过
+    apply_to_routes = False
+
+    def __init__(
+            self, *,
+            wsgi_app: WSGIApplication,
+            producer: Entrypoint,
+            threshold: float = 10.0,
+            interval: float = 1.0,
+            max_reports: int = 10,
+            report_period: float = 60.0,
+            max_depth: int = 32,
+            admin_url: t.Text = '/_watchdog',
+            admin_token: t.Optional[t.Text] = None
+    ) -> None:
+        """ 初始化实例
+
+        @param wsgi_app: 应用程序
+        @param producer: 服务提供者
+        @param threshold: 慢请求阈值秒数
+        @param interval: 扫描间隔秒数
+        @param max_reports: 每个时间窗口最多记录的告警数
+        @param report_period: 时间窗口秒数
+        @param max_depth: 每个调用栈最多保留的帧数(靠近栈顶的部分)
+        @param admin_url: 管理接口地址
+        @param admin_token: 管理接口令牌,通过Authorization: Bearer传入,未设置时关闭管理接口
+        """
+        super(WatchdogMiddleware, self).__init__(wsgi_app=wsgi_app, producer=producer)
+        self.threshold = threshold
+        self.interval = interval
+        self.max_reports = max_reports
+        self.report_period = report_period
+        self.max_depth = max_depth
+        self.admin_url = admin_url.rstrip('/')
+        self.admin_token = admin_token
+        self.stopped = False
+        # 已经告警过的请求,请求结束后移除
+        self.reported: t.Set[InflightRequest] = set()
+        # 当前时间窗口的开始时间及已记录/被抑制的告警数
+        self.window_start = 0.0
+        self.window_reports = 0
+        self.suppressed = 0
+        self.slow_count = 0
+
+    def get_claimed_paths(self) -> t.Tuple[t.Iterable[t.Text], t.Iterable[t.Text]]:
+        """ 获取由中间件自身处理的路径
+
+        @return: t.Tuple[t.Iterable[t.Text], t.Iterable[t.Text]] - (完整路径, 路径前缀)
+        """
+        # 未设置令牌时不提供管理接口
+        return ((), ()) if self.admin_token is None else ((self.admin_url,), ())
+    @staticmethod
+    def get_route_name(request: InflightRequest) -> t.Text:
+        """ 获取请求的路由名称
+
+        @param request: 在途请求
+        @return: t.Text
+        """
+        route = request.route
+        return '[fallback]' if route is None else f'{",".join(sorted(route.methods))} {route.raw_url}'
+
+    @staticmethod
+    def get_request_id(request: InflightRequest) -> t.Optional[t.Text]:
+        """ 获取工作上下文中的请求标识
+
+        @param request: 在途请求
+        @return: t.Optional[t.Text]
+        """
+        for gt in request.greenlets[1:]:
+            context = getattr(gt, 'context', None)
+            request_id = getattr(context, 'worker_request_id', None)
+            if request_id is not None:
+                return request_id
+        return None
+
+    def get_stacks(self, request: InflightRequest) -> t.List[t.Text]:
+        """ 获取处理此请求的协程的调用栈
+
+        @param request: 在途请求
+        @return: t.List[t.Text]
+        """
+        stacks = []
+        # 优先展示工作协程,接收请求的协程通常只是在等待结果
+        for gt in reversed(request.greenlets):
+            frame = gt.gr_frame
+            if frame is None:
+                continue
+            stack = traceback.format_stack(frame)[-self.max_depth:]
+            stacks.append(''.join(stack))
+        return stacks
+
+    def allow_report(self, now: float) -> bool:
+        """ 按时间窗口限流告警
+
+        @param now: 当前时间
+        @return: bool
+        """
+        if now - self.window_start >= self.report_period:
+            self.suppressed and logger.warning(f'{self.suppressed} slow request reports suppressed')
+            self.window_start, self.window_reports, self.suppressed = now, 0, 0
+        if self.window_reports >= self.max_reports:
+            self.suppressed += 1
+            return False
+        self.window_reports += 1
+        return True
+
+    def report(self, request: InflightRequest, elapsed: float, now: float) -> None:
+        """ 记录慢请求
+
+        @param request: 在途请求
+        @param elapsed: 已处理秒数
+        @param now: 当前时间
+        @return: None
+        """
+        self.slow_count += 1
+        if not self.allow_report(now):
+            return
+        environ = request.environ
+        stacks = '\n'.join(self.get_stacks(request)) or 'no suspended greenthread\n'
+        logger.warning(
+            f'slow request {self.get_route_name(request)} '
+            f'path={environ.get("PATH_INFO")} request_id={self.get_request_id(request)} '
+            f'elapsed={elapsed:.3f}s, greenthread stacks:\n{stacks}'
+        )
+
+    def scan(self) -> None:
+        """ 扫描一次在途请求
+
+        @return: None
+        """
+        now = time.monotonic()
+        requests = set(self.producer.inflight.requests.values())
+        # 已结束的请求无需再记住
+        self.reported.intersection_update(requests)
+        for request in requests:
+            elapsed = now - request.start_time
+            if elapsed < self.threshold or request in self.reported:
+                continue
+            self.reported.add(request)
+            self.report(request, elapsed, now)
+
+    def watch_requests(self) -> None:
+        """ 定时扫描在途请求
+
+        @return: None
+        """
+        while not self.stopped:
+            eventlet.sleep(self.interval)
+            try:
+                self.scan()
+            except Exception as e:
+                logger.error(f'watchdog scan failed, {e}')
+
+    def start(self) -> None:
+        """ 生命周期 - 启动阶段
+
+        @return: None
+        """
+        self.producer.inflight.enable()
+        tid = f'{self}.self_watch_requests'
+        self.producer.container.spawn_splits_thread(self.watch_requests, tid=tid)
+
+    def stop(self) -> None:
+        """ 生命周期 - 停止阶段
+
+        @return: None
+        """
+        if self.stopped:
+            return
+        self.stopped = True
+        self.producer.inflight.disable()
+
+    def get_inflight(self, environ: WSGIEnvironment, with_stacks: bool) -> t.List[t.Dict[t.Text, t.Any]]:
+        """ 获取在途请求列表
+
+        @param environ: 管理接口请求的环境对象,不出现在列表中
+        @param with_stacks: 是否包括调用栈
+        @return: t.List[t.Dict[t.Text, t.Any]]
+        """
+        now = time.monotonic()
+        inflight = []
+        for request in sorted(set(self.producer.inflight.requests.values()), key=lambda r: r.start_time):
+            if request.environ is environ:
+                continue
+            item = {
+                'route': self.get_route_name(request),
+                'method': request.environ.get('REQUEST_METHOD'),
+                'path': request.environ.get('PATH_INFO'),
+                'request_id': self.get_request_id(request),
+                'age': round(now - request.start_time, 3),
+                'slow': request in self.reported,
+            }
+            with_stacks and item.update({'stacks': self.get_stacks(request)})
+            inflight.append(item)
+        return inflight
+
+    def __call__(self, environ: WSGIEnvironment, start_response: StartResponse) -> t.Iterable[bytes]:
+        """ 请求处理器
+
+        @param environ: 环境对象
+        @param start_response: 响应对象
+        @return: t.Iterable[bytes]
+        """
+        # 未设置令牌时不提供管理接口
+        if self.admin_token is None or environ.get('PATH_INFO') != self.admin_url:
+            return self.wsgi_app(environ, start_response)
+        if not is_admin_authorized(environ, self.admin_token):
+            return JsonResponse({'error': 'forbidden'}, status=403)(environ, start_response)
+        if environ['REQUEST_METHOD'] != 'GET':
+            return JsonResponse({'error': 'method not allowed'}, status=405)(environ, start_response)
+        query = parse_qs(environ.get('QUERY_STRING', ''))
+        with_stacks = query.get('stacks', ['0'])[0] not in ('0', 'false', '')
+        data = {
+            'threshold': self.threshold,
+            'slow_count': self.slow_count,
+            'inflight': self.get_inflight(environ, with_stacks),
+        }
+        return JsonResponse(data)(environ, start_response)
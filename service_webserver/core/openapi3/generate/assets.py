@@ -96,7 +96,8 @@ def get_swagger_ui_html(
         oauth2_init: t.Optional[t.Dict[t.Text, t.Any]] = None,
         swagger_favicon_url: t.Optional[t.Text] = None,
         swagger_css_url: t.Optional[t.Text] = None,
-        swagger_js_url: t.Optional[t.Text] = None
+        swagger_js_url: t.Optional[t.Text] = None,
+        openapi_index_url: t.Optional[t.Text] = None
 ) -> t.Text:
     """ 获取SwaggerUI接口列表页内容
 
@@ -107,6 +108,7 @@ def get_swagger_ui_html(
     @param swagger_favicon_url: 图标地址
     @param swagger_css_url: 样式的地址
     @param swagger_js_url:  JS的 地址
+    @param openapi_index_url: 标签文档索引地址,设置后以下拉框切换标签文档
     @return: t.Text
     """
     swagger_favicon_url = swagger_favicon_url or 'https://fastapi.tiangolo.com/img/favicon.png'
@@ -126,6 +128,16 @@ def get_swagger_ui_html(
     <script src="{swagger_js_url}"></script>
     <!-- `SwaggerUIBundle` is now available on the page -->
     <script>
+    """
+    # 索引格式与urls配置一致,下拉框切换时才加载对应的标签文档
+    if openapi_index_url:
+        html += f"""
+    fetch('{openapi_index_url}').then(function (r) {{ return r.json() }}).then(function (index) {{
+    const ui = SwaggerUIBundle({{
+        urls: index.urls,
+    """
+    else:
+        html += f"""
     const ui = SwaggerUIBundle({{
         url: '{openapi_url}',
     """
@@ -146,6 +158,9 @@ def get_swagger_ui_html(
         html += f"""
         ui.initOAuth({cjson.dumps(jsonable_encoder(oauth2_init))})
         """
+    if openapi_index_url:
+        html += """
+    })"""
     html += """
     </script>
     </body>
@@ -159,7 +174,8 @@ def get_redoc_html(
         openapi_url: t.Text,
         redoc_favicon_url: t.Optional[t.Text] = None,
         redoc_js_url: t.Optional[t.Text] = None,
-        with_google_fonts: bool = True
+        with_google_fonts: bool = True,
+        openapi_index_url: t.Optional[t.Text] = None
 ) -> t.Text:
     """ 获取Redoc UI接口列表页内容
 
@@ -168,6 +184,7 @@ def get_redoc_html(
     @param redoc_js_url: JS的地址
     @param redoc_favicon_url: 图标地址
     @param with_google_fonts: 谷歌字体
+    @param openapi_index_url: 标签文档索引地址,设置后以下拉框切换标签文档
     @return: t.Text
     """
     redoc_favicon_url = redoc_favicon_url or 'https://fastapi.tiangolo.com/img/favicon.png'
@@ -195,9 +212,29 @@ def get_redoc_html(
     </style>
     </head>
     <body>
+    """
+    if not openapi_index_url:
+        html += f"""
     <redoc spec-url="{openapi_url}"></redoc>
     <script src="{redoc_js_url}"> </script>
     </body>
     </html>
+    """
+        return html
+    html += f"""
+    <select id="redoc-urls" style="margin: 8px;"></select>
+    <div id="redoc-container"></div>
+    <script src="{redoc_js_url}"> </script>
+    <script>
+    const select = document.getElementById('redoc-urls');
+    const container = document.getElementById('redoc-container');
+    select.onchange = function () {{ Redoc.init(select.value, {{}}, container) }};
+    fetch('{openapi_index_url}').then(function (r) {{ return r.json() }}).then(function (index) {{
+        index.urls.forEach(function (u) {{ select.add(new Option(u.name, u.url)) }});
+        index.urls.length && select.onchange();
+    }});
+    </script>
+    </body>
+    </html>
     """
     return html
@@ -4,9 +4,39 @@
 
 from __future__ import annotations
 
+import typing as t
+
 from werkzeug.wrappers.request import Request as BaseRequest
+from service_webserver.core.body_limit import LimitedPartFile
+from service_webserver.core.body_limit import MAX_BODY_SIZE_ENVIRON_KEY
+from service_webserver.core.body_limit import MAX_PART_SIZE_ENVIRON_KEY
 
 
 class Request(BaseRequest):
     """ 默认请求基类 """
-    pass
+
+    @property
+    def max_content_length(self) -> t.Optional[int]:
+        """ 请求体的最大字节数 """
+        return self.environ.get(MAX_BODY_SIZE_ENVIRON_KEY)
+
+    def _get_file_stream(
+            self,
+            total_content_length: t.Optional[int],
+            content_type: t.Optional[t.Text],
+            filename: t.Optional[t.Text] = None,
+            content_length: t.Optional[int] = None
+    ) -> t.BinaryIO:
+        """ 获取上传文件的写入对象
+
+        注意: 普通表单字段仍只受请求体总大小的限制,werkzeug的max_form_memory_size限制的是解析缓冲区而非单个字段
+
+        @param total_content_length: 请求体的总字节数
+        @param content_type: 文件类型
+        @param filename: 文件名称
+        @param content_length: 文件字节数
+        @return: t.BinaryIO
+        """
+        stream = super(Request, self)._get_file_stream(total_content_length, content_type, filename, content_length)
+        max_part_size = self.environ.get(MAX_PART_SIZE_ENVIRON_KEY)
+        return stream if max_part_size is None else LimitedPartFile(self.environ, stream, max_part_size)
@@ -4,16 +4,39 @@
 
 from __future__ import annotations
 
+import os
+import sys
 import html
+import stat
+import uuid
+import eventlet
 import typing as t
 
 from http import HTTPStatus
+from eventlet.queue import Empty
+from eventlet.queue import LightQueue
+from werkzeug.http import parse_date
+from werkzeug.http import parse_etags
 from werkzeug.urls import iri_to_uri
 from werkzeug.wsgi import FileWrapper
+from werkzeug.http import unquote_etag
+from werkzeug.datastructures import Headers
+from werkzeug.http import parse_range_header
+from werkzeug.http import parse_if_range_header
 from service_green.core.green import cjson
 from werkzeug.utils import get_content_type
+from service_webserver.core.compress import compress_bytes
+from service_webserver.core.compress import negotiate_encoding
+from service_webserver.core.file_wrapper import SendfileWrapper
+from service_webserver.core.compress import get_available_encodings
+from service_webserver.core.compress import DEFAULT_PRECOMPRESS_LEVELS
 from werkzeug.wrappers.response import Response as BaseResponse
 
+if t.TYPE_CHECKING:
+    # 由于其定义在存根文件所以需要在TYPE_CHECKING下
+    from werkzeug.wrappers.response import StartResponse
+    from werkzeug.wrappers.request import WSGIEnvironment
+
 # 响应内容
 HttpResponse = t.Optional[t.Union[t.Iterable[bytes], bytes, t.Iterable[str], str]]
 # 响应状态
@@ -30,8 +53,15 @@ __all__ = ['Response',
            'JsonResponse',
            'RedirectResponse',
            'PlainTextResponse',
+           'RangeResponse',
            'StreamResponse',
-           'FileResponse']
+           'FileResponse',
+           'StreamingJsonResponse',
+           'NDJSONResponse',
+           'ServerSentEvent',
+           'EventStreamResponse',
+           'StaticResponse',
+           'PrecompressedResponse']
 
 
 class Response(BaseResponse):
@@ -190,7 +220,213 @@ class RedirectResponse(Response):
         super(RedirectResponse, self).__init__(response, status, headers, mimetype, content_type, direct_passthrough)
 
 
-class StreamResponse(Response):
+class RangeResponse(Response):
+    """ 分段格式响应基类
+
+    doc: https://www.rfc-editor.org/rfc/rfc7233
+    """
+
+    buffer_size = 8192
+    # 单个请求允许的最大分段数,超过时忽略Range返回完整内容
+    max_ranges = 16
+    mimetype = 'application/octet-stream'
+
+    def __init__(
+            self,
+            response: t.Optional[t.BinaryIO] = None,
+            status: HTTPStatus = HTTPStatus.OK.value,
+            headers: HTTPDictHeaders = None,
+            mimetype: t.Optional[t.Text] = None,
+            content_type: t.Optional[t.Text] = None,
+            direct_passthrough: bool = False
+    ) -> None:
+        """ 初始化实例
+
+        @param response: 文件对象
+        @param status  : 响应状态
+        @param headers : 头部信息
+        @param mimetype: 内容类型
+        @param content_type: 响应类型
+        @param direct_passthrough: 是否以流式直传?
+        """
+        self.file = response
+        self.file_offset, self.file_size = self.get_file_range(response)
+        headers = headers or {}
+        self.file_size is None or headers.setdefault('Accept-Ranges', 'bytes')
+        mimetype = mimetype or self.mimetype
+        direct_passthrough = direct_passthrough or True
+        response = FileWrapper(response, buffer_size=self.buffer_size)  # type: ignore
+        super(RangeResponse, self).__init__(response, status, headers, mimetype, content_type, direct_passthrough)
+
+    @staticmethod
+    def get_file_range(file: t.Optional[t.BinaryIO]) -> t.Tuple[int, t.Optional[int]]:
+        """ 获取当前偏移和剩余可读的字节数
+
+        @param file: 文件对象
+        @return: t.Tuple[int, t.Optional[int]]
+        """
+        try:
+            if not file.seekable():
+                return 0, None
+            offset = file.tell()
+            size = file.seek(0, os.SEEK_END) - offset
+            file.seek(offset)
+            return offset, size
+        except (AttributeError, OSError, ValueError):
+            return 0, None
+
+    def is_range_fresh(self, environ: WSGIEnvironment) -> bool:
+        """ 根据If-Range判断分段请求是否依然有效
+
+        @param environ: 环境对象
+        @return: bool
+        """
+        value = environ.get('HTTP_IF_RANGE')
+        if not value:
+            return True
+        # If-Range只允许强比较,弱ETag永远不匹配
+        if value.strip().startswith('W/'):
+            return False
+        if_range = parse_if_range_header(value)
+        if if_range.etag is not None:
+            etag, weak = unquote_etag(self.headers.get('ETag'))
+            return not weak and etag == if_range.etag
+        last_modified = parse_date(self.headers.get('Last-Modified'))
+        return last_modified is not None and last_modified == if_range.date
+
+    def get_byte_ranges(self, environ: WSGIEnvironment) -> t.Optional[t.List[t.Tuple[int, int]]]:
+        """ 解析出需要发送的分段
+
+        @param environ: 环境对象
+        @return: t.Optional[t.List[t.Tuple[int, int]]] None表示发送完整内容,空列表表示无法满足
+        """
+        value = environ.get('HTTP_RANGE')
+        if not value or self.file_size is None or self.status_code != HTTPStatus.OK.value:
+            return None
+        if environ.get('REQUEST_METHOD') not in ('GET', 'HEAD') or not self.is_range_fresh(environ):
+            return None
+        byte_range = parse_range_header(value)
+        # 语法错误或分段过多时按规范忽略Range头部
+        if byte_range is None or byte_range.units != 'bytes' or len(byte_range.ranges) > self.max_ranges:
+            return None
+        ranges = []
+        for begin, end in byte_range.ranges:
+            if begin < 0:
+                start, stop = max(self.file_size + begin, 0), self.file_size
+            else:
+                start, stop = begin, self.file_size if end is None else min(end, self.file_size)
+            start < stop and ranges.append((start, stop))
+        merged: t.List[t.Tuple[int, int]] = []
+        # 合并重叠或相邻的分段避免重复发送
+        for start, stop in sorted(ranges):
+            if merged and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+            else:
+                merged.append((start, stop))
+        return merged
+
+    def iter_file_range(self, start: int, length: int) -> t.Iterator[bytes]:
+        """ 读取单个分段
+
+        @param start: 相对偏移
+        @param length: 分段长度
+        @return: t.Iterator[bytes]
+        """
+        self.file.seek(self.file_offset + start)
+        while length > 0:
+            data = self.file.read(min(self.buffer_size, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+
+    def iter_single_range(self, start: int, length: int) -> t.Iterator[bytes]:
+        """ 发送单个分段并关闭文件
+
+        @param start: 相对偏移
+        @param length: 分段长度
+        @return: t.Iterator[bytes]
+        """
+        try:
+            yield from self.iter_file_range(start, length)
+        finally:
+            self.file.close()
+
+    def iter_multi_ranges(self, parts: t.List[t.Tuple[bytes, int, int]], tail: bytes) -> t.Iterator[bytes]:
+        """ 以multipart/byteranges发送多个分段并关闭文件
+
+        @param parts: 分段头部及其起止位置
+        @param tail: 结束边界
+        @return: t.Iterator[bytes]
+        """
+        try:
+            for head, start, stop in parts:
+                yield head
+                yield from self.iter_file_range(start, stop - start)
+            yield tail
+        finally:
+            self.file.close()
+
+    def make_range_body(self, environ: WSGIEnvironment, start: int, length: int) -> t.Iterable[bytes]:
+        """ 生成单个分段的响应体
+
+        @param environ: 环境对象
+        @param start: 相对偏移
+        @param length: 分段长度
+        @return: t.Iterable[bytes]
+        """
+        return self.iter_single_range(start, length)
+
+    def make_full_body(self, environ: WSGIEnvironment) -> t.Iterable[bytes]:
+        """ 生成完整内容的响应体
+
+        @param environ: 环境对象
+        @return: t.Iterable[bytes]
+        """
+        return self.response
+
+    def __call__(self, environ: WSGIEnvironment, start_response: StartResponse) -> t.Iterable[bytes]:
+        """ 请求处理器
+
+        @param environ: 环境对象
+        @param start_response: 响应对象
+        @return: t.Iterable[bytes]
+        """
+        ranges = self.get_byte_ranges(environ)
+        if ranges is None:
+            self.response = self.make_full_body(environ)
+        elif not ranges:
+            self.file.close()
+            self.response = []
+            self.status_code = HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE.value
+            self.headers['Content-Range'] = f'bytes */{self.file_size}'
+            self.headers['Content-Length'] = '0'
+        elif len(ranges) == 1:
+            start, stop = ranges[0]
+            self.status_code = HTTPStatus.PARTIAL_CONTENT.value
+            self.headers['Content-Range'] = f'bytes {start}-{stop - 1}/{self.file_size}'
+            self.headers['Content-Length'] = str(stop - start)
+            self.response = self.make_range_body(environ, start, stop - start)
+        else:
+            boundary = uuid.uuid4().hex
+            content_type = self.headers.get('Content-Type', self.mimetype)
+            parts = [((
+                f'\r\n--{boundary}\r\n'
+                f'Content-Type: {content_type}\r\n'
+                f'Content-Range: bytes {start}-{stop - 1}/{self.file_size}\r\n\r\n'
+            ).encode('latin-1'), start, stop) for start, stop in ranges]
+            tail = f'\r\n--{boundary}--\r\n'.encode('latin-1')
+            length = sum(len(head) + stop - start for head, start, stop in parts) + len(tail)
+            self.status_code = HTTPStatus.PARTIAL_CONTENT.value
+            self.headers['Content-Type'] = f'multipart/byteranges; boundary={boundary}'
+            self.headers['Content-Length'] = str(length)
+            self.response = self.iter_multi_ranges(parts, tail)
+        # HEAD请求不会迭代响应体,需主动关闭文件
+        environ.get('REQUEST_METHOD') == 'HEAD' and self.file.close()
+        return super(RangeResponse, self).__call__(environ, start_response)
+
+
+class StreamResponse(RangeResponse):
     """ 流式格式响应类 """
 
     buffer_size = 8192
@@ -209,6 +445,8 @@ class StreamResponse(Response):
 
         doc: werkzeug.utils.wrap_file
 
+        注意: 可定位的文件对象支持Range分段请求
+
         @param response: 响应内容
         @param status  : 响应状态
         @param headers : 头部信息
@@ -216,20 +454,18 @@ class StreamResponse(Response):
         @param content_type: 响应类型
         @param direct_passthrough: 是否以流式直传?
         """
-        mimetype = mimetype or self.mimetype
-        direct_passthrough = direct_passthrough or True
-        response = FileWrapper(response, buffer_size=self.buffer_size)  # type: ignore
         super(StreamResponse, self).__init__(response, status, headers, mimetype, content_type, direct_passthrough)
 
 
-class FileResponse(Response):
+class FileResponse(RangeResponse):
     """ 文件格式响应 """
 
+    buffer_size = 262144
     mimetype = 'application/octet-stream'
 
     def __init__(
             self,
-            response: HttpResponse = None,
+            response: t.Optional[t.Union[t.BinaryIO, t.Text, os.PathLike]] = None,
             status: HTTPStatus = HTTPStatus.OK.value,
             headers: HTTPDictHeaders = None,
             mimetype: t.Optional[t.Text] = None,
@@ -240,14 +476,588 @@ class FileResponse(Response):
 
         doc: werkzeug.utils.wrap_file
 
-        @param response: 响应内容
+        注意: 服务器提供wsgi.file_wrapper时非TLS连接会使用os.sendfile零拷贝发送
+
+        @param response: 文件对象或文件路径
         @param status  : 响应状态
         @param headers : 头部信息
         @param mimetype: 内容类型
         @param content_type: 响应类型
         @param direct_passthrough: 是否以流式直传?
         """
-        mimetype = mimetype or self.mimetype
-        direct_passthrough = direct_passthrough or True
-        response = FileWrapper(response, buffer_size=self.buffer_size)  # type: ignore
+        if isinstance(response, (str, os.PathLike)):
+            response = open(response, 'rb')
+        headers = headers or {}
+        file_size = self.get_file_size(response)
+        file_size is None or headers.setdefault('Content-Length', str(file_size))
         super(FileResponse, self).__init__(response, status, headers, mimetype, content_type, direct_passthrough)
+
+    @staticmethod
+    def get_file_size(file: t.Optional[t.BinaryIO]) -> t.Optional[int]:
+        """ 获取普通文件剩余可读的字节数
+
+        @param file: 文件对象
+        @return: t.Optional[int]
+        """
+        try:
+            file_stat = os.fstat(file.fileno())
+            if not stat.S_ISREG(file_stat.st_mode):
+                return None
+            return file_stat.st_size - file.tell()
+        except (AttributeError, OSError, ValueError):
+            return None
+
+    def make_full_body(self, environ: WSGIEnvironment) -> t.Iterable[bytes]:
+        """ 生成完整内容的响应体
+
+        @param environ: 环境对象
+        @return: t.Iterable[bytes]
+        """
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        # 优先使用服务器提供的文件包装器以便其可以直接发送文件描述符
+        if file_wrapper is None or not isinstance(self.response, FileWrapper):
+            return self.response
+        return file_wrapper(self.file, self.buffer_size)
+
+    def make_range_body(self, environ: WSGIEnvironment, start: int, length: int) -> t.Iterable[bytes]:
+        """ 生成单个分段的响应体
+
+        @param environ: 环境对象
+        @param start: 相对偏移
+        @param length: 分段长度
+        @return: t.Iterable[bytes]
+        """
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        response = file_wrapper(self.file, self.buffer_size) if file_wrapper is not None else None
+        # 只有支持限制长度的文件包装器才能用于发送分段
+        if not isinstance(response, SendfileWrapper):
+            return self.iter_single_range(start, length)
+        self.file.seek(self.file_offset + start)
+        response.length = length
+        return response
+
+
+class StreamingJsonResponse(Response):
+    """ JSON流式响应类 """
+
+    chunk_size = 65536
+    mimetype = 'application/json'
+
+    def __init__(
+            self,
+            response: t.Optional[t.Iterable[t.Any]] = None,
+            status: HTTPStatus = HTTPStatus.OK.value,
+            headers: HTTPDictHeaders = None,
+            mimetype: t.Optional[t.Text] = None,
+            content_type: t.Optional[t.Text] = None,
+            direct_passthrough: bool = False,
+            envelope: t.Optional[t.Dict[t.Text, t.Any]] = None,
+            chunk_size: t.Optional[int] = None
+    ) -> None:
+        """ 初始化实例
+
+        注意: 未声明Content-Length时eventlet会自动以chunked编码逐块发送
+
+        @param response: 可迭代数据
+        @param status  : 响应状态
+        @param headers : 头部信息
+        @param mimetype: 内容类型
+        @param content_type: 响应类型
+        @param direct_passthrough: 是否以流式直传?
+        @param envelope: 外层信封字段,数据将作为其data字段的数组
+        @param chunk_size: 每次刷出的字节数
+        """
+        mimetype = mimetype or self.mimetype
+        self.chunk_size = chunk_size or self.chunk_size
+        response = self.iter_json_chunks(response or (), envelope)
+        super(StreamingJsonResponse, self).__init__(response, status, headers, mimetype, content_type,
+                                                    direct_passthrough)
+
+    @staticmethod
+    def _to_bytes(data: t.Union[t.Text, bytes]) -> bytes:
+        """ 转换为字节串
+
+        @param data: 编码结果
+        @return: bytes
+        """
+        return data.encode('utf-8') if isinstance(data, str) else data
+
+    def iter_json_chunks(
+            self,
+            items: t.Iterable[t.Any],
+            envelope: t.Optional[t.Dict[t.Text, t.Any]] = None
+    ) -> t.Iterator[bytes]:
+        """ 逐项编码并按块产出
+
+        @param items: 可迭代数据
+        @param envelope: 外层信封字段
+        @return: t.Iterator[bytes]
+        """
+        if envelope is None:
+            prefix, suffix = b'[', b']'
+        else:
+            # 信封中其它字段先整体编码再截掉结尾的}拼接上data数组的开头
+            head = self._to_bytes(cjson.dumps(envelope)).rstrip()[:-1].rstrip()
+            prefix = head + (b',"data":[' if head != b'{' else b'"data":[')
+            suffix = b']}'
+        buffer, separator = bytearray(prefix), b''
+        try:
+            for item in items:
+                buffer += separator
+                buffer += self._to_bytes(cjson.dumps(item))
+                separator = b','
+                # 峰值内存只与块大小相关而与结果集的大小无关
+                if len(buffer) < self.chunk_size:
+                    continue
+                yield bytes(buffer)
+                buffer.clear()
+            buffer += suffix
+            yield bytes(buffer)
+        finally:
+            # 客户端提前断开时及时关闭上游生成器释放其持有的资源
+            close = getattr(items, 'close', None)
+            close and close()
+
+
+class ServerSentEvent(object):
+    """ 服务端推送事件 """
+
+    __slots__ = ('data', 'event', 'id', 'retry')
+
+    def __init__(
+            self,
+            data: t.Any = None,
+            event: t.Optional[t.Text] = None,
+            id: t.Optional[t.Text] = None,
+            retry: t.Optional[int] = None
+    ) -> None:
+        """ 初始化实例
+
+        @param data : 事件数据,非字符串时以JSON编码
+        @param event: 事件类型
+        @param id   : 事件标识
+        @param retry: 重连间隔(毫秒)
+        """
+        self.data = data
+        self.event = event
+        self.id = id
+        self.retry = retry
+
+    def encode(self) -> bytes:
+        """ 编码为事件帧
+
+        doc: https://html.spec.whatwg.org/multipage/server-sent-events.html
+
+        @return: bytes
+        """
+        frame = []
+        self.id is not None and frame.append(f'id: {self.id}')
+        self.event is not None and frame.append(f'event: {self.event}')
+        self.retry is not None and frame.append(f'retry: {int(self.retry)}')
+        data = self.data
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+        if data is not None and not isinstance(data, str):
+            data = cjson.dumps(data)
+            data = data.decode('utf-8') if isinstance(data, bytes) else data
+        # 多行数据需要拆分为多个data字段,客户端会以换行符重新拼接
+        data is not None and frame.extend(f'data: {line}' for line in data.splitlines() or [''])
+        return ('\n'.join(frame) + '\n\n').encode('utf-8')
+
+
+class GreenStreamIterator(object):
+    """ 带心跳的流式迭代器 """
+
+    # 生产结束标志
+    sentinel = object()
+
+    def __init__(
+            self,
+            iterable: t.Iterable[t.Any],
+            frame: t.Callable[[t.Any], bytes],
+            heartbeat: t.Optional[bytes] = None,
+            heartbeat_interval: t.Optional[float] = None
+    ) -> None:
+        """ 初始化实例
+
+        @param iterable: 数据生成器
+        @param frame: 数据帧编码器
+        @param heartbeat: 心跳帧
+        @param heartbeat_interval: 空闲多久发送心跳(秒)
+        """
+        self.frame = frame
+        self.iterable = iterable
+        self.heartbeat = heartbeat
+        self.heartbeat_interval = heartbeat_interval
+        self.gt, self.queue, self.iterator = None, None, None
+        if heartbeat is not None and heartbeat_interval:
+            # 容量为1保证生产者不会比客户端的消费速度快太多
+            self.queue = LightQueue(maxsize=1)
+            self.gt = eventlet.spawn(self.produce)
+        else:
+            self.iterator = iter(iterable)
+
+    def produce(self) -> None:
+        """ 在独立协程中消费生成器
+
+        @return: None
+        """
+        try:
+            for item in self.iterable:
+                self.queue.put((item, None))
+            self.queue.put((self.sentinel, None))
+        except Exception:
+            self.queue.put((self.sentinel, sys.exc_info()))
+        finally:
+            close = getattr(self.iterable, 'close', None)
+            close and close()
+
+    def __iter__(self) -> GreenStreamIterator:
+        return self
+
+    def __next__(self) -> bytes:
+        if self.iterator is not None:
+            return self.frame(next(self.iterator))
+        try:
+            item, excinfo = self.queue.get(timeout=self.heartbeat_interval)
+        except Empty:
+            # 空闲时发送心跳,同时也能及时探测到客户端已经断开连接
+            return self.heartbeat
+        if item is not self.sentinel:
+            return self.frame(item)
+        if excinfo is not None:
+            raise excinfo[1].with_traceback(excinfo[2])
+        raise StopIteration
+
+    def close(self) -> None:
+        """ 客户端断开或响应结束时释放资源
+
+        @return: None
+        """
+        # 杀死生产者协程时GreenletExit会在生成器挂起处抛出并执行其finally
+        self.gt is not None and self.gt.kill()
+        close = getattr(self.iterable, 'close', None)
+        close and close()
+
+
+class NDJSONResponse(Response):
+    """ NDJSON格式响应类 """
+
+    heartbeat = b'\n'
+    heartbeat_interval = 15
+    mimetype = 'application/x-ndjson'
+
+    def __init__(
+            self,
+            response: t.Optional[t.Iterable[t.Any]] = None,
+            status: HTTPStatus = HTTPStatus.OK.value,
+            headers: HTTPDictHeaders = None,
+            mimetype: t.Optional[t.Text] = None,
+            content_type: t.Optional[t.Text] = None,
+            direct_passthrough: bool = False,
+            heartbeat_interval: t.Optional[float] = None
+    ) -> None:
+        """ 初始化实例
+
+        注意: NDJSON没有注释语法,心跳为空行,客户端解析时应忽略空行
+
+        @param response: 数据生成器
+        @param status  : 响应状态
+        @param headers : 头部信息
+        @param mimetype: 内容类型
+        @param content_type: 响应类型
+        @param direct_passthrough: 是否以流式直传?
+        @param heartbeat_interval: 空闲多久发送心跳(秒),0表示关闭
+        """
+        mimetype = mimetype or self.mimetype
+        headers = headers or {}
+        headers.setdefault('Cache-Control', 'no-cache')
+        headers.setdefault('X-Accel-Buffering', 'no')
+        heartbeat_interval = self.heartbeat_interval if heartbeat_interval is None else heartbeat_interval
+        response = GreenStreamIterator(response or (), self.encode_record, self.heartbeat, heartbeat_interval)
+        super(NDJSONResponse, self).__init__(response, status, headers, mimetype, content_type, direct_passthrough)
+
+    @staticmethod
+    def encode_record(record: t.Any) -> bytes:
+        """ 编码单条记录
+
+        @param record: 记录对象
+        @return: bytes
+        """
+        data = cjson.dumps(record)
+        data = data.encode('utf-8') if isinstance(data, str) else data
+        return data + b'\n'
+
+    def __call__(self, environ: WSGIEnvironment, start_response: StartResponse) -> t.Iterable[bytes]:
+        """ 请求处理器
+
+        @param environ: 环境对象
+        @param start_response: 响应对象
+        @return: t.Iterable[bytes]
+        """
+        # 关闭eventlet的写缓冲让每条记录立即刷出
+        environ['eventlet.minimum_write_chunk_size'] = 0
+        return super(NDJSONResponse, self).__call__(environ, start_response)
+
+
+class EventStreamResponse(Response):
+    """ SSE格式响应类 """
+
+    heartbeat = b': heartbeat\n\n'
+    heartbeat_interval = 15
+    mimetype = 'text/event-stream'
+
+    def __init__(
+            self,
+            response: t.Optional[t.Iterable[t.Any]] = None,
+            status: HTTPStatus = HTTPStatus.OK.value,
+            headers: HTTPDictHeaders = None,
+            mimetype: t.Optional[t.Text] = None,
+            content_type: t.Optional[t.Text] = None,
+            direct_passthrough: bool = False,
+            heartbeat_interval: t.Optional[float] = None
+    ) -> None:
+        """ 初始化实例
+
+        @param response: 数据生成器,元素可为ServerSentEvent或任意数据
+        @param status  : 响应状态
+        @param headers : 头部信息
+        @param mimetype: 内容类型
+        @param content_type: 响应类型
+        @param direct_passthrough: 是否以流式直传?
+        @param heartbeat_interval: 空闲多久发送心跳(秒),0表示关闭
+        """
+        mimetype = mimetype or self.mimetype
+        headers = headers or {}
+        headers.setdefault('Cache-Control', 'no-cache')
+        headers.setdefault('X-Accel-Buffering', 'no')
+        heartbeat_interval = self.heartbeat_interval if heartbeat_interval is None else heartbeat_interval
+        response = GreenStreamIterator(response or (), self.encode_event, self.heartbeat, heartbeat_interval)
+        super(EventStreamResponse, self).__init__(response, status, headers, mimetype, content_type,
+                                                  direct_passthrough)
+
+    @staticmethod
+    def encode_event(event: t.Any) -> bytes:
+        """ 编码单个事件
+
+        @param event: 事件对象
+        @return: bytes
+        """
+        event = event if isinstance(event, ServerSentEvent) else ServerSentEvent(event)
+        return event.encode()
+
+    def __call__(self, environ: WSGIEnvironment, start_response: StartResponse) -> t.Iterable[bytes]:
+        """ 请求处理器
+
+        @param environ: 环境对象
+        @param start_response: 响应对象
+        @return: t.Iterable[bytes]
+        """
+        # 关闭eventlet的写缓冲让每个事件立即刷出
+        environ['eventlet.minimum_write_chunk_size'] = 0
+        return super(EventStreamResponse, self).__call__(environ, start_response)
+
+
+class StaticResponse(Response):
+    """ 预计算的不可变响应类
+
+    状态行/头部列表/响应体在初始化时一次性生成,之后每次请求直接回放
+
+    注意: 头部列表在请求之间共享,中间件不应原地修改传入start_response的头部列表
+    """
+
+    def __init__(
+            self,
+            response: HttpResponse = None,
+            status: HTTPStatus = HTTPStatus.OK.value,
+            headers: HTTPDictHeaders = None,
+            mimetype: t.Optional[t.Text] = None,
+            content_type: t.Optional[t.Text] = None,
+            direct_passthrough: bool = False
+    ) -> None:
+        """ 初始化实例
+
+        @param response: 响应内容
+        @param status  : 响应状态
+        @param headers : 头部信息
+        @param mimetype: 内容类型
+        @param content_type: 响应类型
+        @param direct_passthrough: 是否以流式直传?
+        """
+        super(StaticResponse, self).__init__(response, status, headers, mimetype, content_type, direct_passthrough)
+        self.static_status, self.static_headers, self.static_body = self.freeze()
+        self.static_empty = ()
+
+    def freeze(self) -> t.Tuple[t.Text, t.List[t.Tuple[t.Text, t.Text]], t.Tuple[bytes]]:
+        """ 生成状态行/头部列表/响应体
+
+        @return: t.Tuple[t.Text, t.List[t.Tuple[t.Text, t.Text]], t.Tuple[bytes]]
+        """
+        body = self.get_data()
+        self.headers['Content-Length'] = str(len(body))
+        return self.status, self.headers.to_wsgi_list(), (body,)
+
+    @classmethod
+    def from_response(cls, response: BaseResponse) -> StaticResponse:
+        """ 从普通响应生成不可变响应
+
+        @param response: 响应对象
+        @return: StaticResponse
+        """
+        # 保留重复的头部,如多个Link
+        headers = Headers(response.headers.to_wsgi_list())
+        return cls(response.get_data(), status=response.status_code, headers=headers)
+
+    def __call__(self, environ: WSGIEnvironment, start_response: StartResponse) -> t.Iterable[bytes]:
+        """ 请求处理器
+
+        @param environ: 环境对象
+        @param start_response: 响应对象
+        @return: t.Iterable[bytes]
+        """
+        start_response(self.static_status, self.static_headers)
+        return self.static_empty if environ['REQUEST_METHOD'] == 'HEAD' else self.static_body
+
+
+class PrecompressedResponse(StaticResponse):
+    """ 预压缩的不可变响应类
+
+    初始化时生成强ETag以及各压缩算法的变体,之后按Accept-Encoding选择变体回放并支持304
+    """
+
+    def __init__(
+            self,
+            response: HttpResponse = None,
+            status: HTTPStatus = HTTPStatus.OK.value,
+            headers: HTTPDictHeaders = None,
+            mimetype: t.Optional[t.Text] = None,
+            content_type: t.Optional[t.Text] = None,
+            direct_passthrough: bool = False,
+            encodings: t.Optional[t.List[t.Text]] = None,
+            cache_control: t.Optional[t.Text] = 'no-cache'
+    ) -> None:
+        """ 初始化实例
+
+        @param response: 响应内容
+        @param status  : 响应状态
+        @param headers : 头部信息
+        @param mimetype: 内容类型
+        @param content_type: 响应类型
+        @param direct_passthrough: 是否以流式直传?
+        @param encodings: 预压缩的算法,默认为gzip和br(需安装brotli)
+        @param cache_control: Cache-Control头部
+        """
+        self.encodings = encodings or ['br', 'gzip']
+        self.static_cache_control = cache_control
+        # 各编码变体 - {编码: (头部列表, 响应体, 304头部列表, ETag)}
+        self.variants = {}
+        super(PrecompressedResponse, self).__init__(response, status, headers, mimetype, content_type, direct_passthrough)
+
+    def freeze(self) -> t.Tuple[t.Text, t.List[t.Tuple[t.Text, t.Text]], t.Tuple[bytes]]:
+        """ 生成状态行/头部列表/响应体以及各编码变体
+
+        @return: t.Tuple[t.Text, t.List[t.Tuple[t.Text, t.Text]], t.Tuple[bytes]]
+        """
+        body = self.get_data()
+        self.static_cache_control and self.headers.setdefault('Cache-Control', self.static_cache_control)
+        self.headers['Vary'] = 'Accept-Encoding'
+        self.add_etag()
+        etag = self.headers['ETag']
+        self.headers['Content-Length'] = str(len(body))
+        headers = self.headers.to_wsgi_list()
+        self.variants['identity'] = self.gen_variant(headers, body, etag)
+        available = get_available_encodings()
+        for encoding in self.encodings:
+            if encoding not in available:
+                continue
+            data = compress_bytes(body, encoding, level=DEFAULT_PRECOMPRESS_LEVELS.get(encoding))
+            # 压缩后反而更大时不提供该变体
+            if len(data) >= len(body):
+                continue
+            # 不同编码的字节不同,强ETag需区分
+            variant_etag = f'{etag[:-1]}-{encoding}"'
+            variant_headers = []
+            for name, value in headers:
+                lower_name = name.lower()
+                if lower_name == 'etag':
+                    value = variant_etag
+                if lower_name == 'content-length':
+                    value = str(len(data))
+                variant_headers.append((name, value))
+            variant_headers.append(('Content-Encoding', encoding))
+            self.variants[encoding] = self.gen_variant(variant_headers, data, variant_etag)
+        self.static_encodings = tuple(e for e in self.encodings if e in self.variants)
+        return self.status, headers, (body,)
+
+    @staticmethod
+    def gen_variant(
+            headers: t.List[t.Tuple[t.Text, t.Text]],
+            body: bytes,
+            etag: t.Text
+    ) -> t.Tuple[t.List[t.Tuple[t.Text, t.Text]], t.Tuple[bytes], t.List[t.Tuple[t.Text, t.Text]], t.Text]:
+        """ 生成编码变体
+
+        @param headers: 头部列表
+        @param body: 响应体
+        @param etag: 强ETag
+        @return: t.Tuple[t.List[t.Tuple[t.Text, t.Text]], t.Tuple[bytes], t.List[t.Tuple[t.Text, t.Text]], t.Text]
+        """
+        # 304响应只保留缓存相关的头部
+        keeps = ('etag', 'cache-control', 'vary', 'content-location', 'expires', 'date')
+        not_modified_headers = [(k, v) for k, v in headers if k.lower() in keeps]
+        return headers, (body,), not_modified_headers, etag
+
+    @staticmethod
+    def is_not_modified(environ: WSGIEnvironment, etag: t.Text, last_modified: t.Optional[int] = None) -> bool:
+        """ 是否满足协商缓存条件
+
+        @param environ: 环境对象
+        @param etag: 变体的ETag
+        @param last_modified: 修改时间戳,None表示不支持If-Modified-Since
+        @return: bool
+        """
+        if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+        # If-None-Match优先且使用弱比较,W/前缀不影响匹配
+        if if_none_match:
+            return parse_etags(if_none_match).contains_weak(unquote_etag(etag)[0])
+        if last_modified is None:
+            return False
+        if_modified_since = parse_date(environ.get('HTTP_IF_MODIFIED_SINCE'))
+        return if_modified_since is not None and int(if_modified_since.timestamp()) >= last_modified
+
+    @staticmethod
+    def respond_variant(
+            environ: WSGIEnvironment,
+            start_response: StartResponse,
+            variants: t.Dict[t.Text, t.Tuple],
+            encodings: t.Tuple[t.Text, ...],
+            status: t.Text,
+            last_modified: t.Optional[int] = None
+    ) -> t.Any:
+        """ 按Accept-Encoding选择编码变体并开始响应,满足协商缓存条件时响应304
+
+        @param environ: 环境对象
+        @param start_response: 响应对象
+        @param variants: 各编码变体 - {编码: (头部列表, 响应体, 304头部列表, ETag)},identity为原始内容
+        @param encodings: 可选的压缩算法,按服务端优先顺序排列
+        @param status: 响应状态
+        @param last_modified: 修改时间戳,None表示不支持If-Modified-Since
+        @return: 变体的响应体,304及HEAD请求时为None
+        """
+        encoding = negotiate_encoding(environ.get('HTTP_ACCEPT_ENCODING'), encodings)
+        headers, body, not_modified_headers, etag = variants[encoding or 'identity']
+        if PrecompressedResponse.is_not_modified(environ, etag, last_modified):
+            start_response('304 Not Modified', not_modified_headers)
+            return None
+        start_response(status, headers)
+        return None if environ['REQUEST_METHOD'] == 'HEAD' else body
+
+    def __call__(self, environ: WSGIEnvironment, start_response: StartResponse) -> t.Iterable[bytes]:
+        """ 请求处理器
+
+        @param environ: 环境对象
+        @param start_response: 响应对象
+        @return: t.Iterable[bytes]
+        """
+        body = self.respond_variant(environ, start_response, self.variants, self.static_encodings, self.static_status)
+        return self.static_empty if body is None else body
@@ -0,0 +1,167 @@
+#! -*- coding: utf-8 -*-
+#
+# author: forcemain@163.com
+
+from __future__ import annotations
+
+import time
+import typing as t
+
+from array import array
+
+if t.TYPE_CHECKING:
+    # 由于其定义在存根文件所以需要在TYPE_CHECKING下
+    from werkzeug.wsgi import WSGIApplication
+    from werkzeug.wsgi import WSGIEnvironment
+    from werkzeug.wrappers.response import StartResponse
+    # MetricsRegistry引用了阶段定义,需防止循环引用
+    from service_webserver.core.metrics import MetricsRegistry
+
+# 当前请求的分阶段计时
+TIMING_ENVIRON_KEY = 'service_webserver.timing'
+# 由协议类记录的连接建立时间,只有连接上的首个请求携带
+ACCEPT_TIME_ENVIRON_KEY = 'service_webserver.accept_time'
+
+# 请求处理的各个阶段,按发生的先后顺序排列
+TIMING_PHASES = ('accept', 'route', 'middleware', 'context', 'spawn', 'handler', 'wait', 'serialize', 'send')
+# 连接建立到请求头部解析完成
+PHASE_ACCEPT = 0
+# 路由匹配
+PHASE_ROUTE = 1
+# 中间件,包括进入和返回两个方向
+PHASE_MIDDLEWARE = 2
+# 由请求头部生成工作上下文
+PHASE_CONTEXT = 3
+# 创建工作协程
+PHASE_SPAWN = 4
+# 工作协程的调度及视图函数的执行
+PHASE_HANDLER = 5
+# 工作协程结束到请求协程被唤醒
+PHASE_WAIT = 6
+# 由结果生成响应对象,包括序列化
+PHASE_SERIALIZE = 7
+# 发送响应体
+PHASE_SEND = 8
+
+
+class RequestTiming(object):
+    """ 单个请求的分阶段计时
+
+    每次标记把距上次标记的时间累加到对应阶段,同一阶段可以多次累加
+    """
+
+    __slots__ = ('route', 'start', 'last', 'durations')
+
+    def __init__(self, route: t.Any = None) -> None:
+        """ 初始化实例
+
+        @param route: 匹配到的路由对象
+        """
+        self.route = route
+        self.start = self.last = time.perf_counter()
+        self.durations = array('d', bytes(8 * len(TIMING_PHASES)))
+
+    def mark(self, phase: int) -> None:
+        """ 结束一个阶段
+
+        @param phase: 阶段下标
+        @return: None
+        """
+        now = time.perf_counter()
+        self.durations[phase] += now - self.last
+        self.last = now
+
+    def on_link(self, gt: t.Any) -> None:
+        """ 工作协程结束时的回调
+
+        @param gt: 工作协程
+        @return: None
+        """
+        self.mark(PHASE_HANDLER)
+
+    def get_server_timing(self) -> t.Text:
+        """ 生成Server-Timing头部的值
+
+        @return: t.Text
+        """
+        items = [f'{name};dur={d * 1000:.3f}' for name, d in zip(TIMING_PHASES, self.durations) if d]
+        items.append(f'total;dur={(time.perf_counter() - self.start) * 1000:.3f}')
+        return ', '.join(items)
+
+
+class TimingRegistry(object):
+    """ 分阶段计时登记表
+
+    只有存在使用者(如ServerTimingMiddleware)时才计时,平时请求只多一次属性判断
+    """
+
+    def __init__(self, metrics: MetricsRegistry) -> None:
+        """ 初始化实例
+
+        @param metrics: 指标登记表,启用时汇总各阶段耗时
+        """
+        self.users = 0
+        self.metrics = metrics
+
+    @property
+    def enabled(self) -> bool:
+        """ 是否需要计时 """
+        return self.users > 0
+
+    def enable(self) -> None:
+        """ 增加一个使用者
+
+        @return: None
+        """
+        self.users += 1
+
+    def disable(self) -> None:
+        """ 减少一个使用者
+
+        @return: None
+        """
+        self.users = max(self.users - 1, 0)
+
+    def begin(self, environ: WSGIEnvironment) -> RequestTiming:
+        """ 开始计时
+
+        @param environ: 环境对象
+        @return: RequestTiming
+        """
+        timing = environ[TIMING_ENVIRON_KEY] = RequestTiming()
+        accept_time = environ.get(ACCEPT_TIME_ENVIRON_KEY)
+        if accept_time is not None:
+            timing.durations[PHASE_ACCEPT] = timing.start - accept_time
+        posthooks = environ.get('eventlet.posthooks')
+        posthooks is None or posthooks.append((self.finish, (timing,), {}))
+        return timing
+
+    @staticmethod
+    def track(
+            wsgi_app: WSGIApplication,
+            timing: RequestTiming,
+            environ: WSGIEnvironment,
+            start_response: StartResponse
+    ) -> t.Iterable[bytes]:
+        """ 调用应用程序并把返回途中的耗时计入中间件阶段
+
+        @param wsgi_app: 应用程序
+        @param timing: 请求计时
+        @param environ: 环境对象
+        @param start_response: 响应对象
+        @return: t.Iterable[bytes]
+        """
+        try:
+            return wsgi_app(environ, start_response)
+        finally:
+            timing.mark(PHASE_MIDDLEWARE)
+
+    def finish(self, environ: WSGIEnvironment, timing: RequestTiming) -> None:
+        """ 响应发送完成后结束计时
+
+        @param environ: 环境对象
+        @param timing: 请求计时
+        @return: None
+        """
+        timing.mark(PHASE_SEND)
+        self.metrics.enabled and self.metrics.observe_timing(timing.route, timing.durations)
@@ -23,6 +23,11 @@ setup(
         'werkzeug==2.0.1',
         'service-core', 'service-green'
     ],
+    entry_points={
+        'console_scripts': [
+            'service-webserver-openapi3=service_webserver.core.middlewares.openapi3.pregenerate:main',
+        ],
+    },
     classifiers=[
         'Typing :: Typed',
         'Operating System :: MacOS',